@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Assembles a disk image: the GPT of a layout with the payloads of its
+partitions at their first LBAs.
+
+A payload shared by several partitions (both slots of an A/B partition)
+is written once, the other partitions get a clone of its range of the
+disk image: shared blocks (FICLONERANGE) on filesystems with reflinks,
+copy_file_range() otherwise, or a plain copy.
+
+The disk image is written in order of offsets, the secondary GPT last,
+so that hashio can hash it as it's written.
+
+The progress is journaled next to the disk image (<disk image>.journal):
+the layout of the tables, then a line per partition once its payload is
+on disk, with the payload's identity and sha256. A run interrupted is
+resumed by the next one for the same layout: the partitions whose
+payload is unchanged (same identity, and same sha256 once hashed again)
+are kept, the others written over, their zeros included. The journal is
+removed once the disk image is complete.
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import hashlib
+import json
+import os
+import struct
+
+import pt
+import sparse
+import hashio
+
+BUG = pt.BUG
+
+BYTES_PER_SECTOR = pt.BYTES_PER_SECTOR
+
+# _IOW(0x94, 13, struct file_clone_range)
+FICLONERANGE = 0x4020940D
+# src_fd, src_offset, src_length, dest_offset
+FILE_CLONE_RANGE = struct.Struct("=qQQQ")
+
+CLONE_ALIGNMENT = 4096
+COPY_SIZE = len(sparse.ZEROS)
+
+JOURNAL_SUFFIX = ".journal"
+
+FALLOC_FL_KEEP_SIZE  = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# fallocate() of the C library, False if there is none.
+_fallocate = None
+
+def punch_hole(fd, offset, length):
+  """Deallocate length bytes at offset of fd, which then read as zeros.
+  Return whether the filesystem did it."""
+  global _fallocate
+  if _fallocate is None:
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+      _fallocate = libc.fallocate
+      _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                             ctypes.c_int64, ctypes.c_int64]
+    except (OSError, AttributeError, TypeError):
+      _fallocate = False
+  if _fallocate is False:
+    return False
+  return _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                    offset, length) == 0
+
+def zero_fd(fd, offset, length):
+  """Make length bytes at offset of fd zeros: a hole, or written."""
+  if length <= 0 or punch_hole(fd, offset, length):
+    return
+  done = 0
+  while done < length:
+    done += os.pwrite(fd, sparse.ZEROS[:min(length - done, COPY_SIZE)],
+                      offset + done)
+
+def zero_range(f, offset, length):
+  """Make length bytes at offset of the file object f zeros, hashed as
+  such if f is a hashio.HashingFile."""
+  if length <= 0:
+    return
+  f.flush()
+  zero_fd(f.fileno(), offset, length)
+  if isinstance(f, hashio.HashingFile):
+    f.zeroed(offset, length)
+
+def copy_range(fd, src, dst, length, fresh=True):
+  """Copy length bytes at src of fd to dst. Zeros are left as holes if
+  fresh, the range at dst not written before, and zeroed otherwise."""
+  done = 0
+  while done < length:
+    os.lseek(fd, src + done, os.SEEK_SET)
+    data = os.read(fd, min(length - done, COPY_SIZE))
+    if len(data) == 0:
+      break
+    if data != sparse.ZEROS[:len(data)]:
+      os.lseek(fd, dst + done, os.SEEK_SET)
+      os.write(fd, data)
+    elif not fresh:
+      zero_fd(fd, dst + done, len(data))
+    done += len(data)
+
+def clone_range(fd, src, dst, length, fresh=True):
+  """Make length bytes at dst of fd the same as at src, and return how:
+  "reflink", "copy_file_range" or "copy" (see copy_range for fresh)."""
+  try:
+    fcntl.ioctl(fd, FICLONERANGE, FILE_CLONE_RANGE.pack(fd, src, length, dst))
+    return "reflink"
+  except (IOError, OSError):
+    # Not supported by the filesystem, or unaligned ranges.
+    pass
+
+  copy_file_range = getattr(os, "copy_file_range", None)
+  if copy_file_range is not None:
+    try:
+      done = 0
+      while done < length:
+        n = copy_file_range(fd, fd, length - done, src + done, dst + done)
+        if n == 0:
+          break
+        done += n
+      if done == length:
+        return "copy_file_range"
+    except OSError:
+      pass
+
+  copy_range(fd, src, dst, length, fresh)
+  return "copy"
+
+def write_raw(f, offset, path, digest=None, fresh=True):
+  """Write the file at path into f at offset, return its size. The data
+  is hashed into digest as it's read, if given. Zeros are left as holes
+  if fresh, the range not written before, and zeroed otherwise."""
+  size = 0
+  with open(path, "rb") as src:
+    while True:
+      data = src.read(COPY_SIZE)
+      if len(data) == 0:
+        break
+      if digest is not None:
+        digest.update(data)
+      if data != sparse.ZEROS[:len(data)]:
+        f.seek(offset + size)
+        f.write(data)
+      elif not fresh:
+        zero_range(f, offset + size, len(data))
+      size += len(data)
+  return size
+
+def payload_size(path):
+  """Return the bytes the payload at path takes once expanded."""
+  if sparse.is_sparse(path):
+    with open(path, "rb") as f:
+      return sparse.SparseImageReader(f).size()
+  return os.path.getsize(path)
+
+def file_digest(path):
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    while True:
+      data = f.read(COPY_SIZE)
+      if len(data) == 0:
+        break
+      digest.update(data)
+  return digest.hexdigest()
+
+def write_payload(f, offset, path, fresh=True):
+  """Write the payload at path, expanded if it's a sparse image, into f
+  at offset, and return the sha256 of the payload file. See write_raw
+  for fresh."""
+  if sparse.is_sparse(path):
+    zero = None
+    if not fresh:
+      zero = lambda at, length: zero_range(f, at, length)
+    with open(path, "rb") as src:
+      sparse.SparseImageReader(src).expand(f, offset, zero)
+    # Sparse images are read out of order, and small: hash them apart.
+    return file_digest(path)
+  digest = hashlib.sha256()
+  write_raw(f, offset, path, digest, fresh)
+  return digest.hexdigest()
+
+def layout_digest(table):
+  """The sha256 of the tables and size of the disk image of table."""
+  digest = hashlib.sha256()
+  digest.update(("%d:" % table.disk_sectors).encode("ascii"))
+  digest.update(bytes(table.protective_mbr.array))
+  digest.update(bytes(table.primary_gpt.array))
+  digest.update(bytes(table.secondary_gpt.array))
+  return digest.hexdigest()
+
+class Journal(object):
+  """The progress of the assembly of a disk image, in the file path: a
+  line with the digest of the layout, then a JSON record per partition,
+  each on disk only after the partition's payload."""
+
+  def __init__(self, path, layout):
+    self.path   = path
+    self.layout = layout
+    self.f      = None
+
+  def load(self):
+    """Return the records of the partitions written by an earlier run for
+    the same layout, by label."""
+    records = {}
+    try:
+      with open(self.path) as f:
+        lines = f.read().splitlines()
+    except (IOError, OSError):
+      return records
+    try:
+      header = json.loads(lines[0])
+    except (ValueError, IndexError):
+      return records
+    if header.get("layout") != self.layout:
+      return records
+    for line in lines[1:]:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        # Cut short by the interruption.
+        break
+      records[record["label"]] = record
+    return records
+
+  def start(self, records):
+    """Start the journal over with records, the partitions kept."""
+    self.f = open(self.path, "w")
+    self.f.write(json.dumps({"layout": self.layout}) + "\n")
+    for record in records:
+      self.f.write(json.dumps(record, sort_keys=True) + "\n")
+    self.sync()
+
+  def add(self, record):
+    self.f.write(json.dumps(record, sort_keys=True) + "\n")
+    self.sync()
+
+  def sync(self):
+    self.f.flush()
+    os.fsync(self.f.fileno())
+
+  def finish(self):
+    """The disk image is complete, forget the journal."""
+    self.f.close()
+    os.unlink(self.path)
+
+def payload_record(part, path, offset, length):
+  """Return the journal record of the payload at path written to offset,
+  without its sha256."""
+  st = os.stat(path)
+  record = {"label": part.label, "offset": offset, "length": length,
+            "payload": os.path.realpath(path), "size": st.st_size,
+            "mtime": st.st_mtime_ns}
+  if part.verity is not None:
+    record["tree"] = hashlib.sha256(part.verity.tree).hexdigest()
+  return record
+
+def is_kept(record, done, path=None):
+  """Whether the partition of record was written by an earlier run, as
+  recorded in done, from the same payload: its path, size, mtime and hash
+  tree, and, if path is given, the sha256 of the payload at path hashed
+  again (a payload rewritten within the mtime granularity, or copied
+  with its mtime)."""
+  old = done.get(record["label"])
+  if old is None:
+    return False
+  for key in record:
+    if old.get(key) != record[key]:
+      return False
+  if path is not None and old.get("sha256") != file_digest(path):
+    return False
+  return True
+
+def has_tables(output, table):
+  """Whether output is a disk image of the size of table starting with its
+  Protective MBR and Primary GPT."""
+  disk_size = table.disk_sectors * BYTES_PER_SECTOR
+  head = bytes(table.protective_mbr.array) + bytes(table.primary_gpt.array)
+  try:
+    if os.path.getsize(output) != disk_size:
+      return False
+    with open(output, "rb") as f:
+      return f.read(len(head)) == head
+  except (IOError, OSError):
+    return False
+
+def assemble(table, images, output):
+  """Write the disk image output from table, a gpt.GPTPartitionTable built
+  for its disk_sectors, and the payloads (partition filename) found in
+  the directory images, if not None. Returns the (offset, length) extents
+  written, nothing else of the disk image holds data.
+
+  An assembly of the same layout interrupted before is resumed, see
+  Journal."""
+  disk_size = table.disk_sectors * BYTES_PER_SECTOR
+  # (payload, hash tree) -> (offset, room, sha256) of its first partition
+  written = {}
+  extents = [(0, len(table.protective_mbr.array) +
+                 len(table.primary_gpt.array)),
+             (disk_size - len(table.secondary_gpt.array),
+              len(table.secondary_gpt.array))]
+
+  journal = Journal(output + JOURNAL_SUFFIX, layout_digest(table))
+  done = {}
+  if has_tables(output, table):
+    done = journal.load()
+  resume = len(done) > 0
+  kept = []
+
+  with hashio.open_output(output, "r+b" if resume else "w+b") as f:
+    hashing = isinstance(f, hashio.HashingFile)
+    if not resume:
+      f.truncate(disk_size)
+    f.write(bytearray(table.protective_mbr.array))
+    f.write(bytearray(table.primary_gpt.array))
+    # Partitions not reached again keep their records for the next run.
+    journal.start(list(done.values()))
+
+    parts = sorted(zip(table.partitions.part_list,
+                       table.primary_gpt.entry_array),
+                   key=lambda item: item[1].first_lba)
+    for part, entry in parts:
+      if images is None or part.filename == "":
+        continue
+      path = os.path.join(images, part.filename)
+      if not os.path.isfile(path):
+        old = done.get(part.label)
+        if old is not None:
+          # Written by the earlier run, with a payload gone since.
+          zero_range(f, old["offset"], old["length"])
+        print("| %-12s no payload %s" % (part.label, path))
+        continue
+
+      offset = entry.first_lba * BYTES_PER_SECTOR
+      room = (entry.last_lba - entry.first_lba + 1) * BYTES_PER_SECTOR
+      length = payload_size(path)
+      if part.verity is not None:
+        length = part.verity.hash_offset() + len(part.verity.tree)
+      if length > room:
+        raise RuntimeError("%s: %d bytes of payload, the partition has %d"
+                           % (part.label, length, room))
+      if hashing:
+        f.add_range(part.label, offset, length)
+
+      key = (os.path.realpath(path), id(part.verity))
+      record = payload_record(part, path, offset, length)
+      if key in written:
+        src, src_room, digest = written[key]
+        # Whole blocks can be shared, they stay within both partitions.
+        length = min(-(-length // CLONE_ALIGNMENT) * CLONE_ALIGNMENT,
+                     room, src_room)
+        record["source"] = src
+        record["sha256"] = digest
+        if is_kept(record, done):
+          how = "kept"
+          kept.append(part.label)
+        else:
+          f.flush()
+          how = clone_range(f.fileno(), src, offset, length, not resume)
+          if resume:
+            zero_fd(f.fileno(), offset + length, room - length)
+          os.fsync(f.fileno())
+          journal.add(record)
+        if hashing:
+          f.written_elsewhere(offset, length)
+        extents.append((offset, length))
+        print("| %-12s %s cloned (%s)" % (part.label, part.filename, how))
+        continue
+
+      if is_kept(record, done, path):
+        record["sha256"] = done[part.label]["sha256"]
+        if hashing:
+          f.written_elsewhere(offset, length)
+        kept.append(part.label)
+        print("| %-12s %s kept" % (part.label, part.filename))
+      else:
+        record["sha256"] = write_payload(f, offset, path, not resume)
+        if part.verity is not None:
+          if resume:
+            size = payload_size(path)
+            zero_range(f, offset + size, part.verity.hash_offset() - size)
+          f.seek(offset + part.verity.hash_offset())
+          f.write(part.verity.tree)
+        if resume:
+          # What an earlier payload left past this one.
+          zero_range(f, offset + length, room - length)
+        f.flush()
+        os.fsync(f.fileno())
+        journal.add(record)
+        print("| %-12s %s written" % (part.label, part.filename))
+      written[key] = (offset, room, record["sha256"])
+      extents.append((offset, length))
+
+    f.seek(disk_size - len(table.secondary_gpt.array))
+    f.write(bytearray(table.secondary_gpt.array))
+
+  journal.finish()
+  if resume:
+    BUG.green("Resume %s <-- Disk image, %d partitions kept"
+              % (output, len(kept)))
+  BUG.green("Create %s <-- Disk image" % output)
+  return extents
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Runs external commands (mkext4fs, mkdosfs, mcopy, ...) concurrently under
+a limit, streaming their output line by line into per-job logs.
+
+Needs Python 3 (asyncio), it is imported on demand by common.runJobs().
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import resource
+import signal
+import subprocess
+import time
+
+import common
+
+OPTIONS = common.OPTIONS
+
+# Longest line kept as one line in a job log, longer output is split.
+LINE_LIMIT = 1024 * 1024
+
+class Job(object):
+  """An external command to run.
+
+  Args:
+    args: the command represented as a list of strings.
+    name: name of the job in logs and results, args[0] if None.
+    log: path of the file receiving the job's output, or None.
+    timeout: seconds after which the job is killed, or None.
+    cwd, env: as for subprocess.Popen.
+  """
+
+  def __init__(self, args, name=None, log=None, timeout=None,
+               cwd=None, env=None):
+    self.args    = list(args)
+    self.name    = name if name is not None else os.path.basename(args[0])
+    self.log     = log
+    self.timeout = timeout
+    self.cwd     = cwd
+    self.env     = env
+
+class JobResult(object):
+
+  def __init__(self, job):
+    self.job        = job
+    self.returncode = None   # negative signal number if killed
+    self.duration   = 0.0    # seconds
+    # KB, from wait4(). The kernel carries the high water mark of the
+    # forked runner over exec, so a job peaking below the runner's own
+    # peak reports that instead: peak_rss is then only an upper bound,
+    # and rss_bound is set.
+    self.peak_rss   = 0
+    self.rss_bound  = False
+    self.timed_out  = False
+    self.cancelled  = False
+    self.error      = None   # exception if the job couldn't start
+
+  def ok(self):
+    return self.error is None and self.returncode == 0
+
+  def rss(self):
+    """peak_rss as text, "<=" marking an upper bound."""
+    return "%s%dKB" % (self.rss_bound and "<=" or "", self.peak_rss)
+
+  def __repr__(self):
+    return "<JobResult %s rc=%s %.3fs %s%s>" % (
+      self.job.name, self.returncode, self.duration, self.rss(),
+      self.timed_out and " timed out" or "")
+
+def returncode(status):
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
+def kill_group(pid):
+  try:
+    os.killpg(pid, signal.SIGKILL)
+  except OSError:
+    pass
+
+async def pipe_reader(loop, fd):
+  reader = asyncio.StreamReader(limit=LINE_LIMIT)
+  protocol = asyncio.StreamReaderProtocol(reader)
+  await loop.connect_read_pipe(lambda: protocol, os.fdopen(fd, "rb", 0))
+  return reader
+
+async def stream(reader, tag, job, log):
+  while True:
+    try:
+      line = await reader.readline()
+    except ValueError:
+      # Longer than LINE_LIMIT, take what is buffered as a line.
+      line = await reader.read(LINE_LIMIT)
+    if not line:
+      break
+    text = line.decode("utf-8", "replace").rstrip("\n")
+    if log is not None:
+      log.write("%s: %s\n" % (tag, text))
+    if OPTIONS.verbose:
+      print("  [%s] %s" % (job.name, text))
+
+async def run_job(job, semaphore, executor=None):
+  """Run job once semaphore allows it and return its JobResult. The job's
+  process group is killed on failure, timeout or cancellation, a job
+  cancelled while running still returns its JobResult."""
+  result = JobResult(job)
+  async with semaphore:
+    loop = asyncio.get_running_loop()
+    if OPTIONS.verbose:
+      print("  running: %s" % " ".join(job.args))
+
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    start = time.monotonic()
+    # What the job inherits over exec is at most this.
+    runner_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+      p = subprocess.Popen(job.args, stdin=subprocess.DEVNULL,
+                           stdout=out_w, stderr=err_w, cwd=job.cwd,
+                           env=job.env, start_new_session=True)
+    except OSError as e:
+      os.close(out_r)
+      os.close(err_r)
+      result.error = e
+      return result
+    finally:
+      os.close(out_w)
+      os.close(err_w)
+
+    log = open(job.log, "w") if job.log is not None else None
+    # The child is reaped with wait4() rather than through Popen so that
+    # its own resource usage is known.
+    waiter = loop.run_in_executor(executor, os.wait4, p.pid, 0)
+    try:
+      readers = [
+        asyncio.ensure_future(stream(await pipe_reader(loop, out_r),
+                                     "stdout", job, log)),
+        asyncio.ensure_future(stream(await pipe_reader(loop, err_r),
+                                     "stderr", job, log)),
+      ]
+      try:
+        await asyncio.wait_for(asyncio.shield(waiter), job.timeout)
+      except asyncio.TimeoutError:
+        result.timed_out = True
+      except asyncio.CancelledError:
+        result.cancelled = True
+      if not waiter.done() or returncode(waiter.result()[1]) != 0:
+        # Timed out, cancelled or failed: leave none of the job's
+        # processes behind, they would also hold its pipes open.
+        kill_group(p.pid)
+      _, status, rusage = await waiter
+      p.returncode = result.returncode = returncode(status)
+      result.peak_rss = rusage.ru_maxrss
+      result.rss_bound = result.peak_rss <= runner_rss
+      await asyncio.gather(*readers)
+    finally:
+      result.duration = time.monotonic() - start
+      if log is not None:
+        log.write("exit: %s (%.3fs, %s)\n" % (result.returncode,
+                                              result.duration,
+                                              result.rss()))
+        log.close()
+  return result
+
+async def run_jobs(jobs, limit=None, fail_fast=False):
+  """Run jobs with at most limit (default: the number of CPUs) of them at
+  a time, and return their JobResults in the order of jobs. With fail_fast
+  the remaining jobs are cancelled after the first failure."""
+  if limit is None:
+    limit = os.cpu_count() or 1
+  semaphore = asyncio.Semaphore(limit)
+  # One waiting thread per running job.
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=limit)
+  tasks = [asyncio.ensure_future(run_job(job, semaphore, executor))
+           for job in jobs]
+
+  if fail_fast:
+    for done in asyncio.as_completed(tasks):
+      if not (await done).ok():
+        break
+    for task in tasks:
+      task.cancel()
+
+  outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+  executor.shutdown()
+
+  results = []
+  for job, outcome in zip(jobs, outcomes):
+    if isinstance(outcome, asyncio.CancelledError):
+      outcome = JobResult(job)
+      outcome.cancelled = True
+    elif isinstance(outcome, BaseException):
+      raise outcome
+    results.append(outcome)
+  return results
+
+def run(jobs, limit=None, fail_fast=False):
+  """Synchronous form of run_jobs()."""
+  return asyncio.run(run_jobs(jobs, limit, fail_fast))
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given disk images (or directories of them) and the partition xml they were
+made from, checks that the GPT of every image matches the layout of the xml,
+and writes a report.
+
+Only the Protective MBR and the Primary GPT (LBA 0-33) and the Secondary GPT
+(the last 33 sectors) of an image are read, never the payloads of its
+partitions, and the images are checked concurrently.
+
+Usage: audit [flags] image_or_directory ...
+
+  -x  (--xml) <partition.xml>
+      The partition XML file the images were made from.
+
+  -l  (--lun) <lun>
+      The physical partition of the XML the images hold (default 0).
+
+  -L  (--list) <file>
+      A file naming an image per line, checked as well as the arguments.
+
+  -o  (--output) <report>
+      The report file (default: standard output).
+
+  -f  (--format) <json|csv>
+      The format of the report (default json).
+
+  -j  (--jobs) <jobs>
+      The number of images checked at the same time (default 4 per CPU).
+
+"""
+
+import os
+import sys
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.xml = None
+OPTIONS.lun = 0
+OPTIONS.list = None
+OPTIONS.report = None
+OPTIONS.format = "json"
+OPTIONS.jobs = None
+
+# Protective MBR, Primary GPT header and 32 sectors of entries
+PRIMARY_SECTORS   = 34
+# 32 sectors of entries and the Secondary GPT header
+SECONDARY_SECTORS = 33
+
+STATUS_OK       = "ok"
+STATUS_MISMATCH = "mismatch"
+STATUS_ERROR    = "error"
+
+def image_files(paths, list_file=None):
+  """Return the images of paths, the files of a directory in name order,
+  followed by those named in list_file."""
+  images = []
+  for path in paths:
+    if os.path.isdir(path):
+      for name in sorted(os.listdir(path)):
+        if os.path.isfile(os.path.join(path, name)):
+          images.append(os.path.join(path, name))
+    else:
+      images.append(path)
+  if list_file is not None:
+    with open(list_file) as f:
+      for line in f:
+        line = line.strip()
+        if line != "" and not line.startswith("#"):
+          images.append(line)
+  return images
+
+def read_tables(filename):
+  """Return (sectors, head, tail) of the image filename: its number of
+  sectors, its first PRIMARY_SECTORS and last SECONDARY_SECTORS sectors."""
+  import gpt
+
+  fd = os.open(filename, os.O_RDONLY)
+  try:
+    # Block devices have no st_size, seek to their end instead.
+    size = os.lseek(fd, 0, os.SEEK_END)
+    sectors = size // gpt.BYTES_PER_SECTOR
+    if sectors < PRIMARY_SECTORS + SECONDARY_SECTORS:
+      raise IOError("%d sectors, too small for a GPT" % sectors)
+    head = os.pread(fd, PRIMARY_SECTORS * gpt.BYTES_PER_SECTOR, 0)
+    tail = os.pread(fd, SECONDARY_SECTORS * gpt.BYTES_PER_SECTOR,
+                    (sectors - SECONDARY_SECTORS) * gpt.BYTES_PER_SECTOR)
+  finally:
+    os.close(fd)
+  return (sectors, head, tail)
+
+def decode_entries(data, header):
+  """Return the gpt.Entry list of the entry array data of header."""
+  import gpt
+
+  entries = []
+  for i in range(header.entry_number):
+    entry = gpt.Entry()
+    offset = i * header.entry_size
+    entry.fromarray(data[offset:offset + header.entry_size])
+    entries.append(entry)
+  return entries
+
+def check_header(header, data, name, current_lba, backup_lba,
+                 entry_array_start_lba, diagnostics):
+  """Check the decoded header and the CRC32 of its entry array data,
+  return whether the entries can be decoded."""
+  import gpt
+  import validate
+
+  def error(code, message):
+    diagnostics.append(validate.Diagnostic(validate.ERROR, code,
+                                           "%s: %s" % (name, message)))
+
+  template = gpt.GPTHeader(True)
+  if header.signature != template.signature:
+    error("header", "no GPT signature")
+    return False
+  if header.header_size < template.header_size or \
+     header.header_size > gpt.BYTES_PER_SECTOR:
+    error("header", "header size %d" % header.header_size)
+    return False
+  if header.header_crc32 != header.calc_header_crc32():
+    error("crc", "header CRC32 0x%X, computed 0x%X"
+          % (header.header_crc32, header.calc_header_crc32()))
+
+  for field, expected in (("current_lba", current_lba),
+                          ("backup_lba", backup_lba),
+                          ("entry_array_start_lba", entry_array_start_lba)):
+    value = getattr(header, field)
+    if value != expected:
+      error("header", "%s %d, expected %d" % (field, value, expected))
+
+  if header.entry_size != template.entry_size or \
+     header.entry_number * header.entry_size > len(data):
+    error("entries", "%d entries of %d bytes"
+          % (header.entry_number, header.entry_size))
+    return False
+  crc = gpt.crc32(data[:header.entry_number * header.entry_size])
+  if header.entry_array_crc32 != crc:
+    error("crc", "entry array CRC32 0x%X, computed 0x%X"
+          % (header.entry_array_crc32, crc))
+  return True
+
+def check_layout(entries, partitions, sectors, diagnostics):
+  """Compare the used entries with the partitions of the xml, placed as
+  gpt.py places them on a disk of sectors."""
+  import gpt
+  import validate
+
+  def error(label, message):
+    diagnostics.append(validate.Diagnostic(validate.ERROR, "layout",
+                                           "%s: %s" % (label, message),
+                                           (label,)))
+
+  used = [e for e in entries if not e.is_empty()]
+  spans = validate.place_partitions(partitions, partitions.instructions,
+                                    sectors)
+  if len(used) != len(spans):
+    diagnostics.append(validate.Diagnostic(
+      validate.ERROR, "entries",
+      "%d partitions, the xml has %d" % (len(used), len(spans))))
+
+  for entry, (first, last, part) in zip(used, spans):
+    if entry.label != part.label[0:36]:
+      error(part.label, "entry labelled %s" % entry.label)
+      continue
+    if entry.type_guid != part._type:
+      error(part.label, "type %s, expected %s"
+            % (gpt.guid2str(entry.type_guid), gpt.guid2str(part._type)))
+    if (entry.first_lba, entry.last_lba) != (first, last):
+      error(part.label, "sectors %s, expected %s"
+            % (validate.span(entry.first_lba, entry.last_lba),
+               validate.span(first, last)))
+    if entry.attributes != gpt.part_attributes(part):
+      error(part.label, "attributes 0x%X, expected 0x%X"
+            % (entry.attributes, gpt.part_attributes(part)))
+    if part.uniqueguid != "" and \
+       entry.unique_guid != part.validate_GUID(part.uniqueguid):
+      error(part.label, "uniqueguid %s, expected %s"
+            % (gpt.guid2str(entry.unique_guid), part.uniqueguid))
+
+def audit_image(filename, partitions):
+  """Check the image filename against partitions, return its result: a
+  dict of the image, its status, and the Diagnostics of its problems."""
+  import gpt
+  import validate
+
+  result = {"image": filename, "status": STATUS_OK, "sectors": None,
+            "disk_guid": None, "diagnostics": []}
+  diagnostics = result["diagnostics"]
+
+  try:
+    sectors, head, tail = read_tables(filename)
+  except (IOError, OSError) as e:
+    result["status"] = STATUS_ERROR
+    diagnostics.append(validate.Diagnostic(validate.ERROR, "io", str(e)))
+    return result
+  result["sectors"] = sectors
+
+  bps = gpt.BYTES_PER_SECTOR
+  if head[510:512] != b"\x55\xAA" or head[446 + 4] != 0xEE:
+    diagnostics.append(validate.Diagnostic(validate.ERROR, "mbr",
+                                           "no protective MBR"))
+
+  primary = gpt.GPTHeader(True)
+  primary.fromarray(head[bps:2 * bps])
+  primary_ok = check_header(primary, head[2 * bps:], "primary", 1,
+                            sectors - 1, 2, diagnostics)
+
+  secondary = gpt.GPTHeader(False)
+  secondary.fromarray(tail[-bps:])
+  secondary_ok = check_header(secondary, tail[:-bps], "secondary",
+                              sectors - 1, 1, sectors - SECONDARY_SECTORS,
+                              diagnostics)
+
+  if primary_ok:
+    result["disk_guid"] = gpt.guid2str(primary.disk_guid)
+    entries = decode_entries(head[2 * bps:], primary)
+    if secondary_ok and \
+       (head[2 * bps:2 * bps + primary.entry_number * primary.entry_size] !=
+        tail[:secondary.entry_number * secondary.entry_size] or
+        primary.disk_guid != secondary.disk_guid):
+      diagnostics.append(validate.Diagnostic(
+        validate.ERROR, "backup", "the Secondary GPT differs from the Primary"))
+    check_layout(entries, partitions, sectors, diagnostics)
+
+  if validate.has_errors(diagnostics):
+    result["status"] = STATUS_MISMATCH
+  return result
+
+def audit(images, partitions, jobs):
+  """Check images against partitions on a pool of jobs threads, return
+  their results in the order of images."""
+  from multiprocessing.pool import ThreadPool
+
+  pool = ThreadPool(max(1, min(jobs, len(images))))
+  try:
+    return pool.map(lambda image: audit_image(image, partitions), images,
+                    chunksize=16)
+  finally:
+    pool.close()
+    pool.join()
+
+def write_json(results, f):
+  import json
+
+  report = []
+  for result in results:
+    item = dict(result)
+    item["diagnostics"] = [d.to_dict() for d in result["diagnostics"]]
+    report.append(item)
+  json.dump(report, f, indent=2, sort_keys=True)
+  f.write("\n")
+
+def write_csv(results, f):
+  """One row per problem, and one for each image without any."""
+  import csv
+
+  writer = csv.writer(f)
+  writer.writerow(["image", "status", "level", "code", "labels", "message"])
+  for result in results:
+    if len(result["diagnostics"]) == 0:
+      writer.writerow([result["image"], result["status"], "", "", "", ""])
+    for d in result["diagnostics"]:
+      writer.writerow([result["image"], result["status"], d.level, d.code,
+                       " ".join(d.labels), d.message])
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-x", "--xml"):
+      OPTIONS.xml = arg
+    elif opt in ("-l", "--lun"):
+      OPTIONS.lun = int(arg)
+    elif opt in ("-L", "--list"):
+      OPTIONS.list = arg
+    elif opt in ("-o", "--output"):
+      OPTIONS.report = arg
+    elif opt in ("-f", "--format"):
+      OPTIONS.format = arg
+    elif opt in ("-j", "--jobs"):
+      OPTIONS.jobs = int(arg)
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="x:l:L:o:f:j:",
+                             extra_long_opts=[
+                               "xml=",
+                               "lun=",
+                               "list=",
+                               "output=",
+                               "format=",
+                               "jobs=",
+                             ],
+                             extra_option_handler=option_handler)
+
+  if OPTIONS.xml is None or OPTIONS.format not in ("json", "csv") or \
+     (len(args) == 0 and OPTIONS.list is None):
+    common.usage(__doc__)
+    sys.exit(1)
+
+  import multiprocessing
+  import parser
+  import pt
+
+  parser.PARSER.xml2object(OPTIONS.xml)
+  if OPTIONS.lun < 0 or OPTIONS.lun >= len(pt.PHYSICAL_PARTITIONS):
+    pt.BUG.error("No physical partition %d in %s." % (OPTIONS.lun, OPTIONS.xml))
+  partitions = pt.PHYSICAL_PARTITIONS[OPTIONS.lun]
+  if partitions._type is not partitions.GPT_TYPE:
+    pt.BUG.error("Only GPT layouts can be audited.")
+
+  if OPTIONS.jobs is None:
+    OPTIONS.jobs = 4 * multiprocessing.cpu_count()
+
+  images = image_files(args, OPTIONS.list)
+  results = audit(images, partitions, OPTIONS.jobs)
+
+  write = write_json if OPTIONS.format == "json" else write_csv
+  if OPTIONS.report is None:
+    write(results, sys.stdout)
+  else:
+    with open(OPTIONS.report, "w", newline="") as f:
+      write(results, f)
+
+  failed = [r for r in results if r["status"] != STATUS_OK]
+  sys.stderr.write("%d images audited, %d with problems.\n"
+                   % (len(results), len(failed)))
+  if len(failed) > 0:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Measures flashing payloads to the fake fastboot device over a link of
+some latency, waiting for every reply against pipelined commands, and
+checks what the device got.
+
+Usage: bench_fastboot.py [flags]
+
+  -n  (--runs) <runs>
+      The number of timed runs of each case (default 3).
+
+  -s  (--size) <size>
+      The size of the payload of each partition (default 32M).
+
+  -p  (--partitions) <count>
+      The number of partitions flashed (default 4).
+
+  -m  (--max-download-size) <size>
+      The max-download-size of the device (default 1M).
+
+  -L  (--latency) <ms>
+      The latency of the replies of the device (default 2).
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import common
+# Sets its own OPTIONS defaults, before those of the benchmark.
+import fastboot
+
+OPTIONS = common.OPTIONS
+OPTIONS.runs = 3
+OPTIONS.size = 32 * 1024 * 1024
+OPTIONS.partitions = 4
+OPTIONS.max_download_size = 1024 * 1024
+OPTIONS.latency = 2.0
+
+def make_payload(path, size):
+  """Half random data, half zeros, in 1M stretches."""
+  stretch = 1024 * 1024
+  with open(path, "wb") as f:
+    written = 0
+    while written < size:
+      n = min(stretch, size - written)
+      if (written // stretch) % 2 == 0:
+        f.write(os.urandom(n))
+      else:
+        f.write(b"\0" * n)
+      written += n
+
+def check(jobs, device_directory):
+  for label, path in jobs:
+    with open(path, "rb") as a, \
+         open(os.path.join(device_directory, label), "rb") as b:
+      expected = a.read()
+      if b.read(len(expected)) != expected:
+        raise RuntimeError("%s differs from %s" % (label, path))
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-n", "--runs"):
+      OPTIONS.runs = int(arg)
+    elif opt in ("-s", "--size"):
+      OPTIONS.size = common.parseSize(arg)
+    elif opt in ("-p", "--partitions"):
+      OPTIONS.partitions = int(arg)
+    elif opt in ("-m", "--max-download-size"):
+      OPTIONS.max_download_size = common.parseSize(arg)
+    elif opt in ("-L", "--latency"):
+      OPTIONS.latency = float(arg)
+    else:
+      return False
+    return True
+
+  common.parseOptions(argv, __doc__,
+                      extra_opts="n:s:p:m:L:",
+                      extra_long_opts=["runs=", "size=", "partitions=",
+                                       "max-download-size=", "latency="],
+                      extra_option_handler=option_handler)
+
+  directory = tempfile.mkdtemp(prefix="bench_fastboot.")
+  device_directory = os.path.join(directory, "device")
+  os.mkdir(device_directory)
+  device = fastboot.FakeDevice(device_directory,
+                               max_download_size=OPTIONS.max_download_size,
+                               latency=OPTIONS.latency)
+  device.start()
+  try:
+    jobs = []
+    for i in range(OPTIONS.partitions):
+      path = os.path.join(directory, "payload%d.img" % i)
+      make_payload(path, OPTIONS.size)
+      jobs.append(("part%d" % i, path))
+
+    print("%d partitions of %dMB, max-download-size %dKB, latency %.1fms"
+      % (OPTIONS.partitions, OPTIONS.size // (1024 * 1024),
+         OPTIONS.max_download_size // 1024, OPTIONS.latency))
+    print("%-14s %10s %10s" % ("case", "best(s)", "MB/s"))
+    total = OPTIONS.partitions * OPTIONS.size / (1024.0 * 1024.0)
+    for name, depth in (("lockstep", 1),
+                        ("pipelined", fastboot.PIPELINE),
+                        ("pipelined x4", 4 * fastboot.PIPELINE)):
+      samples = []
+      for i in range(OPTIONS.runs):
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        start = time.time()
+        try:
+          transport = fastboot.connect("localhost", device.port)
+          try:
+            fastboot.flash(transport, jobs, depth)
+          finally:
+            transport.close()
+        finally:
+          sys.stdout.close()
+          sys.stdout = stdout
+        samples.append(time.time() - start)
+      check(jobs, device_directory)
+      best = min(samples)
+      print("%-14s %10.2f %10.1f" % (name, best, total / best))
+  finally:
+    device.close()
+    shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Measures the filesystem image builders end to end over synthetic source
+trees, and checks the results against a baseline.
+
+The trees are generated from a seed, the same for every run: many tiny
+files, a few huge files (data and holes), deep directories, and a mix
+like a root filesystem (binaries, libraries, symlinks, hard links). Each
+builder runs in a forked process, as its command would: its wall time,
+the subprocesses it starts, the bytes of the image (and those allocated
+on disk) and its peak RSS (with its subprocesses) are recorded.
+
+Builders whose external tools are missing (the mkext4fs tool, mkdosfs
+and mcopy for vfat) are skipped, nothing needs the network.
+
+Usage: bench_fsimage.py [flags]
+
+  -n  (--runs) <runs>
+      The number of timed runs of each case, the best is kept (default 3).
+
+  -S  (--scale) <factor>
+      Scale the number and sizes of the files of the trees (default 1).
+
+  -s  (--seed) <seed>
+      The seed of the trees (default 0).
+
+  -t  (--trees) <tree>[,<tree>...]
+      The trees: tiny, huge, deep, rootfs (default all of them).
+
+  -B  (--builders) <builder>[,<builder>...]
+      The builders: ext4, ext4-sparse, ext4-tool, vfat (default all).
+
+  -o  (--output) <file>
+      Write the results as a JSON baseline, with the thresholds of -T.
+
+  -b  (--baseline) <file>
+      Compare the results to the JSON baseline, and exit with 1 if one of
+      them regressed by more than the baseline's thresholds.
+
+  -T  (--threshold) <metric>=<fraction>
+      The regression threshold of metric (wall, rss, bytes, allocated,
+      subprocesses) written with -o, e.g. wall=0.25 for 25% slower.
+
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.runs = 3
+OPTIONS.scale = 1.0
+OPTIONS.seed = 0
+OPTIONS.trees = None
+OPTIONS.builders = None
+OPTIONS.output = None
+OPTIONS.baseline = None
+OPTIONS.thresholds = {
+  "wall":         0.25,
+  "rss":          0.20,
+  "bytes":        0.05,
+  "allocated":    0.10,
+  "subprocesses": 0.0,
+}
+
+# The mtime of every generated file, images depend on it.
+MTIME = 1262304000
+TIMESTAMP = "1262304000"
+MB = 1024 * 1024
+
+########################################
+# Trees
+
+def scaled(n):
+  return max(1, int(n * OPTIONS.scale))
+
+def data(rnd, size):
+  return bytes(bytearray(rnd.getrandbits(8) for i in range(size))) \
+         if size < 64 else rnd.getrandbits(size * 8).to_bytes(size, "little")
+
+def write_file(path, rnd, size):
+  with open(path, "wb") as f:
+    f.write(data(rnd, size))
+
+def make_tiny(root, rnd):
+  """Many files of at most 512 bytes, a hundred per directory."""
+  count = scaled(20000)
+  for i in range(count):
+    d = os.path.join(root, "d%03d" % (i // 100))
+    if i % 100 == 0:
+      os.mkdir(d)
+    write_file(os.path.join(d, "f%05d" % i), rnd, rnd.randint(0, 512))
+
+def make_huge(root, rnd):
+  """A few files of tens of megabytes, half of them holes."""
+  block = data(rnd, MB)
+  for i in range(3):
+    size = scaled(32 + 32 * i) * MB
+    with open(os.path.join(root, "huge%d.bin" % i), "wb") as f:
+      for j in range(size // MB):
+        if j % 2 == 0:
+          f.write(block[j % 256:] + block[:j % 256])
+        else:
+          f.seek(MB, os.SEEK_CUR)
+      f.truncate(size)
+
+def make_deep(root, rnd):
+  """Directories 100 deep, a few small files at each level."""
+  for chain in range(scaled(20)):
+    d = os.path.join(root, "chain%02d" % chain)
+    for level in range(100):
+      d = os.path.join(d, "level%03d" % level)
+      os.makedirs(d)
+      for i in range(3):
+        write_file(os.path.join(d, "f%d" % i), rnd, rnd.randint(0, 4096))
+
+def make_rootfs(root, rnd):
+  """A mix like a root filesystem: binaries and libraries of skewed
+  sizes, configuration files, symlinks and hard links."""
+  sizes = {"bin": (200, 16 * 1024), "lib": (400, 64 * 1024),
+           "etc": (300, 1024), "usr/share": (1500, 4096)}
+  for d, (count, median) in sorted(sizes.items()):
+    path = os.path.join(root, d)
+    os.makedirs(path)
+    for i in range(scaled(count)):
+      size = min(int(rnd.lognormvariate(0, 1.2) * median), 8 * MB)
+      write_file(os.path.join(path, "%s%04d" % (os.path.basename(d), i)),
+                 rnd, size)
+  for i in range(scaled(50)):
+    os.symlink("../lib/lib%04d" % i, os.path.join(root, "bin", "link%04d" % i))
+    os.link(os.path.join(root, "bin", "bin%04d" % i),
+            os.path.join(root, "bin", "hard%04d" % i))
+
+TREES = [
+  ("tiny",   make_tiny),
+  ("huge",   make_huge),
+  ("deep",   make_deep),
+  ("rootfs", make_rootfs),
+]
+
+def make_tree(directory, name, make):
+  root = os.path.join(directory, name)
+  os.mkdir(root)
+  make(root, random.Random("%s:%s" % (OPTIONS.seed, name)))
+  for dpath, dnames, fnames in os.walk(root):
+    for n in dnames + fnames:
+      os.utime(os.path.join(dpath, n), (MTIME, MTIME), follow_symlinks=False)
+  os.utime(root, (MTIME, MTIME))
+  return root
+
+########################################
+# Builders
+
+def tool_path(name):
+  """The external tool name in PATH, None if missing or one of ours."""
+  path = shutil.which(name)
+  if path is None or os.path.realpath(path).startswith(ROOT + os.sep):
+    return None
+  return path
+
+BUILDERS = [
+  # name, module, flags, external tools needed
+  ("ext4",        "mkext4fs", ["-b", "-T", TIMESTAMP], []),
+  ("ext4-sparse", "mkext4fs", ["-b", "-S", "-T", TIMESTAMP], []),
+  ("ext4-tool",   "mkext4fs", ["-T", TIMESTAMP], ["mkext4fs"]),
+  ("vfat",        "mkvfatfs", [], ["mkdosfs", "mcopy"]),
+]
+
+def run_builder(module, argv):
+  """Run module.main(argv) in a forked process. Returns (exit status,
+  wall seconds, subprocesses started, peak RSS in KB)."""
+  read_end, write_end = os.pipe()
+  start = time.time()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_end)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    status = 0
+    started = [0]
+    try:
+      import subprocess
+      popen_init = subprocess.Popen.__init__
+
+      def counting_init(self, *args, **kwargs):
+        started[0] += 1
+        popen_init(self, *args, **kwargs)
+      subprocess.Popen.__init__ = counting_init
+
+      __import__(module).main(argv)
+    except SystemExit as e:
+      status = e.code or 0
+    except BaseException:
+      status = 1
+    os.write(write_end, str(started[0]).encode("ascii"))
+    os._exit(status if isinstance(status, int) else 1)
+
+  os.close(write_end)
+  _, status, rusage = os.wait4(pid, 0)
+  wall = time.time() - start
+  started = int(os.read(read_end, 64) or b"0")
+  os.close(read_end)
+  # ru_maxrss is in KB, the largest of the builder and its subprocesses.
+  return (os.waitstatus_to_exitcode(status), wall, started, rusage.ru_maxrss)
+
+def measure(builder, tree, directory):
+  """Return the result of builder over tree, the best of OPTIONS.runs."""
+  name, module, flags, tools = builder
+  missing = [t for t in tools if tool_path(t) is None]
+  if len(missing) > 0:
+    return {"skipped": "no %s" % ", ".join(missing)}
+
+  image = os.path.join(directory, "bench.img")
+  best = None
+  for i in range(OPTIONS.runs):
+    if os.path.exists(image):
+      os.unlink(image)
+    status, wall, started, rss = run_builder(module, flags + [tree, image])
+    if status != 0:
+      return {"failed": "exit status %d" % status}
+    st = os.stat(image)
+    result = {"wall": round(wall, 4), "subprocesses": started,
+              "rss": rss, "bytes": st.st_size,
+              "allocated": st.st_blocks * 512}
+    if best is None or result["wall"] < best["wall"]:
+      best = result
+  os.unlink(image)
+  return best
+
+########################################
+# Baseline
+
+def regressions(results, baseline):
+  """Return the lines about the results worse than baseline by more than
+  its thresholds."""
+  thresholds = baseline.get("thresholds", OPTIONS.thresholds)
+  lines = []
+  for case, old in sorted(baseline.get("results", {}).items()):
+    new = results.get(case)
+    if new is None or "wall" not in new or "wall" not in old:
+      continue
+    for metric, threshold in sorted(thresholds.items()):
+      if metric not in old or metric not in new:
+        continue
+      limit = old[metric] * (1.0 + threshold)
+      if new[metric] > limit:
+        lines.append("%s: %s %s -> %s (more than %+d%%)"
+                     % (case, metric, old[metric], new[metric],
+                        int(threshold * 100)))
+  return lines
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-n", "--runs"):
+      OPTIONS.runs = int(arg)
+    elif opt in ("-S", "--scale"):
+      OPTIONS.scale = float(arg)
+    elif opt in ("-s", "--seed"):
+      OPTIONS.seed = arg
+    elif opt in ("-t", "--trees"):
+      OPTIONS.trees = arg.split(",")
+    elif opt in ("-B", "--builders"):
+      OPTIONS.builders = arg.split(",")
+    elif opt in ("-o", "--output"):
+      OPTIONS.output = arg
+    elif opt in ("-b", "--baseline"):
+      OPTIONS.baseline = arg
+    elif opt in ("-T", "--threshold"):
+      metric, value = arg.split("=", 1)
+      OPTIONS.thresholds[metric] = float(value)
+    else:
+      return False
+    return True
+
+  common.parseOptions(argv, __doc__,
+                      extra_opts="n:S:s:t:B:o:b:T:",
+                      extra_long_opts=["runs=", "scale=", "seed=", "trees=",
+                                       "builders=", "output=", "baseline=",
+                                       "threshold="],
+                      extra_option_handler=option_handler)
+
+  trees = [t for t in TREES
+           if OPTIONS.trees is None or t[0] in OPTIONS.trees]
+  builders = [b for b in BUILDERS
+              if OPTIONS.builders is None or b[0] in OPTIONS.builders]
+
+  directory = tempfile.mkdtemp(prefix="bench_fsimage.")
+  results = {}
+  try:
+    print("%-20s %9s %6s %9s %10s %10s" % ("case", "wall(s)", "procs",
+                                           "rss(MB)", "image(MB)",
+                                           "disk(MB)"))
+    for tree_name, make in trees:
+      start = time.time()
+      tree = make_tree(directory, tree_name, make)
+      sys.stderr.write("%s: generated in %.1fs\n"
+                       % (tree_name, time.time() - start))
+      for builder in builders:
+        case = "%s/%s" % (tree_name, builder[0])
+        result = results[case] = measure(builder, tree, directory)
+        if "wall" not in result:
+          print("%-20s %s" % (case, result.get("skipped") or result["failed"]))
+          continue
+        print("%-20s %9.2f %6d %9.1f %10.1f %10.1f"
+          % (case, result["wall"], result["subprocesses"],
+             result["rss"] / 1024.0, result["bytes"] / float(MB),
+             result["allocated"] / float(MB)))
+      shutil.rmtree(tree)
+  finally:
+    shutil.rmtree(directory)
+
+  if OPTIONS.output is not None:
+    with open(OPTIONS.output, "w") as f:
+      json.dump({"scale": OPTIONS.scale, "seed": OPTIONS.seed,
+                 "thresholds": OPTIONS.thresholds, "results": results},
+                f, indent=1, sort_keys=True)
+      f.write("\n")
+
+  failed = [case for case, r in results.items() if "failed" in r]
+  if OPTIONS.baseline is not None:
+    with open(OPTIONS.baseline) as f:
+      baseline = json.load(f)
+    if baseline.get("scale") != OPTIONS.scale or \
+       str(baseline.get("seed")) != str(OPTIONS.seed):
+      sys.stderr.write("The baseline was made with other trees "
+                       "(scale %s, seed %s).\n"
+                       % (baseline.get("scale"), baseline.get("seed")))
+      sys.exit(2)
+    lines = regressions(results, baseline)
+    for line in lines:
+      print("REGRESSION %s" % line)
+    if len(lines) > 0:
+      sys.exit(1)
+  if len(failed) > 0:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Measures the per-invocation start-up cost of the ptbox commands against
+a bare interpreter start-up.
+
+Usage: bench_startup.py [flags]
+
+  -n  (--runs) <runs>
+      The number of timed runs of each case (default 20).
+
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.runs = 20
+
+def cases(output_directory):
+  py    = sys.executable
+  ptbox = os.path.join(ROOT, "ptbox.py")
+  xml   = os.path.join(ROOT, "partition-gpt-example.xml")
+  return [
+    ("python -c pass",     [py, "-c", "pass"]),
+    ("ptbox -h",           [py, ptbox, "-h"]),
+    ("ptbox mkpart -h",    [py, ptbox, "mkpart", "-h"]),
+    ("ptbox mkext4fs -h",  [py, ptbox, "mkext4fs", "-h"]),
+    ("ptbox mkvfatfs -h",  [py, ptbox, "mkvfatfs", "-h"]),
+    ("ptbox mkpart (gpt)", [py, ptbox, "mkpart", "-g", "-x", xml,
+                            "-o", output_directory + "/"]),
+  ]
+
+def timeit(cmd, runs):
+  devnull = open(os.devnull, "w")
+  # One untimed run so that byte code caches are in place.
+  subprocess.call(cmd, stdout=devnull, stderr=devnull)
+  samples = []
+  for i in range(runs):
+    start = time.time()
+    subprocess.call(cmd, stdout=devnull, stderr=devnull)
+    samples.append((time.time() - start) * 1000.0)
+  devnull.close()
+  samples.sort()
+  return samples[0], samples[len(samples) // 2]
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-n", "--runs"):
+      OPTIONS.runs = int(arg)
+    else:
+      return False
+    return True
+
+  common.parseOptions(argv, __doc__,
+                      extra_opts="n:",
+                      extra_long_opts=["runs="],
+                      extra_option_handler=option_handler)
+
+  output_directory = tempfile.mkdtemp(prefix="bench_startup.")
+  try:
+    baseline = None
+    print("%-22s %10s %10s %10s" % ("case", "min(ms)", "median(ms)",
+                                    "overhead"))
+    for name, cmd in cases(output_directory):
+      fastest, median = timeit(cmd, OPTIONS.runs)
+      if baseline is None:
+        baseline = median
+      print("%-22s %10.1f %10.1f %+9.1f" % (name, fastest, median,
+                                            median - baseline))
+  finally:
+    shutil.rmtree(output_directory)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
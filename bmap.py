@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given an image, writes its block map (bmaptool format 2.0) to a .bmap file.
+Given an image and a target device or file, copies only the mapped blocks
+of the image to the target. Otherwise print usages.
+
+Usage: bmap [flags] image [target]
+
+  -b  (--bmap) <bmap file>
+      The block map of the image (default: image.bmap).
+
+  -n  (--no-verify)
+      Don't verify the checksums of the copied ranges.
+
+"""
+
+import hashlib
+import os
+import sys
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.bmap = None
+OPTIONS.verify = True
+
+BLOCK_SIZE = 4096
+CHECKSUM   = "sha256"
+READ_SIZE  = 1024 * 1024
+
+ZEROS = b"\0" * READ_SIZE
+
+def data_extents(fd, size, hints=None):
+  """Yield the (offset, length) extents of fd, size bytes long, which may
+  hold data: those found with SEEK_DATA/SEEK_HOLE, within the (offset,
+  length) hints if given, or the whole file where seeking for holes isn't
+  supported."""
+  if hints is None:
+    hints = [(0, size)]
+
+  for start, length in hints:
+    end = min(start + length, size)
+    offset = start
+    while offset < end:
+      try:
+        data = os.lseek(fd, offset, os.SEEK_DATA)
+        hole = os.lseek(fd, data, os.SEEK_HOLE)
+      except AttributeError:
+        # No SEEK_DATA on this platform
+        yield (offset, end - offset)
+        break
+      except OSError as e:
+        import errno
+        if e.errno == errno.ENXIO:
+          # No data after offset
+          break
+        yield (offset, end - offset)
+        break
+      if data >= end:
+        break
+      yield (data, min(hole, end) - data)
+      offset = hole
+
+def block_extents(extents, size, block_size):
+  """Return extents widened to whole blocks (the last one ending at size),
+  sorted and merged where they touch."""
+  merged = []
+  for offset, length in sorted(extents):
+    start = offset // block_size * block_size
+    end = min(-(-(offset + length) // block_size) * block_size, size)
+    if len(merged) > 0 and start <= merged[-1][1]:
+      merged[-1][1] = max(merged[-1][1], end)
+    else:
+      merged.append([start, end])
+  return merged
+
+def mapped_ranges(fd, size, block_size=BLOCK_SIZE, hints=None):
+  """Return the (first, last, checksum) of each range of blocks of fd
+  holding data: blocks of its data extents which aren't all zeros. The
+  checksum covers the bytes of the range (up to size for the last
+  block)."""
+  zero_block = b"\0" * block_size
+  ranges = []
+  current = None  # [first, last, hash] of the range being read
+
+  extents = block_extents(data_extents(fd, size, hints), size, block_size)
+  for offset, end in extents:
+    while offset < end:
+      data = os.pread(fd, min(READ_SIZE, end - offset), offset)
+      if len(data) == 0:
+        break
+      if data == ZEROS[:len(data)]:
+        # Fast path, a run of zeros
+        offset += len(data)
+        continue
+      for i in range(0, len(data), block_size):
+        chunk = data[i:i + block_size]
+        if chunk == zero_block[:len(chunk)]:
+          continue
+        b = (offset + i) // block_size
+        if current is None or current[1] != b - 1:
+          if current is not None:
+            ranges.append((current[0], current[1], current[2].hexdigest()))
+          current = [b, b, hashlib.new(CHECKSUM)]
+        current[1] = b
+        current[2].update(chunk)
+      offset += len(data)
+
+  if current is not None:
+    ranges.append((current[0], current[1], current[2].hexdigest()))
+  return ranges
+
+def format_range(first, last):
+  if first == last:
+    return "%d" % first
+  return "%d-%d" % (first, last)
+
+def bmap_text(size, block_size, ranges, file_checksum):
+  mapped = sum([last - first + 1 for first, last, checksum in ranges])
+  lines = [
+    '<?xml version="1.0" ?>',
+    '<bmap version="2.0">',
+    '    <ImageSize> %d </ImageSize>' % size,
+    '    <BlockSize> %d </BlockSize>' % block_size,
+    '    <BlocksCount> %d </BlocksCount>' % -(-size // block_size),
+    '    <MappedBlocksCount> %d </MappedBlocksCount>' % mapped,
+    '    <ChecksumType> %s </ChecksumType>' % CHECKSUM,
+    '    <BmapFileChecksum> %s </BmapFileChecksum>' % file_checksum,
+    '    <BlockMap>',
+  ]
+  for first, last, checksum in ranges:
+    lines.append('        <Range chksum="%s"> %s </Range>'
+                 % (checksum, format_range(first, last)))
+  lines.append('    </BlockMap>')
+  lines.append('</bmap>')
+  return "\n".join(lines) + "\n"
+
+def write_bmap(image, bmap_file=None, block_size=BLOCK_SIZE, hints=None):
+  """Write the block map of image to bmap_file (default: image.bmap).
+  hints are the (offset, length) extents image may hold data in, e.g.
+  the tables and payloads of a disk image, the rest isn't even read.
+  Returns the name of the bmap file."""
+  if bmap_file is None:
+    bmap_file = image + ".bmap"
+
+  fd = os.open(image, os.O_RDONLY)
+  try:
+    size = os.lseek(fd, 0, os.SEEK_END)
+    ranges = mapped_ranges(fd, size, block_size, hints)
+  finally:
+    os.close(fd)
+
+  # The checksum of the file is taken with its own field as zeros.
+  zeros = "0" * hashlib.new(CHECKSUM).digest_size * 2
+  text = bmap_text(size, block_size, ranges, zeros)
+  checksum = hashlib.new(CHECKSUM, text.encode("ascii")).hexdigest()
+  with open(bmap_file, "w") as f:
+    f.write(bmap_text(size, block_size, ranges, checksum))
+  return bmap_file
+
+class BlockMap(object):
+  """A block map read back from a .bmap file."""
+
+  def __init__(self, bmap_file):
+    import xml.etree.ElementTree as ET
+
+    with open(bmap_file, "rb") as f:
+      text = f.read()
+    root = ET.fromstring(text)
+    if root.tag != "bmap":
+      raise RuntimeError("%s is not a block map" % bmap_file)
+
+    self.image_size  = int(root.findtext("ImageSize"))
+    self.block_size  = int(root.findtext("BlockSize"))
+    self.blocks      = int(root.findtext("BlocksCount"))
+    self.checksum    = root.findtext("ChecksumType", CHECKSUM).strip()
+    self.ranges      = []
+
+    file_checksum = root.findtext("BmapFileChecksum")
+    if file_checksum is not None:
+      file_checksum = file_checksum.strip()
+      zeros = b"0" * len(file_checksum)
+      h = hashlib.new(self.checksum,
+                      text.replace(file_checksum.encode("ascii"), zeros, 1))
+      if h.hexdigest() != file_checksum:
+        raise RuntimeError("%s is corrupted, checksum mismatch" % bmap_file)
+
+    for r in root.find("BlockMap").findall("Range"):
+      blocks = r.text.strip().split("-")
+      first = int(blocks[0])
+      last  = int(blocks[-1])
+      self.ranges.append((first, last, r.get("chksum")))
+
+  def mapped_blocks(self):
+    return sum([last - first + 1 for first, last, checksum in self.ranges])
+
+def copy(image, target, bmap_file=None, verify=True):
+  """Copy the mapped ranges of image, as listed in bmap_file (default:
+  image.bmap), to target, a device or a file. Blocks which aren't mapped
+  are never written, a new target file has holes there. Returns the
+  bytes copied."""
+  if bmap_file is None:
+    bmap_file = image + ".bmap"
+  bmap = BlockMap(bmap_file)
+
+  src = os.open(image, os.O_RDONLY)
+  dst = os.open(target, os.O_WRONLY | os.O_CREAT, 0o644)
+  copied = 0
+  try:
+    if os.path.isfile(target) and os.fstat(dst).st_size < bmap.image_size:
+      os.ftruncate(dst, bmap.image_size)
+    for first, last, checksum in bmap.ranges:
+      offset = first * bmap.block_size
+      end = min((last + 1) * bmap.block_size, bmap.image_size)
+      h = hashlib.new(bmap.checksum)
+      while offset < end:
+        data = os.pread(src, min(READ_SIZE, end - offset), offset)
+        if len(data) == 0:
+          raise RuntimeError("%s ends within block %d" % (image, last))
+        h.update(data)
+        os.pwrite(dst, data, offset)
+        offset += len(data)
+        copied += len(data)
+      if verify is True and checksum is not None and \
+         h.hexdigest() != checksum:
+        raise RuntimeError("checksum mismatch of blocks %s of %s"
+                           % (format_range(first, last), image))
+    os.fsync(dst)
+  finally:
+    os.close(src)
+    os.close(dst)
+  return copied
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-b", "--bmap"):
+      OPTIONS.bmap = arg
+    elif opt in ("-n", "--no-verify"):
+      OPTIONS.verify = False
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="b:n",
+                             extra_long_opts=[
+                               "bmap=",
+                               "no-verify",
+                             ],
+                             extra_option_handler=option_handler)
+
+  if len(args) == 1:
+    bmap_file = write_bmap(args[0], OPTIONS.bmap)
+    print("Create %s <-- Block map of %s" % (bmap_file, args[0]))
+  elif len(args) == 2:
+    copied = copy(args[0], args[1], OPTIONS.bmap, OPTIONS.verify)
+    print("Copied %d bytes of %s to %s" % (copied, args[0], args[1]))
+  else:
+    common.usage(__doc__)
+    sys.exit(1)
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Keeps images (gpt_*.bin, MBR.bin/EBR.bin, partition and disk images) in a
+store of content-defined chunks, each stored once whatever the number of
+images and builds holding it. Otherwise print usages.
+
+Usage: chunkstore [flags] put image ...
+       chunkstore [flags] get [tag/]image output
+       chunkstore [flags] list
+       chunkstore [flags] gc
+
+  -s  (--store) <directory>
+      The chunk store (default: ./chunks).
+
+  -t  (--tag) <tag>
+      The build the images are put as, their manifests go under it.
+
+  -x  (--xml) <partition.xml>
+      The layout of the disk images being put: the partitions are
+      recorded in their manifests, and chunked apart.
+
+  -l  (--lun) <lun>
+      The physical partition of the XML the disk images hold (default 0).
+
+  -j  (--jobs) <jobs>
+      The number of processes chunking and hashing (default: the number
+      of CPUs).
+
+A chunk ends where the CRC32 of its last sector (512 bytes, the window of
+the rolling hash, moved a sector at a time) has its low bits clear, so
+that equal content cuts the same way wherever it moved to in an image.
+Chunks of zeros and holes aren't stored. "gc" removes the chunks no
+manifest refers to.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.store = "chunks"
+OPTIONS.tag = None
+OPTIONS.xml = None
+OPTIONS.lun = 0
+OPTIONS.jobs = None
+
+SECTOR_SIZE = 512
+MIN_CHUNK   = 16 * 1024
+MAX_CHUNK   = 256 * 1024
+# A boundary at one sector in 128 after MIN_CHUNK: 80K chunks on average
+BOUNDARY_MASK = 127
+# Partitions are chunked in segments of at most this many bytes at once
+SEGMENT_SIZE = 64 * 1024 * 1024
+READ_SIZE    = 4 * 1024 * 1024
+CHECKSUM     = "sha256"
+MANIFEST_VERSION = 1
+
+ZEROS = b"\0" * MAX_CHUNK
+
+def chunk_path(store, digest):
+  return os.path.join(store, "chunks", digest[:2], digest)
+
+def manifest_path(store, name):
+  return os.path.join(store, "manifests", name + ".json")
+
+def cut(data, start, limit):
+  """Return the length of the chunk of data starting at start, ending at
+  limit at the latest."""
+  i = start + MIN_CHUNK
+  while i < limit:
+    if zlib.crc32(data[i - SECTOR_SIZE:i]) & BOUNDARY_MASK == 0:
+      return i - start
+    i += SECTOR_SIZE
+  return limit - start
+
+def chunks(fd, offset, length):
+  """Yield the chunks of the length bytes of fd at offset, as memoryviews."""
+  carry = b""
+  end = offset + length
+  while offset < end or len(carry) > 0:
+    slab = b""
+    if offset < end:
+      slab = os.pread(fd, min(READ_SIZE, end - offset), offset)
+      if len(slab) == 0:
+        raise IOError("the image ends at %d" % offset)
+      offset += len(slab)
+    data = memoryview(carry + slab)
+    last = offset >= end
+    start = 0
+    while len(data) - start >= MAX_CHUNK or (last and start < len(data)):
+      n = cut(data, start, min(start + MAX_CHUNK, len(data)))
+      yield data[start:start + n]
+      start += n
+    carry = bytes(data[start:])
+
+def store_chunk(store, digest, data):
+  """Store data as the chunk digest, unless it already is. Returns the
+  bytes stored."""
+  path = chunk_path(store, digest)
+  if os.path.exists(path):
+    return 0
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError:
+      # Made by another process meanwhile
+      pass
+  tmp = "%s.%d.tmp" % (path, os.getpid())
+  with open(tmp, "wb") as f:
+    f.write(data)
+  os.rename(tmp, path)
+  return len(data)
+
+def chunk_segment(args):
+  """Chunk, hash and store a segment of an image, in a worker process.
+  Returns (index, chunk list, bytes stored): chunks are [digest, length],
+  digest None for zeros."""
+  import bmap
+
+  index, store, image, offset, length = args
+  entries = []
+  stored = 0
+
+  fd = os.open(image, os.O_RDONLY)
+  try:
+    position = offset
+    for data_offset, data_length in bmap.data_extents(fd, offset + length,
+                                                      [(offset, length)]):
+      if data_offset > position:
+        entries.append([None, data_offset - position])
+      for data in chunks(fd, data_offset, data_length):
+        if data == ZEROS[:len(data)]:
+          entries.append([None, len(data)])
+          continue
+        digest = hashlib.new(CHECKSUM, data).hexdigest()
+        stored += store_chunk(store, digest, data)
+        entries.append([digest, len(data)])
+      position = data_offset + data_length
+    if position < offset + length:
+      entries.append([None, offset + length - position])
+  finally:
+    os.close(fd)
+
+  # Merge runs of zeros
+  merged = []
+  for entry in entries:
+    if entry[0] is None and len(merged) > 0 and merged[-1][0] is None:
+      merged[-1][1] += entry[1]
+    else:
+      merged.append(entry)
+  return (index, merged, stored)
+
+def image_regions(size, spans):
+  """Return the (label, offset, length) regions of an image of size bytes:
+  the partitions of spans, (first_lba, last_lba, part) within it, and the
+  space around them."""
+  regions = []
+  position = 0
+  for first, last, part in sorted(spans, key=lambda s: s[0]):
+    offset = first * SECTOR_SIZE
+    end = min((last + 1) * SECTOR_SIZE, size)
+    if offset >= size or end <= position:
+      continue
+    if offset > position:
+      regions.append(("", position, offset - position))
+    regions.append((part.label, max(offset, position),
+                    end - max(offset, position)))
+    position = end
+  if position < size:
+    regions.append(("", position, size - position))
+  return regions
+
+class Lock(object):
+  """A lock on the store: shared by "put" and "get", exclusive for "gc"."""
+
+  def __init__(self, store, exclusive):
+    import fcntl
+
+    if not os.path.isdir(store):
+      os.makedirs(store)
+    self.f = open(os.path.join(store, "lock"), "a")
+    fcntl.flock(self.f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.f.close()
+
+def put(store, image, name, partitions=None, jobs=None):
+  """Put image into store as the manifest name, chunked apart by the
+  partitions of partitions (a pt.Partitions, placed on a disk of the
+  size of image) if given. Returns (manifest, bytes stored)."""
+  import multiprocessing
+
+  fd = os.open(image, os.O_RDONLY)
+  try:
+    size = os.lseek(fd, 0, os.SEEK_END)
+  finally:
+    os.close(fd)
+
+  spans = []
+  if partitions is not None:
+    import validate
+    spans = validate.place_partitions(partitions, partitions.instructions,
+                                      size // SECTOR_SIZE)
+  regions = image_regions(size, spans)
+  segments = []
+  for i, (label, offset, length) in enumerate(regions):
+    for start in range(offset, offset + length, SEGMENT_SIZE):
+      segments.append((i, store, image,
+                       start, min(SEGMENT_SIZE, offset + length - start)))
+
+  if jobs is None:
+    jobs = multiprocessing.cpu_count()
+  jobs = max(1, min(jobs, len(segments)))
+  if jobs == 1:
+    results = [chunk_segment(segment) for segment in segments]
+  else:
+    pool = multiprocessing.Pool(jobs)
+    try:
+      results = pool.map(chunk_segment, segments, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+
+  manifest = {
+    "version":  MANIFEST_VERSION,
+    "name":     name,
+    "image":    os.path.basename(image),
+    "size":     size,
+    "checksum": CHECKSUM,
+    "regions":  [{"label": label, "offset": offset, "length": length,
+                  "chunks": []} for label, offset, length in regions],
+  }
+  stored = 0
+  for index, entries, segment_stored in results:
+    manifest["regions"][index]["chunks"].extend(entries)
+    stored += segment_stored
+
+  path = manifest_path(store, name)
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path + ".tmp", "w") as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.write("\n")
+  os.rename(path + ".tmp", path)
+  return (manifest, stored)
+
+def read_manifest(store, name):
+  path = manifest_path(store, name)
+  if not os.path.isfile(path):
+    raise RuntimeError("no image %s in %s" % (name, store))
+  with open(path) as f:
+    manifest = json.load(f)
+  if manifest.get("version") != MANIFEST_VERSION:
+    raise RuntimeError("%s: unknown manifest version" % path)
+  return manifest
+
+def get(store, name, output):
+  """Rebuild the image name of store into output, checking the chunks.
+  Zeros are left as holes. Returns the manifest."""
+  manifest = read_manifest(store, name)
+  with open(output, "wb") as f:
+    f.truncate(manifest["size"])
+    for region in manifest["regions"]:
+      offset = region["offset"]
+      for digest, length in region["chunks"]:
+        if digest is not None:
+          with open(chunk_path(store, digest), "rb") as c:
+            data = c.read()
+          if len(data) != length or \
+             hashlib.new(manifest["checksum"], data).hexdigest() != digest:
+            raise RuntimeError("chunk %s of %s is corrupted" % (digest, name))
+          f.seek(offset)
+          f.write(data)
+        offset += length
+  return manifest
+
+def manifests(store):
+  """Return the names of the manifests of store."""
+  root = os.path.join(store, "manifests")
+  names = []
+  for dpath, dnames, fnames in os.walk(root):
+    for fname in fnames:
+      if fname.endswith(".json"):
+        path = os.path.relpath(os.path.join(dpath, fname), root)
+        names.append(path[:-len(".json")])
+  return sorted(names)
+
+def gc(store):
+  """Remove the chunks no manifest refers to. Returns (chunks, bytes)
+  removed."""
+  referenced = set()
+  for name in manifests(store):
+    for region in read_manifest(store, name)["regions"]:
+      for digest, length in region["chunks"]:
+        if digest is not None:
+          referenced.add(digest)
+
+  removed = 0
+  removed_bytes = 0
+  root = os.path.join(store, "chunks")
+  for dpath, dnames, fnames in os.walk(root):
+    for fname in fnames:
+      if fname in referenced:
+        continue
+      path = os.path.join(dpath, fname)
+      removed_bytes += os.path.getsize(path)
+      os.unlink(path)
+      removed += 1
+  return (removed, removed_bytes)
+
+def layout(xml, lun):
+  """Return the partitions of physical partition lun of xml."""
+  import parser
+  import pt
+
+  parser.PARSER.xml2object(xml)
+  if lun < 0 or lun >= len(pt.PHYSICAL_PARTITIONS):
+    pt.BUG.error("No physical partition %d in %s." % (lun, xml))
+  return pt.PHYSICAL_PARTITIONS[lun]
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-s", "--store"):
+      OPTIONS.store = arg
+    elif opt in ("-t", "--tag"):
+      OPTIONS.tag = arg
+    elif opt in ("-x", "--xml"):
+      OPTIONS.xml = arg
+    elif opt in ("-l", "--lun"):
+      OPTIONS.lun = int(arg)
+    elif opt in ("-j", "--jobs"):
+      OPTIONS.jobs = int(arg)
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="s:t:x:l:j:",
+                             extra_long_opts=[
+                               "store=",
+                               "tag=",
+                               "xml=",
+                               "lun=",
+                               "jobs=",
+                             ],
+                             extra_option_handler=option_handler)
+
+  if len(args) == 0 or \
+     (args[0] == "put" and len(args) < 2) or \
+     (args[0] == "get" and len(args) != 3) or \
+     (args[0] in ("list", "gc") and len(args) != 1) or \
+     args[0] not in ("put", "get", "list", "gc"):
+    common.usage(__doc__)
+    sys.exit(1)
+
+  store = OPTIONS.store
+  if args[0] == "put":
+    partitions = None
+    if OPTIONS.xml is not None:
+      partitions = layout(OPTIONS.xml, OPTIONS.lun)
+    with Lock(store, False):
+      for image in args[1:]:
+        name = os.path.basename(image)
+        if OPTIONS.tag is not None:
+          name = "%s/%s" % (OPTIONS.tag, name)
+        manifest, stored = put(store, image, name, partitions, OPTIONS.jobs)
+        data = sum([length for region in manifest["regions"]
+                    for digest, length in region["chunks"]
+                    if digest is not None])
+        print("Put %s as %s: %d bytes, %d of data, %d stored"
+          % (image, name, manifest["size"], data, stored))
+  elif args[0] == "get":
+    with Lock(store, False):
+      get(store, args[1], args[2])
+    print("Create %s <-- %s" % (args[2], args[1]))
+  elif args[0] == "list":
+    for name in manifests(store):
+      print(name)
+  else:
+    with Lock(store, True):
+      removed, removed_bytes = gc(store)
+    print("Removed %d chunks, %d bytes" % (removed, removed_bytes))
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (C) 2015 The Yudatun Open Source Project
 #
@@ -9,7 +9,6 @@
 
 import os
 import getopt
-import subprocess
 import sys
 
 class Options(object): pass
@@ -18,6 +17,10 @@ OPTIONS = Options()
 
 OPTIONS.verbose = False
 
+# Namespace of every name based GUID/UUID derived by these tools,
+# uuid5(NAMESPACE_URL, "https://github.com/yudatun/pt-box").
+GUID_NAMESPACE = "4972cf73-b808-5126-a2f4-cb7de24519d3"
+
 COMMON_DOCSTRING = """
   -v  (--verbose)
       Show command lines beging executed.
@@ -27,8 +30,8 @@ COMMON_DOCSTRING = """
 """
 
 def usage(docstring):
-  print docstring.rstrip("\n")
-  print COMMON_DOCSTRING
+  print(docstring.rstrip("\n"))
+  print(COMMON_DOCSTRING)
 
 def parseOptions(argv, docstring,
                  extra_opts="", extra_long_opts=(),
@@ -43,9 +46,9 @@ def parseOptions(argv, docstring,
     opts, args = getopt.getopt(argv, "hv" + extra_opts,
                                ["help", "verbose",] +
                                list(extra_long_opts))
-  except getopt.GetoptError, err:
+  except getopt.GetoptError as err:
     usage(docstring)
-    print "**", str(err), "**"
+    print("** %s **" % (err,))
     sys.exit(2)
 
   for opt, arg in opts:
@@ -60,11 +63,80 @@ def parseOptions(argv, docstring,
 
   return args
 
+def parseSize(text):
+  """Return the byte count of a size like 1048576, 512K, 100M or 2G."""
+  text = str(text).strip()
+  units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+  if text[-1:].upper() in units:
+    return int(text[:-1]) * units[text[-1:].upper()]
+  return int(text)
+
+def parseHeadroom(text, size):
+  """Return the bytes of headroom text for size bytes of content: a size
+  like 16M, or a percentage of size like 10%. None or "" is no headroom."""
+  if text is None or str(text).strip() == "":
+    return 0
+  text = str(text).strip()
+  if text.endswith("%"):
+    return -(-size * int(text[:-1]) // 100)
+  return parseSize(text)
+
+def readSizes(filename):
+  """Return the image sizes (name -> bytes) recorded in filename, one
+  name=bytes per line, as written by recordSize()."""
+  sizes = {}
+  if not os.path.exists(filename):
+    return sizes
+  with open(filename) as f:
+    for line in f:
+      line = line.strip()
+      if line == "" or line.startswith("#") or "=" not in line:
+        continue
+      name, value = line.rsplit("=", 1)
+      sizes[name.strip()] = int(value)
+  return sizes
+
+def recordSize(filename, name, size):
+  """Record that the image name is size bytes in the sizes file filename,
+  which builders of several images may update at the same time."""
+  import fcntl
+
+  with open(filename, "a+") as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.seek(0)
+    lines = [l for l in f.read().splitlines()
+             if l.split("=", 1)[0].strip() != name]
+    lines.append("%s=%d" % (name, size))
+    f.seek(0)
+    f.truncate()
+    f.write("\n".join(lines) + "\n")
+
+def isTar(path):
+  """Return whether path is a tar file, compressed or not."""
+  if not os.path.isfile(path):
+    return False
+  import tarfile
+  return tarfile.is_tarfile(path)
+
+def extractTar(path, directory):
+  """Extract the tar at path into directory for the tools which read
+  trees from disk, its hard links as hard links."""
+  import tarfile
+
+  with tarfile.open(path, "r:*") as tar:
+    if hasattr(tarfile, "tar_filter"):
+      # No absolute names or names outside of directory.
+      tar.extractall(directory, filter="tar")
+    else:
+      tar.extractall(directory)
+
 def run(args, **kwargs):
   """Create and return a subprocess.Popen object, printing the command
   line on the terminal if -v was specified."""
   if OPTIONS.verbose:
-    print "  running: ", " ".join(args)
+    print("  running: %s" % " ".join(args))
+  # Imported on demand, most invocations never spawn a process.
+  import subprocess
   return subprocess.Popen(args, **kwargs)
 
 def runCommand(cmd):
@@ -73,10 +145,41 @@ def runCommand(cmd):
   Args:
     cmd: the command represented as a list of strings.
   Returns:
-    A tuple of the output and the exit code.
+    A tuple of the output (text, printed as it comes) and the exit code.
   """
-  print "Running: ", " ".join(cmd)
+  print("Running: %s" % " ".join(cmd))
+  import subprocess
   p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-  output, _ = p.communicate()
-  print "%s" % (output.tstrip(),)
-  return (output, p.returncode)
+  lines = []
+  for line in p.stdout:
+    line = line.decode("utf-8", "replace")
+    print(line.rstrip("\n"))
+    lines.append(line)
+  p.stdout.close()
+  p.wait()
+  return ("".join(lines), p.returncode)
+
+def runJobs(cmds, limit=None, timeout=None, log_dir=None, fail_fast=False):
+  """Run the given commands concurrently, at most limit (default: the
+  number of CPUs) at a time, and wait for all of them.
+
+  Args:
+    cmds: list of commands, each represented as a list of strings.
+    limit: the number of commands running at once.
+    timeout: seconds after which a command is killed, or None.
+    log_dir: directory receiving the output of each command as
+      <index>-<command>.log, or None.
+    fail_fast: cancel the remaining commands after the first failure.
+  Returns:
+    A list of asyncrun.JobResult (returncode, duration, peak_rss and
+    whether it's only an upper bound, ...) in the order of cmds.
+  """
+  import asyncrun
+
+  jobs = []
+  for i, cmd in enumerate(cmds):
+    log = None
+    if log_dir is not None:
+      log = os.path.join(log_dir, "%d-%s.log" % (i, os.path.basename(cmd[0])))
+    jobs.append(asyncrun.Job(cmd, log=log, timeout=timeout))
+  return asyncrun.run(jobs, limit, fail_fast)
@@ -0,0 +1,980 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Builds ext4 filesystem images without external tools.
+
+The source tree is scanned once, then the block groups, the inode tables
+and the extent trees are all laid out before anything is written. The
+image is written in one sequential pass, the data of each file contiguous
+and in scan order, to a raw (holes kept) or an Android sparse image.
+
+The source may be a tar (compressed or not) instead of a directory: its
+headers are scanned, then its members are read once more in order, their
+data laid out in that order and written straight into the image. Nothing
+is extracted, only the headers are kept in memory.
+
+Only what a freshly built image needs is supported: 4K blocks, no flex_bg,
+linear directories, extents and an optional (empty) journal.
+"""
+
+import os
+import stat
+import struct
+
+import common
+import sparse
+import hashio
+
+BLOCK_SIZE        = 4096
+INODE_SIZE        = 256
+INODE_EXTRA_ISIZE = 32
+INODE_RATIO       = 16384  # bytes per inode when the image size is given
+BLOCKS_PER_GROUP  = 8 * BLOCK_SIZE
+INODES_PER_BLOCK  = BLOCK_SIZE // INODE_SIZE
+DESC_SIZE         = 32
+LOST_FOUND_BLOCKS = 4
+
+ROOT_INO       = 2
+JOURNAL_INO    = 8
+LOST_FOUND_INO = 11  # also the first non-reserved inode
+
+SUPER_MAGIC   = 0xEF53
+EXTENT_MAGIC  = 0xF30A
+JOURNAL_MAGIC = 0xC03B3998
+
+COMPAT_HAS_JOURNAL     = 0x0004
+INCOMPAT_FILETYPE      = 0x0002
+INCOMPAT_EXTENTS       = 0x0040
+RO_COMPAT_SPARSE_SUPER = 0x0001
+RO_COMPAT_LARGE_FILE   = 0x0002
+RO_COMPAT_DIR_NLINK    = 0x0020
+RO_COMPAT_EXTRA_ISIZE  = 0x0040
+
+EXTENTS_FL       = 0x80000
+EXTENTS_IN_INODE = 4
+EXTENTS_PER_LEAF = (BLOCK_SIZE - 12) // 12
+
+# Bytes of file data read and checked for zeros at a time.
+CHUNK_SIZE = 256 * 1024
+
+FILE_TYPES = {
+  stat.S_IFREG:  1,
+  stat.S_IFDIR:  2,
+  stat.S_IFCHR:  3,
+  stat.S_IFBLK:  4,
+  stat.S_IFIFO:  5,
+  stat.S_IFSOCK: 6,
+  stat.S_IFLNK:  7,
+}
+
+INODE = struct.Struct("<2H5I2H3I60s4I6H2H7I")
+GROUP_DESC = struct.Struct("<3I4HI4H")
+EXTENT_HEADER = struct.Struct("<4HI")
+EXTENT = struct.Struct("<I2HI")
+EXTENT_INDEX = struct.Struct("<2I2H")
+DIR_ENTRY = struct.Struct("<IH2B")
+JOURNAL_SUPER = struct.Struct(">8Ii3I16s2I")
+
+class Ext4Error(RuntimeError): pass
+
+def fsencode(name):
+  if isinstance(name, bytes):
+    return name
+  return os.fsencode(name)
+
+def div_round_up(a, b):
+  return (a + b - 1) // b
+
+def has_super(group):
+  """sparse_super: backups only in groups 0, 1 and powers of 3, 5 and 7."""
+  if group <= 1:
+    return True
+  for base in (3, 5, 7):
+    n = base
+    while n < group:
+      n *= base
+    if n == group:
+      return True
+  return False
+
+def journal_blocks(blocks):
+  """The journal size mke2fs picks for an image of blocks blocks, 0 when
+  the image is too small to have one."""
+  if blocks < 2048:
+    return 0
+  if blocks < 32768:
+    return 1024
+  if blocks < 256 * 1024:
+    return 4096
+  if blocks < 512 * 1024:
+    return 8192
+  if blocks < 4096 * 1024:
+    return 16384
+  return 32768
+
+def estimate_leaves(blocks):
+  """Return at least the number of extent tree leaves of blocks data
+  blocks. A run of blocks ends at most at every group boundary, and the
+  data area of a group is always more than half of it."""
+  extents = blocks // (BLOCKS_PER_GROUP // 2) + 2
+  if extents <= EXTENTS_IN_INODE:
+    return 0
+  return div_round_up(extents, EXTENTS_PER_LEAF)
+
+########################################
+
+class Node(object):
+  """A file, directory, symlink or special file of the source tree. Hard
+  links are one Node in several directories."""
+
+  def __init__(self, st=None, source=None):
+    self.mode    = 0
+    self.uid     = 0
+    self.gid     = 0
+    self.size    = 0
+    self.mtime   = 0
+    self.rdev    = 0
+    self.source  = source  # where the data of a regular file is read from
+    self.target  = None    # symlink target
+    self.entries = []      # (name, Node) of a directory, in order
+    self.parent  = None
+    self.member  = None    # index of the tar member holding the data
+
+    if st is not None:
+      self.mode  = st.st_mode
+      self.uid   = st.st_uid
+      self.gid   = st.st_gid
+      self.mtime = int(st.st_mtime)
+      if stat.S_ISREG(st.st_mode):
+        self.size = st.st_size
+      elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        self.rdev = st.st_rdev
+
+    # Filled in by Ext4Image
+    self.ino    = 0
+    self.links  = 0
+    self.data   = None  # directory blocks
+    self.runs   = []    # (first block, count) of the data, in order
+    self.leaves = []    # extent tree leaf blocks
+
+  def is_dir(self):
+    return stat.S_ISDIR(self.mode)
+
+  def is_reg(self):
+    return stat.S_ISREG(self.mode)
+
+  def is_symlink(self):
+    return stat.S_ISLNK(self.mode)
+
+  def open(self):
+    if self.member is not None:
+      return self.source.open(self.member)
+    return open(self.source, "rb")
+
+def scan_directory(root):
+  """Return the Node tree of directory root, scanned in sorted order."""
+  top = Node(os.stat(root), root)
+  hard_links = {}
+  stack = [top]
+  while stack:
+    d = stack.pop()
+    subdirs = []
+    for name in sorted(os.listdir(d.source)):
+      path = os.path.join(d.source, name)
+      st = os.lstat(path)
+      key = (st.st_dev, st.st_ino)
+      if stat.S_ISDIR(st.st_mode):
+        node = Node(st, path)
+        node.parent = d
+        subdirs.append(node)
+      elif st.st_nlink > 1 and key in hard_links:
+        node = hard_links[key]
+      else:
+        node = Node(st, path)
+        if stat.S_ISLNK(st.st_mode):
+          node.target = fsencode(os.readlink(path))
+        if st.st_nlink > 1:
+          hard_links[key] = node
+      d.entries.append((fsencode(name), node))
+    stack.extend(reversed(subdirs))
+  return top
+
+class TarStream(object):
+  """The data of the members of the tar at path, read in member order
+  without seeking, by the Nodes of scan_tar()."""
+
+  def __init__(self, path):
+    self.path  = path
+    self.tar   = None
+    self.index = 0  # of the next member
+
+  def open(self, member):
+    """Return a file object of the data of member, the members before it
+    having been skipped."""
+    import tarfile
+
+    if self.tar is None:
+      self.tar = tarfile.open(self.path, "r|*")
+    if member < self.index:
+      raise Ext4Error("%s: member %d read out of order" % (self.path, member))
+    while self.index <= member:
+      info = self.tar.next()
+      if info is None:
+        raise Ext4Error("%s: member %d missing, the tar changed"
+                        % (self.path, member))
+      self.index += 1
+    return self.tar.extractfile(info)
+
+  def close(self):
+    if self.tar is not None:
+      self.tar.close()
+      self.tar = None
+
+def tar_node(info, stream, index):
+  """Return the Node of the tar member info, the index-th of stream."""
+  node = Node()
+  node.uid   = info.uid
+  node.gid   = info.gid
+  node.mtime = int(info.mtime)
+  permissions = info.mode & 0o7777
+  if info.isreg():
+    node.mode   = stat.S_IFREG | permissions
+    node.size   = info.size
+    node.source = stream
+    node.member = index
+  elif info.isdir():
+    node.mode = stat.S_IFDIR | permissions
+  elif info.issym():
+    node.mode   = stat.S_IFLNK | 0o777
+    node.target = fsencode(info.linkname)
+  elif info.ischr() or info.isblk():
+    kind = stat.S_IFCHR if info.ischr() else stat.S_IFBLK
+    node.mode = kind | permissions
+    node.rdev = os.makedev(info.devmajor, info.devminor)
+  elif info.isfifo():
+    node.mode = stat.S_IFIFO | permissions
+  else:
+    raise Ext4Error("%s: unsupported member type %r" % (info.name, info.type))
+  return node
+
+def tar_name(name):
+  """The path of a member name within the tree, "" for its root."""
+  import posixpath
+  name = posixpath.normpath("/" + name).lstrip("/")
+  return "" if name == "." else name
+
+def scan_tar(path):
+  """Return the Node tree of the tar at path from its headers, entries in
+  sorted order. Directories missing from the tar are made, a later member
+  replaces an earlier one of the same name."""
+  import posixpath
+  import tarfile
+
+  stream = TarStream(path)
+  top = Node()
+  top.mode   = stat.S_IFDIR | 0o755
+  top.source = stream
+  dirs = {"": top}
+  children = {id(top): {}}
+  files = {}  # name -> Node, for hard links
+
+  def directory(name):
+    d = dirs.get(name)
+    if d is None:
+      parent = directory(posixpath.dirname(name))
+      d = dirs[name] = Node()
+      d.mode   = stat.S_IFDIR | 0o755
+      d.mtime  = parent.mtime
+      d.parent = parent
+      children[id(d)] = {}
+      children[id(parent)][posixpath.basename(name)] = d
+    return d
+
+  with tarfile.open(path, "r:*") as tar:
+    for index, info in enumerate(tar):
+      name = tar_name(info.name)
+      if name == "":
+        if info.isdir():
+          top.mode  = stat.S_IFDIR | (info.mode & 0o7777)
+          top.uid   = info.uid
+          top.gid   = info.gid
+          top.mtime = int(info.mtime)
+        continue
+      parent = directory(posixpath.dirname(name))
+      if info.isdir():
+        node = directory(name)
+        node.mode  = stat.S_IFDIR | (info.mode & 0o7777)
+        node.uid   = info.uid
+        node.gid   = info.gid
+        node.mtime = int(info.mtime)
+        continue
+      if info.islnk():
+        node = files.get(tar_name(info.linkname))
+        if node is None:
+          raise Ext4Error("%s: hard link to %s, not in the tar"
+                          % (info.name, info.linkname))
+      else:
+        node = files[name] = tar_node(info, stream, index)
+      node.parent = parent
+      children[id(parent)][posixpath.basename(name)] = node
+
+  for d in dirs.values():
+    d.entries = sorted([(fsencode(name), node)
+                        for name, node in children[id(d)].items()],
+                       key=lambda entry: entry[0])
+  return top
+
+def scan(source):
+  """Return the Node tree of source, a directory or a tar."""
+  if common.isTar(source):
+    return scan_tar(source)
+  return scan_directory(source)
+
+def walk(top):
+  """Yield the distinct nodes under (and with) top, each directory before
+  its entries, in the order they are laid out."""
+  seen = set()
+  stack = [top]
+  while stack:
+    d = stack.pop()
+    yield d
+    subdirs = []
+    for name, node in d.entries:
+      if node.is_dir():
+        subdirs.append(node)
+      elif id(node) not in seen:
+        seen.add(id(node))
+        yield node
+    stack.extend(reversed(subdirs))
+
+def dir_blocks(entries):
+  """Return the linear directory blocks holding entries, a list of
+  (inode, name, file type)."""
+  blocks = []
+  block = []
+  used = 0
+  for ino, name, ftype in entries:
+    if len(name) > 255:
+      raise Ext4Error("file name too long: %r" % (name,))
+    size = (DIR_ENTRY.size + len(name) + 3) & ~3
+    if used + size > BLOCK_SIZE:
+      blocks.append(block)
+      block = []
+      used = 0
+    block.append((ino, name, ftype, size))
+    used += size
+  blocks.append(block)
+
+  data = bytearray(len(blocks) * BLOCK_SIZE)
+  for i, block in enumerate(blocks):
+    offset = i * BLOCK_SIZE
+    for j, (ino, name, ftype, size) in enumerate(block):
+      if j == len(block) - 1:
+        # The last entry covers the rest of the block.
+        size = (i + 1) * BLOCK_SIZE - offset
+      DIR_ENTRY.pack_into(data, offset, ino, size, len(name), ftype)
+      data[offset + DIR_ENTRY.size:offset + DIR_ENTRY.size + len(name)] = name
+      offset += size
+  return bytes(data)
+
+def bitmap(used, valid):
+  """Return a block sized bitmap with the first used bits set and the
+  padding bits from valid on set as well."""
+  data = bytearray(BLOCK_SIZE)
+  nbits = BLOCK_SIZE * 8
+  for start, end in ((0, used), (valid, nbits)):
+    if start >= end:
+      continue
+    first = (start + 7) // 8
+    last  = end // 8
+    if first <= last:
+      data[first:last] = b"\xff" * (last - first)
+      for bit in range(start, min(first * 8, end)):
+        data[bit // 8] |= 1 << (bit % 8)
+      for bit in range(max(last * 8, start), end):
+        data[bit // 8] |= 1 << (bit % 8)
+    else:
+      for bit in range(start, end):
+        data[bit // 8] |= 1 << (bit % 8)
+  return bytes(data)
+
+########################################
+
+class Group(object):
+
+  def __init__(self, index, start, end, gdt_blocks, itable_blocks):
+    self.index        = index
+    self.start        = start
+    self.end          = end
+    self.has_super    = has_super(index)
+    meta = self.start
+    if self.has_super:
+      meta += 1 + gdt_blocks
+    self.block_bitmap = meta
+    self.inode_bitmap = meta + 1
+    self.inode_table  = meta + 2
+    self.data_start   = meta + 2 + itable_blocks
+
+    # Filled in by the allocation
+    self.used_blocks  = 0  # data blocks, allocated from data_start on
+    self.used_inodes  = 0
+    self.used_dirs    = 0
+
+  def free_blocks(self):
+    return self.end - self.data_start - self.used_blocks
+
+class Allocator(object):
+  """Hands out data blocks in increasing order, group after group."""
+
+  def __init__(self, groups):
+    self.groups = groups
+    self.index  = 0
+
+  def alloc(self, count):
+    runs = []
+    while count > 0:
+      if self.index >= len(self.groups):
+        raise Ext4Error("image too small for its content")
+      g = self.groups[self.index]
+      n = min(count, g.free_blocks())
+      if n == 0:
+        self.index += 1
+        continue
+      runs.append((g.data_start + g.used_blocks, n))
+      g.used_blocks += n
+      count -= n
+    return runs
+
+class Ext4Image(object):
+  """An ext4 image of a Node tree.
+
+  Args:
+    top: the root Node, see scan_directory().
+    size: image size in bytes, or None for the smallest image that fits.
+    label: volume label.
+    mount_point: recorded as the last mount point.
+    timestamp: time of every inode and of the image, None for the files'
+      own times (and the newest of them for the image).
+    journal: whether the image has a journal.
+    uuid: filesystem UUID (uuid.UUID), None for one derived from the
+      label and the geometry, so that the same input gives the same image.
+    headroom: free space left in the smallest image, a size like 16M or a
+      percentage of the used blocks like 10% (see common.parseHeadroom).
+  """
+
+  def __init__(self, top, size=None, label="", mount_point="",
+               timestamp=None, journal=True, uuid=None, headroom=None):
+    self.top         = top
+    self.size        = size
+    self.label       = label or ""
+    self.mount_point = mount_point or ""
+    self.timestamp   = timestamp
+    self.journal     = journal
+    self.uuid        = uuid
+    self.headroom    = headroom
+
+    self.nodes       = list(walk(top))
+    self.lost_found  = None
+    self.items       = []  # (first block, count, data) in block order
+
+    self.layout()
+
+  ########################################
+  # Layout
+
+  def layout(self):
+    self.init_inodes()
+    self.init_directories()
+
+    data_blocks = 0 if self.lost_found in self.nodes else LOST_FOUND_BLOCKS
+    for node in self.nodes:
+      data_blocks += self.data_blocks(node)
+      data_blocks += estimate_leaves(self.data_blocks(node))
+
+    if self.size is not None:
+      self.init_geometry(self.size // BLOCK_SIZE)
+    else:
+      free_blocks = div_round_up(
+        common.parseHeadroom(self.headroom, data_blocks * BLOCK_SIZE),
+        BLOCK_SIZE)
+      # Grow the image until the data, the journal and the metadata fit,
+      # from a group of the data and its own metadata: superblock, group
+      # descriptors, bitmaps and inode table.
+      blocks = data_blocks + 1 + div_round_up(DESC_SIZE, BLOCK_SIZE) + 2 + \
+               div_round_up(self.last_ino, INODES_PER_BLOCK)
+      while True:
+        self.init_geometry(blocks)
+        capacity = 0
+        for g in self.groups:
+          capacity += g.end - g.data_start
+        needed = data_blocks + free_blocks + self.journal_blocks
+        needed += estimate_leaves(self.journal_blocks)
+        if capacity >= needed:
+          break
+        blocks += needed - capacity
+
+    self.allocate()
+
+  def init_inodes(self):
+    # A lost+found of the source is the image's, else one is added.
+    self.lost_found = None
+    for name, node in self.top.entries:
+      if name == b"lost+found" and node.is_dir():
+        self.lost_found = node
+
+    ino = LOST_FOUND_INO
+    for node in self.nodes:
+      if node is self.top:
+        node.ino = ROOT_INO
+      elif node is self.lost_found:
+        node.ino = LOST_FOUND_INO
+      else:
+        ino += 1
+        node.ino = ino
+      if node.is_dir():
+        node.links = 2
+        for name, child in node.entries:
+          if child.is_dir():
+            node.links += 1
+      else:
+        node.links = 0
+    for node in self.nodes:
+      for name, child in node.entries:
+        if not child.is_dir():
+          child.links += 1
+    self.last_ino = ino
+
+    if self.lost_found is not None:
+      return
+    self.lost_found = Node()
+    self.lost_found.mode   = stat.S_IFDIR | 0o700
+    self.lost_found.mtime  = self.image_time()
+    self.lost_found.ino    = LOST_FOUND_INO
+    self.lost_found.links  = 2
+    self.lost_found.parent = self.top
+    self.top.links += 1
+
+  def image_time(self):
+    if self.timestamp is not None:
+      return self.timestamp
+    return max([node.mtime for node in self.nodes])
+
+  def init_directories(self):
+    for node in self.nodes:
+      if not node.is_dir():
+        continue
+      parent = node.parent or node
+      entries = [(node.ino, b".", 2), (parent.ino, b"..", 2)]
+      if node is self.top and self.lost_found not in self.nodes:
+        entries.append((LOST_FOUND_INO, b"lost+found", 2))
+      for name, child in node.entries:
+        entries.append((child.ino, name, FILE_TYPES[stat.S_IFMT(child.mode)]))
+      node.data = dir_blocks(entries)
+      node.size = len(node.data)
+
+    if self.lost_found not in self.nodes:
+      entries = [(LOST_FOUND_INO, b".", 2), (ROOT_INO, b"..", 2)]
+      self.lost_found.data = dir_blocks(entries)
+    # Blocks kept free for e2fsck to link files into.
+    empty = bytearray(BLOCK_SIZE)
+    DIR_ENTRY.pack_into(empty, 0, 0, BLOCK_SIZE, 0, 0)
+    blocks = len(self.lost_found.data) // BLOCK_SIZE
+    self.lost_found.data += bytes(empty) * max(0, LOST_FOUND_BLOCKS - blocks)
+    self.lost_found.size = len(self.lost_found.data)
+
+  def data_blocks(self, node):
+    if node.is_dir():
+      return len(node.data) // BLOCK_SIZE
+    if node.is_reg():
+      return div_round_up(node.size, BLOCK_SIZE)
+    if node.is_symlink() and len(node.target) >= 60:
+      return 1
+    return 0
+
+  def init_geometry(self, blocks):
+    inodes = self.last_ino
+    while True:
+      groups = div_round_up(blocks, BLOCKS_PER_GROUP)
+      if groups == 0:
+        raise Ext4Error("image too small")
+      wanted = inodes
+      if self.size is not None:
+        wanted = max(inodes, blocks * BLOCK_SIZE // INODE_RATIO)
+      ipg = div_round_up(div_round_up(wanted, groups), INODES_PER_BLOCK)
+      ipg *= INODES_PER_BLOCK
+      ipg = min(ipg, BLOCK_SIZE * 8)
+      if ipg * groups < inodes:
+        raise Ext4Error("image too small for %d inodes" % inodes)
+
+      gdt_blocks = div_round_up(groups * DESC_SIZE, BLOCK_SIZE)
+      itable_blocks = ipg // INODES_PER_BLOCK
+      self.groups = []
+      for i in range(groups):
+        start = i * BLOCKS_PER_GROUP
+        end = min(start + BLOCKS_PER_GROUP, blocks)
+        self.groups.append(Group(i, start, end, gdt_blocks, itable_blocks))
+
+      # Drop a last group too small for its own metadata.
+      last = self.groups[-1]
+      if last.data_start >= last.end and groups > 1:
+        blocks = last.start
+        continue
+      if last.data_start >= last.end:
+        raise Ext4Error("image too small")
+      break
+
+    self.blocks_count     = blocks
+    self.inodes_per_group = ipg
+    self.gdt_blocks       = gdt_blocks
+    self.journal_blocks   = 0
+    if self.journal:
+      self.journal_blocks = journal_blocks(blocks)
+
+  def allocate(self):
+    allocator = Allocator(self.groups)
+
+    def place(node, data):
+      node.runs = allocator.alloc(len(data) // BLOCK_SIZE)
+      offset = 0
+      for start, count in node.runs:
+        self.items.append((start, count,
+                           data[offset:offset + count * BLOCK_SIZE]))
+        offset += count * BLOCK_SIZE
+      self.alloc_leaves(allocator, node)
+
+    # Directories first, so that walking the tree reads one area.
+    for node in self.nodes:
+      if node.is_dir():
+        place(node, node.data)
+    if self.lost_found not in self.nodes:
+      place(self.lost_found, self.lost_found.data)
+
+    if self.journal_blocks > 0:
+      self.journal_node = Node()
+      self.journal_node.mode  = stat.S_IFREG | 0o600
+      self.journal_node.mtime = self.image_time()
+      self.journal_node.ino   = JOURNAL_INO
+      self.journal_node.links = 1
+      self.journal_node.size  = self.journal_blocks * BLOCK_SIZE
+      self.journal_node.runs  = allocator.alloc(self.journal_blocks)
+      first = True
+      for start, count in self.journal_node.runs:
+        if first:
+          self.items.append((start, 1, self.journal_superblock()))
+          start += 1
+          count -= 1
+          first = False
+        if count > 0:
+          self.items.append((start, count, None))
+      self.alloc_leaves(allocator, self.journal_node)
+
+    # Files in the order their data is read: that of the members of a tar.
+    for node in sorted(self.nodes, key=lambda n: n.member or 0):
+      if node.is_reg():
+        node.runs = allocator.alloc(self.data_blocks(node))
+        for start, count in node.runs:
+          self.items.append((start, count, node))
+        self.alloc_leaves(allocator, node)
+      elif node.is_symlink() and len(node.target) >= 60:
+        place(node, node.target + b"\0" * (BLOCK_SIZE - len(node.target)))
+
+    self.inode_map = {}
+    for node in set([self.lost_found] + self.nodes):
+      self.inode_map[node.ino] = node
+      g = self.groups[(node.ino - 1) // self.inodes_per_group]
+      if node.is_dir():
+        g.used_dirs += 1
+    if self.journal_blocks > 0:
+      self.inode_map[JOURNAL_INO] = self.journal_node
+    for g in self.groups:
+      first = g.index * self.inodes_per_group + 1
+      g.used_inodes = max(0, min(self.inodes_per_group,
+                                 self.last_ino - first + 1))
+
+  def alloc_leaves(self, allocator, node):
+    if len(node.runs) <= EXTENTS_IN_INODE:
+      return
+    leaves = div_round_up(len(node.runs), EXTENTS_PER_LEAF)
+    if leaves > EXTENTS_IN_INODE:
+      raise Ext4Error("file too fragmented: %s" % (node.source,))
+    for i in range(leaves):
+      (start, count), = allocator.alloc(1)
+      node.leaves.append(start)
+      runs = node.runs[i * EXTENTS_PER_LEAF:(i + 1) * EXTENTS_PER_LEAF]
+      logical = 0
+      for _, c in node.runs[:i * EXTENTS_PER_LEAF]:
+        logical += c
+      self.items.append((start, 1, self.extent_block(runs, logical)))
+
+  ########################################
+  # Metadata
+
+  def fs_uuid(self):
+    if self.uuid is not None:
+      return self.uuid
+    import uuid
+    name = "ext4:%s:%s:%d:%d" % (self.label, self.mount_point,
+                                 self.blocks_count, self.inodes_per_group)
+    return uuid.uuid5(uuid.UUID(common.GUID_NAMESPACE), name)
+
+  def extent_block(self, runs, logical):
+    data = bytearray(BLOCK_SIZE)
+    EXTENT_HEADER.pack_into(data, 0, EXTENT_MAGIC, len(runs),
+                            EXTENTS_PER_LEAF, 0, 0)
+    offset = EXTENT_HEADER.size
+    for start, count in runs:
+      EXTENT.pack_into(data, offset, logical, count, start >> 32,
+                       start & 0xFFFFFFFF)
+      logical += count
+      offset += EXTENT.size
+    return bytes(data)
+
+  def extent_root(self, node):
+    data = bytearray(60)
+    if len(node.runs) <= EXTENTS_IN_INODE:
+      EXTENT_HEADER.pack_into(data, 0, EXTENT_MAGIC, len(node.runs),
+                              EXTENTS_IN_INODE, 0, 0)
+      offset = EXTENT_HEADER.size
+      logical = 0
+      for start, count in node.runs:
+        EXTENT.pack_into(data, offset, logical, count, start >> 32,
+                         start & 0xFFFFFFFF)
+        logical += count
+        offset += EXTENT.size
+    else:
+      EXTENT_HEADER.pack_into(data, 0, EXTENT_MAGIC, len(node.leaves),
+                              EXTENTS_IN_INODE, 1, 0)
+      offset = EXTENT_HEADER.size
+      for i, leaf in enumerate(node.leaves):
+        logical = 0
+        for _, c in node.runs[:i * EXTENTS_PER_LEAF]:
+          logical += c
+        EXTENT_INDEX.pack_into(data, offset, logical, leaf & 0xFFFFFFFF,
+                               leaf >> 32, 0)
+        offset += EXTENT_INDEX.size
+    return bytes(data)
+
+  def inode(self, node):
+    flags = 0
+    blocks = 0
+    if node.is_symlink() and len(node.target) < 60:
+      # Fast symlink, the target is kept in the inode.
+      i_block = node.target
+    elif stat.S_ISCHR(node.mode) or stat.S_ISBLK(node.mode):
+      major = os.major(node.rdev)
+      minor = os.minor(node.rdev)
+      if major < 256 and minor < 256:
+        i_block = struct.pack("<I", (major << 8) | minor)
+      else:
+        i_block = struct.pack("<2I", 0, (minor & 0xFF) | (major << 8) |
+                              ((minor & ~0xFF) << 12))
+    elif node.is_reg() or node.is_dir() or node.is_symlink():
+      flags |= EXTENTS_FL
+      i_block = self.extent_root(node)
+      for start, count in node.runs:
+        blocks += count
+      blocks += len(node.leaves)
+    else:
+      i_block = b""
+
+    size = node.size
+    if node.is_symlink():
+      size = len(node.target)
+    t = node.mtime
+    if self.timestamp is not None:
+      t = self.timestamp
+    return INODE.pack(node.mode, node.uid & 0xFFFF, size & 0xFFFFFFFF,
+                      t, t, t, 0, node.gid & 0xFFFF, node.links,
+                      blocks * (BLOCK_SIZE // 512), flags, 0, i_block,
+                      0, 0, size >> 32, 0,
+                      0, 0, node.uid >> 16, node.gid >> 16, 0, 0,
+                      INODE_EXTRA_ISIZE, 0, 0, 0, 0, t, 0, 0, 0)
+
+  def inode_table(self, group):
+    """Return the used part of the inode table of group."""
+    inodes = self.inode_map
+    first = group.index * self.inodes_per_group + 1
+    data = bytearray()
+    for ino in range(first, first + group.used_inodes):
+      record = bytearray(INODE_SIZE)
+      if ino in inodes:
+        packed = self.inode(inodes[ino])
+        record[:len(packed)] = packed
+      data += record
+    return bytes(data)
+
+  def superblock(self, group):
+    free_blocks = 0
+    free_inodes = 0
+    for g in self.groups:
+      free_blocks += g.free_blocks()
+      free_inodes += self.inodes_per_group - g.used_inodes
+    t = self.image_time()
+    fs_uuid = self.fs_uuid()
+
+    compat = 0
+    if self.journal_blocks > 0:
+      compat |= COMPAT_HAS_JOURNAL
+    incompat = INCOMPAT_FILETYPE | INCOMPAT_EXTENTS
+    ro_compat = (RO_COMPAT_SPARSE_SUPER | RO_COMPAT_LARGE_FILE |
+                 RO_COMPAT_DIR_NLINK | RO_COMPAT_EXTRA_ISIZE)
+
+    data = bytearray(1024)
+    struct.pack_into("<13IHh4H4I2HI2H3I16s16s64s", data, 0,
+                     self.inodes_per_group * len(self.groups),
+                     self.blocks_count, 0, free_blocks, free_inodes,
+                     0,                   # s_first_data_block
+                     2, 2,                # 4K blocks and clusters
+                     BLOCKS_PER_GROUP, BLOCKS_PER_GROUP,
+                     self.inodes_per_group,
+                     0, t,                # s_mtime, s_wtime
+                     0, -1,               # s_mnt_count, s_max_mnt_count
+                     SUPER_MAGIC, 1, 1, 0,
+                     t, 0, 0, 1,          # s_lastcheck ... s_rev_level
+                     0, 0,                # s_def_resuid, s_def_resgid
+                     LOST_FOUND_INO, INODE_SIZE, group.index,
+                     compat, incompat, ro_compat,
+                     fs_uuid.bytes, fsencode(self.label)[:16],
+                     fsencode(self.mount_point)[:63])
+    hash_seed = fs_uuid.bytes[::-1]
+    if self.journal_blocks > 0:
+      struct.pack_into("<I", data, 0xE0, JOURNAL_INO)
+    struct.pack_into("<16s2B", data, 0xEC, hash_seed, 1,
+                     self.journal_blocks > 0 and 1 or 0)
+    struct.pack_into("<I", data, 0x108, t)  # s_mkfs_time
+    if self.journal_blocks > 0:
+      i_block = self.extent_root(self.journal_node)
+      data[0x10C:0x10C + 60] = i_block
+      struct.pack_into("<2I", data, 0x10C + 60,
+                       self.journal_node.size >> 32,
+                       self.journal_node.size & 0xFFFFFFFF)
+    struct.pack_into("<2HI", data, 0x15C, INODE_EXTRA_ISIZE,
+                     INODE_EXTRA_ISIZE, 1)  # signed directory hash
+    return bytes(data)
+
+  def group_descriptors(self):
+    data = bytearray(self.gdt_blocks * BLOCK_SIZE)
+    for g in self.groups:
+      GROUP_DESC.pack_into(data, g.index * DESC_SIZE, g.block_bitmap,
+                           g.inode_bitmap, g.inode_table, g.free_blocks(),
+                           self.inodes_per_group - g.used_inodes,
+                           g.used_dirs, 0, 0, 0, 0, 0, 0)
+    return bytes(data)
+
+  def journal_superblock(self):
+    data = bytearray(BLOCK_SIZE)
+    JOURNAL_SUPER.pack_into(data, 0, JOURNAL_MAGIC,
+                            4,                 # superblock v2
+                            0, BLOCK_SIZE, self.journal_blocks,
+                            1, 1, 0,           # s_first, s_sequence, s_start
+                            0, 0, 0, 0,
+                            self.fs_uuid().bytes, 1, 0)
+    return bytes(data)
+
+  ########################################
+  # Output
+
+  def write(self, writer):
+    """Write the image to writer (see sparse), in one sequential pass."""
+    gdt = self.group_descriptors()
+    items = iter(self.items)
+    item = next(items, None)
+    opened = {}
+
+    for g in self.groups:
+      if g.has_super:
+        sb = self.superblock(g)
+        if g.index == 0:
+          block = b"\0" * 1024 + sb + b"\0" * (BLOCK_SIZE - 2048)
+        else:
+          block = sb + b"\0" * (BLOCK_SIZE - 1024)
+        writer.write(block)
+        writer.write(gdt)
+
+      used = g.data_start - g.start + g.used_blocks
+      writer.write(bitmap(used, g.end - g.start))
+      writer.write(bitmap(g.used_inodes, self.inodes_per_group))
+
+      table = self.inode_table(g)
+      table += b"\0" * ((-len(table)) % BLOCK_SIZE)
+      writer.write(table)
+      writer.zero(g.data_start - g.inode_table - len(table) // BLOCK_SIZE)
+
+      position = g.data_start
+      while item is not None and item[0] < g.end:
+        start, count, data = item
+        writer.skip(start - position)
+        if data is None:
+          writer.zero(count)
+        elif isinstance(data, Node):
+          self.write_file(writer, data, count, opened)
+        else:
+          writer.write(data)
+        position = start + count
+        item = next(items, None)
+      writer.skip(g.end - position)
+
+    for f in opened.values():
+      f.close()
+    writer.close()
+
+  def write_file(self, writer, node, count, opened):
+    f = opened.get(id(node))
+    if f is None:
+      f = opened[id(node)] = node.open()
+    remaining = count * BLOCK_SIZE
+    while remaining > 0:
+      n = min(remaining, CHUNK_SIZE)
+      data = f.read(n)
+      if len(data) < n:
+        # The file shrank since it was scanned.
+        data += b"\0" * (n - len(data))
+      if data == sparse.ZEROS[:n]:
+        writer.zero(n // BLOCK_SIZE)
+      else:
+        writer.write(data)
+      remaining -= n
+    if node.runs[-1][0] + node.runs[-1][1] == writer.blocks:
+      f.close()
+      del opened[id(node)]
+
+  def build(self, output_file, sparse_image=False, crc=False):
+    """Write the image to output_file, as an Android sparse image with
+    sparse_image (and a CRC32 chunk with crc)."""
+    with hashio.open_output(output_file) as f:
+      if sparse_image:
+        writer = sparse.SparseImageWriter(f, BLOCK_SIZE, self.blocks_count,
+                                          crc)
+      else:
+        writer = sparse.RawImageWriter(f, BLOCK_SIZE, self.blocks_count)
+      self.write(writer)
+
+def min_size(input_directory, journal=True, headroom=None):
+  """Return the bytes of the smallest ext4 image of input_directory (or
+  tar), with headroom free, laid out without writing anything."""
+  image = Ext4Image(scan(input_directory), None, journal=journal,
+                    headroom=headroom)
+  return image.blocks_count * BLOCK_SIZE
+
+def make_image(input_directory, output_file, size=None, label="",
+               mount_point="", timestamp=None, journal=True,
+               sparse_image=False, crc=False, headroom=None):
+  """Build an ext4 image of input_directory (or tar) to output_file and
+  return its Ext4Image. Without size the image is the smallest that fits,
+  with headroom free."""
+  top = scan(input_directory)
+  image = Ext4Image(top, size, label, mount_point, timestamp, journal,
+                    headroom=headroom)
+  try:
+    image.build(output_file, sparse_image, crc)
+  finally:
+    if isinstance(top.source, TarStream):
+      top.source.close()
+  return image
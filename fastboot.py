@@ -0,0 +1,641 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given a partition xml, a directory of images and a device, flashes the
+payloads (partition filename) of the partitions over the fastboot TCP
+transport. With -S, runs a fake device instead, which writes what it is
+flashed into a directory. Otherwise print usages.
+
+Downloads and flashes are pipelined: the next payload is read and split
+while the previous one is on the wire, and up to -P commands are sent
+ahead of their replies. A payload larger than the max-download-size of
+the device is sent as Android sparse images of parts of it, blocks of
+zeros as fill chunks.
+
+Usage: fastboot [flags] host[:port]
+       fastboot -S directory [flags] [host:]port
+
+  -x  (--xml) <partition.xml>
+      The partition XML file of the device.
+
+  -i  (--images) <directory>
+      The directory of the payloads.
+
+  -T  (--tables) <directory>
+      Flash the gpt_both.bin of every physical partition in directory
+      (made by mkpart) as partition:<lun> first.
+
+  -P  (--pipeline) <commands>
+      The number of commands sent ahead of their replies (default 4). 1
+      waits for the reply of each command.
+
+  -m  (--max-download-size) <size>
+      Split payloads within size, if the device takes more.
+
+  -r  (--reboot)
+      Reboot the device once flashed.
+
+  -S  (--serve) <directory>
+      Run a fake device flashing partitions as files of directory.
+
+  -L  (--latency) <ms>
+      The replies of the fake device arrive ms after it sends them
+      (default 0), the round trip of a slow link.
+
+"""
+
+import collections
+import io
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import common
+import sparse
+
+OPTIONS = common.OPTIONS
+OPTIONS.xml = None
+OPTIONS.images = None
+OPTIONS.tables = None
+OPTIONS.pipeline = None
+OPTIONS.max_download_size = None
+OPTIONS.reboot = False
+OPTIONS.serve = None
+OPTIONS.latency = 0
+
+PORT       = 5554
+# Commands sent ahead of their replies
+PIPELINE   = 4
+VERSION    = b"FB01"
+BLOCK_SIZE = 4096
+READ_SIZE  = len(sparse.ZEROS)
+# Payloads queued ahead of the one being sent
+QUEUE_SIZE = 2
+# Largest download of the fake device
+FAKE_MAX_DOWNLOAD_SIZE = 256 * 1024 * 1024
+
+# Length of each packet of the TCP transport
+PACKET_HEADER = struct.Struct(">Q")
+
+class FastbootError(RuntimeError):
+  pass
+
+def parse_address(text, default_host=None):
+  """Return (host, port) of "host", "host:port" or ":port"."""
+  host, sep, port = text.rpartition(":")
+  if sep == "":
+    if default_host is not None and text.isdigit():
+      return (default_host, int(text))
+    return (text, PORT)
+  return (host or default_host or "localhost", int(port))
+
+class Transport(object):
+  """The fastboot TCP transport: a handshake, then every message in
+  packets of their length (8 bytes, big endian) and data."""
+
+  def __init__(self, sock):
+    self.sock = sock
+
+  def recv_exactly(self, size):
+    data = bytearray()
+    while len(data) < size:
+      chunk = self.sock.recv(min(size - len(data), READ_SIZE))
+      if len(chunk) == 0:
+        raise FastbootError("connection closed")
+      data += chunk
+    return bytes(data)
+
+  def send(self, data):
+    self.sock.sendall(PACKET_HEADER.pack(len(data)))
+    self.sock.sendall(data)
+
+  def recv(self):
+    size = PACKET_HEADER.unpack(self.recv_exactly(PACKET_HEADER.size))[0]
+    return self.recv_exactly(size)
+
+  def close(self):
+    self.sock.close()
+
+def connect(host, port, timeout=30):
+  """Return the Transport of a handshaken connection to the device."""
+  sock = socket.create_connection((host, port), timeout)
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  transport = Transport(sock)
+  sock.sendall(VERSION)
+  version = transport.recv_exactly(len(VERSION))
+  if version[:2] != b"FB":
+    sock.close()
+    raise FastbootError("%s:%d is not a fastboot device" % (host, port))
+  return transport
+
+def read_reply(transport):
+  """Return (status, message) of the next reply of the device, printing
+  its INFO and TEXT messages on the way."""
+  while True:
+    reply = transport.recv()
+    status, message = reply[:4].decode("ascii"), \
+                      reply[4:].decode("utf-8", "replace")
+    if status in ("INFO", "TEXT"):
+      if OPTIONS.verbose:
+        print("(device) %s" % message)
+      continue
+    if status == "FAIL":
+      raise FastbootError("device: %s" % message)
+    return (status, message)
+
+def command(transport, cmd):
+  """Send cmd, wait for its OKAY and return its message."""
+  transport.send(cmd.encode("utf-8"))
+  status, message = read_reply(transport)
+  if status != "OKAY":
+    raise FastbootError("%s: unexpected %s reply" % (cmd, status))
+  return message
+
+def max_download_size(transport):
+  value = command(transport, "getvar:max-download-size")
+  return int(value, 0)
+
+def image_blocks(path):
+  """Return (block_size, total_blocks, runs) of the payload at path, runs
+  yielding ("raw", data, count), ("fill", pattern, count) or ("skip",
+  None, count) in block order. Blocks of zeros of a raw payload are fill
+  runs, its last block is padded with zeros."""
+  if sparse.is_sparse(path):
+    f = open(path, "rb")
+    reader = sparse.SparseImageReader(f)
+
+    def runs():
+      try:
+        for chunk_type, block, count, arg in reader.chunks():
+          if chunk_type == sparse.CHUNK_TYPE_RAW:
+            size = count * reader.block_size
+            offset = arg
+            while size > 0:
+              n = min(size, READ_SIZE)
+              data = os.pread(f.fileno(), n, offset)
+              if len(data) != n:
+                raise FastbootError("%s: truncated sparse image" % path)
+              yield ("raw", data, n // reader.block_size)
+              offset += n
+              size -= n
+          elif chunk_type == sparse.CHUNK_TYPE_FILL:
+            yield ("fill", arg, count)
+          elif chunk_type == sparse.CHUNK_TYPE_DONT_CARE:
+            yield ("skip", None, count)
+      finally:
+        f.close()
+    return (reader.block_size, reader.total_blocks, runs())
+
+  size = os.path.getsize(path)
+  zero_block = sparse.ZEROS[:BLOCK_SIZE]
+
+  def runs():
+    with open(path, "rb") as f:
+      while True:
+        data = f.read(READ_SIZE)
+        if len(data) == 0:
+          break
+        if len(data) % BLOCK_SIZE != 0:
+          data += sparse.ZEROS[:BLOCK_SIZE - len(data) % BLOCK_SIZE]
+        view = memoryview(data)
+        start = 0
+        zero = None
+        for offset in range(0, len(data), BLOCK_SIZE):
+          is_zero = view[offset:offset + BLOCK_SIZE] == zero_block
+          if zero is not None and is_zero != zero:
+            if zero:
+              yield ("fill", b"\0" * 4, (offset - start) // BLOCK_SIZE)
+            else:
+              yield ("raw", view[start:offset], (offset - start) // BLOCK_SIZE)
+            start = offset
+          zero = is_zero
+        if zero:
+          yield ("fill", b"\0" * 4, (len(data) - start) // BLOCK_SIZE)
+        else:
+          yield ("raw", view[start:], (len(data) - start) // BLOCK_SIZE)
+  return (BLOCK_SIZE, -(-size // BLOCK_SIZE), runs())
+
+def sparse_pieces(path, max_size):
+  """Yield Android sparse images of at most max_size bytes, each writing
+  a part of the payload at path and skipping the rest of it."""
+  block_size, total_blocks, runs = image_blocks(path)
+  # A raw or fill chunk, and the skip chunk ending the image
+  overhead = 2 * sparse.CHUNK_HEADER.size + 4
+
+  state = {"buf": None, "writer": None}
+
+  def start(block):
+    state["buf"] = io.BytesIO()
+    state["writer"] = sparse.SparseImageWriter(state["buf"], block_size,
+                                               total_blocks)
+    state["writer"].skip(block)
+
+  def finish():
+    state["writer"].close()
+    data = state["buf"].getvalue()
+    state["buf"] = state["writer"] = None
+    return data
+
+  block = 0
+  pieces = 0
+  fresh = True  # nothing but the leading skip in the current piece
+  for kind, arg, count in runs:
+    while count > 0:
+      if state["writer"] is None:
+        start(block)
+        fresh = True
+      room = max_size - state["buf"].tell() - overhead
+      if kind == "raw":
+        n = min(count, room // block_size)
+      elif kind == "fill":
+        n = count if room >= 0 else 0
+      else:
+        n = count
+      if n <= 0:
+        if fresh:
+          raise FastbootError("max-download-size %d is too small" % max_size)
+        pieces += 1
+        yield finish()
+        continue
+
+      if kind == "raw":
+        state["writer"].write(arg[:n * block_size])
+        arg = arg[n * block_size:]
+        fresh = False
+      elif kind == "fill":
+        state["writer"].fill(arg, n)
+        fresh = False
+      else:
+        state["writer"].skip(n)
+      block += n
+      count -= n
+
+  # Trailing skips are left out, unless the payload is nothing else.
+  if state["writer"] is not None and (not fresh or pieces == 0):
+    yield finish()
+
+def payload_pieces(path, max_size):
+  """Yield the downloads flashing the payload at path: the file itself if
+  it fits in max_size, its sparse pieces otherwise."""
+  if os.path.getsize(path) <= max_size:
+    with open(path, "rb") as f:
+      yield f.read()
+    return
+  for piece in sparse_pieces(path, max_size):
+    yield piece
+
+def read_ahead(jobs, max_size, out):
+  """Put (label, index, data) of the downloads of jobs into the queue out,
+  then None. An exception is put in place of the failed download."""
+  try:
+    for label, path in jobs:
+      for index, data in enumerate(payload_pieces(path, max_size)):
+        out.put((label, index, data))
+    out.put(None)
+  except Exception as e:
+    out.put(e)
+
+class Pipeline(object):
+  """Sends commands up to depth ahead of their replies, which are read
+  back in order."""
+
+  def __init__(self, transport, depth):
+    self.transport = transport
+    self.depth     = max(1, depth)
+    # (command, replies expected before its OKAY) in the order sent
+    self.pending   = collections.deque()
+
+  def wait(self, limit):
+    while len(self.pending) > limit:
+      cmd, data_reply = self.pending.popleft()
+      status, message = read_reply(self.transport)
+      if data_reply:
+        if status != "DATA":
+          raise FastbootError("%s: unexpected %s reply" % (cmd, status))
+        status, message = read_reply(self.transport)
+      if status != "OKAY":
+        raise FastbootError("%s: unexpected %s reply" % (cmd, status))
+
+  def download(self, data):
+    cmd = "download:%08x" % len(data)
+    self.wait(self.depth - 1)
+    self.transport.send(cmd.encode("ascii"))
+    if self.depth == 1:
+      status, message = read_reply(self.transport)
+      if status != "DATA":
+        raise FastbootError("%s: unexpected %s reply" % (cmd, status))
+      self.transport.send(data)
+      self.pending.append((cmd, False))
+    else:
+      # The data follows the command, the device reads it on its DATA.
+      self.transport.send(data)
+      self.pending.append((cmd, True))
+
+  def command(self, cmd):
+    self.wait(self.depth - 1)
+    self.transport.send(cmd.encode("utf-8"))
+    self.pending.append((cmd, False))
+
+  def flush(self):
+    self.wait(0)
+
+def flash(transport, jobs, depth=PIPELINE, max_size=None):
+  """Flash jobs, (partition, payload path) pairs, in order. Returns the
+  bytes downloaded."""
+  import queue
+
+  device_max = max_download_size(transport)
+  if max_size is None or max_size > device_max:
+    max_size = device_max
+
+  pieces = queue.Queue(QUEUE_SIZE)
+  reader = threading.Thread(target=read_ahead, args=(jobs, max_size, pieces))
+  reader.daemon = True
+  reader.start()
+
+  pipeline = Pipeline(transport, depth)
+  downloaded = 0
+  while True:
+    item = pieces.get()
+    if item is None:
+      break
+    if isinstance(item, Exception):
+      raise item
+    label, index, data = item
+    pipeline.download(data)
+    pipeline.command("flash:%s" % label)
+    downloaded += len(data)
+    if index == 0:
+      print("| %-12s flashing" % label)
+  pipeline.flush()
+  reader.join()
+  return downloaded
+
+def flash_jobs(xml, images, tables=None):
+  """Return the (partition, payload path) pairs to flash from the partition
+  xml and the directory images, the GPTs in tables first."""
+  import parser
+  import pt
+
+  parser.PARSER.xml2object(xml)
+  physical_partitions = pt.PHYSICAL_PARTITIONS
+
+  jobs = []
+  if tables is not None:
+    for lun in range(len(physical_partitions)):
+      suffix = "%d" % lun if len(physical_partitions) > 1 else ""
+      path = os.path.join(tables, "gpt_both%s.bin" % suffix)
+      if os.path.isfile(path):
+        jobs.append(("partition:%d" % lun, path))
+      else:
+        print("| %-12s no table %s" % ("partition:%d" % lun, path))
+
+  for partitions in physical_partitions:
+    for part in partitions.part_list:
+      if part.filename == "" or images is None:
+        continue
+      path = os.path.join(images, part.filename)
+      if not os.path.isfile(path):
+        print("| %-12s no payload %s" % (part.label, path))
+        continue
+      jobs.append((part.label, path))
+  return jobs
+
+class FakeDevice(object):
+  """A fastboot device over TCP, serving one connection at a time, which
+  flashes partitions as files of directory (sparse images expanded)."""
+
+  def __init__(self, directory, host="localhost", port=PORT,
+               max_download_size=FAKE_MAX_DOWNLOAD_SIZE, latency=0):
+    self.directory         = directory
+    self.max_download_size = max_download_size
+    self.latency           = latency / 1000.0
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind((host, port))
+    self.sock.listen(1)
+    self.port = self.sock.getsockname()[1]
+    self.closed = False
+    self.replies = None
+
+  def reply(self, transport, status, message=""):
+    data = status.encode("ascii") + message.encode("utf-8")
+    if self.replies is None:
+      transport.send(data)
+    else:
+      self.replies.put((time.time() + self.latency, data))
+
+  def send_replies(self, transport):
+    """Send the replies once they are latency old, as a link would
+    deliver them, while the device goes on with the next commands."""
+    while True:
+      item = self.replies.get()
+      if item is None:
+        break
+      due, data = item
+      delay = due - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      try:
+        transport.send(data)
+      except OSError:
+        break
+
+  def partition_file(self, name):
+    name = name.replace(":", "_")
+    if name in ("", ".", "..") or "/" in name:
+      raise FastbootError("bad partition name %r" % name)
+    return os.path.join(self.directory, name)
+
+  def write_partition(self, name, data):
+    path = self.partition_file(name)
+    mode = "r+b" if os.path.exists(path) else "w+b"
+    with open(path, mode) as f:
+      if data[:4] == struct.pack("<I", sparse.SPARSE_HEADER_MAGIC):
+        reader = sparse.SparseImageReader(io.BytesIO(data))
+        f.seek(0, os.SEEK_END)
+        if f.tell() < reader.size():
+          f.truncate(reader.size())
+        reader.expand(f, 0)
+      else:
+        f.write(data)
+
+  def handle(self, transport):
+    data = None
+    while True:
+      try:
+        cmd = transport.recv().decode("utf-8")
+      except FastbootError:
+        return
+      if cmd == "getvar:max-download-size":
+        self.reply(transport, "OKAY", "0x%08x" % self.max_download_size)
+      elif cmd == "getvar:product":
+        self.reply(transport, "OKAY", "fake")
+      elif cmd.startswith("getvar:"):
+        self.reply(transport, "FAIL", "unknown variable")
+      elif cmd.startswith("download:"):
+        size = int(cmd[len("download:"):], 16)
+        if size > self.max_download_size:
+          self.reply(transport, "FAIL", "data too large")
+          continue
+        self.reply(transport, "DATA", "%08x" % size)
+        data = bytearray()
+        while len(data) < size:
+          data += transport.recv()
+        self.reply(transport, "OKAY")
+      elif cmd.startswith("flash:"):
+        if data is None:
+          self.reply(transport, "FAIL", "no data downloaded")
+          continue
+        self.write_partition(cmd[len("flash:"):], bytes(data))
+        data = None
+        self.reply(transport, "OKAY")
+      elif cmd.startswith("erase:"):
+        with open(self.partition_file(cmd[len("erase:"):]), "wb"):
+          pass
+        self.reply(transport, "OKAY")
+      elif cmd == "reboot":
+        self.reply(transport, "OKAY")
+        return
+      else:
+        self.reply(transport, "FAIL", "unknown command")
+
+  def serve(self):
+    """Serve connections until close()."""
+    while not self.closed:
+      try:
+        sock, address = self.sock.accept()
+      except OSError:
+        break
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      transport = Transport(sock)
+      sender = None
+      if self.latency > 0:
+        import queue
+        self.replies = queue.Queue()
+        sender = threading.Thread(target=self.send_replies, args=(transport,))
+        sender.start()
+      try:
+        if transport.recv_exactly(len(VERSION))[:2] == b"FB":
+          sock.sendall(VERSION)
+          self.handle(transport)
+      except (FastbootError, OSError):
+        pass
+      finally:
+        if sender is not None:
+          self.replies.put(None)
+          sender.join()
+          self.replies = None
+        transport.close()
+
+  def start(self):
+    """Serve in a background thread."""
+    t = threading.Thread(target=self.serve)
+    t.daemon = True
+    t.start()
+    return t
+
+  def close(self):
+    self.closed = True
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self.sock.close()
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-x", "--xml"):
+      OPTIONS.xml = arg
+    elif opt in ("-i", "--images"):
+      OPTIONS.images = arg
+    elif opt in ("-T", "--tables"):
+      OPTIONS.tables = arg
+    elif opt in ("-P", "--pipeline"):
+      OPTIONS.pipeline = int(arg)
+    elif opt in ("-m", "--max-download-size"):
+      OPTIONS.max_download_size = common.parseSize(arg)
+    elif opt in ("-r", "--reboot"):
+      OPTIONS.reboot = True
+    elif opt in ("-S", "--serve"):
+      OPTIONS.serve = arg
+    elif opt in ("-L", "--latency"):
+      OPTIONS.latency = float(arg)
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="x:i:T:P:m:rS:L:",
+                             extra_long_opts=[
+                               "xml=",
+                               "images=",
+                               "tables=",
+                               "pipeline=",
+                               "max-download-size=",
+                               "reboot",
+                               "serve=",
+                               "latency=",
+                             ],
+                             extra_option_handler=option_handler)
+
+  if len(args) != 1:
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.pipeline is None:
+    OPTIONS.pipeline = PIPELINE
+
+  if OPTIONS.serve is not None:
+    host, port = parse_address(args[0], "localhost")
+    kwargs = {"latency": OPTIONS.latency}
+    if OPTIONS.max_download_size is not None:
+      kwargs["max_download_size"] = OPTIONS.max_download_size
+    device = FakeDevice(OPTIONS.serve, host, port, **kwargs)
+    print("Fake device on %s:%d, flashing into %s"
+      % (host, device.port, OPTIONS.serve))
+    try:
+      device.serve()
+    except KeyboardInterrupt:
+      device.close()
+    return
+
+  if OPTIONS.xml is None or (OPTIONS.images is None and OPTIONS.tables is None):
+    common.usage(__doc__)
+    sys.exit(1)
+
+  jobs = flash_jobs(OPTIONS.xml, OPTIONS.images, OPTIONS.tables)
+  host, port = parse_address(args[0])
+  start = time.time()
+  transport = connect(host, port)
+  try:
+    downloaded = flash(transport, jobs, OPTIONS.pipeline,
+                       OPTIONS.max_download_size)
+    if OPTIONS.reboot is True:
+      command(transport, "reboot")
+  finally:
+    transport.close()
+  elapsed = time.time() - start
+  print("Flashed %d partitions, %d bytes in %.2fs (%.1f MB/s)"
+    % (len(jobs), downloaded, elapsed,
+       downloaded / (1024.0 * 1024.0) / max(elapsed, 1e-6)))
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (C) 2015 The Yudatun Open Source Project
 #
@@ -7,12 +7,13 @@
 # published by the Free Software Foundation
 #
 
-import random
 import struct
+import zlib
 
 import pt
 import common
 import mbr
+import hashio
 
 OPTIONS = common.OPTIONS
 
@@ -22,41 +23,139 @@ BUG          = pt.BUG
 
 BYTES_PER_SECTOR = pt.BYTES_PER_SECTOR
 
-# A8h reflected is 15h, i.e. 10101000 <--> 00010101
-def reflect(data, bits):
-  reflection = 0x00000000
-  for bit in range(bits):
-    if (data & 0x01):
-      reflection |= (1 << ((bits - 1) - bit))
-
-    data = (data >> 1);
-
-  return reflection
-
-def my_crc32(array, num):
-  k         = 8            # length of unit (i.e. byte)
-  MSB       = 0
-  gx        = 0x04C11DB7   # IEEE 32bit polynomial
-  regs      = 0xFFFFFFFF   # init to all ones
-  regs_mask = 0xFFFFFFFF   # ensure only 32 bit answer
-
-  for i in range(num):
-    data = array[i]
-    data = reflect(data, 8)
-    for j in range(k):
-      MSB  = data >> (k - 1)  # get MSB
-      MSB &= 1                # ensure just 1 bit
-      regs_MSB = (regs >> 31) & 1
-      regs = regs << 1        # shift regs for CRC-CCITT
-      if regs_MSB ^ MSB:      # MSB is a 1
-        regs = regs ^ gx      # XOR with generator poly
-      regs = regs & regs_mask # Mask off excess upper bits
-      data <<= 1              # get to next bit
-
-  regs  = regs & regs_mask # Mask off excess upper bits
-  crc32 = reflect(regs, 32) ^ 0xFFFFFFFF
-
-  return crc32
+# signature, revision, header_size, header_crc32, reserved, current_lba,
+# backup_lba, first_lba, last_lba, disk_guid, entry_array_start_lba,
+# entry_number, entry_size, entry_array_crc32
+HEADER = struct.Struct("<QIIIIQQQQ16sQIII")
+# type_guid, unique_guid, first_lba, last_lba, attributes, label (UTF-16LE)
+ENTRY  = struct.Struct("<16s16sQQQ72s")
+
+def crc32(data):
+  """Return the CRC32 (IEEE 802.3) of data, as the GPT fields hold it."""
+  return zlib.crc32(bytes(data)) & 0xFFFFFFFF
+
+def guid2bytes(guid):
+  """Return the 16 on-disk bytes of GUID integer guid."""
+  return struct.pack("<QQ", guid & 0xFFFFFFFFFFFFFFFF, guid >> 64)
+
+def bytes2guid(data):
+  """Return the GUID integer of the 16 on-disk bytes data."""
+  low, high = struct.unpack("<QQ", bytes(data))
+  return (high << 64) | low
+
+def uuid2guid(u):
+  """Return uuid u as the GUID integer whose little endian bytes are the
+  on-disk (mixed endian) form, the same as Partition.validate_GUID()."""
+  import binascii
+  return int(binascii.hexlify(u.bytes_le[::-1]), 16)
+
+def guid2str(guid):
+  """Return the registry form (xxxxxxxx-xxxx-...) of GUID integer guid."""
+  import binascii
+  import uuid
+  data = binascii.unhexlify("%032x" % guid)[::-1]
+  return str(uuid.UUID(bytes_le=data))
+
+def derive_guid(*names):
+  """Return a name based (RFC 4122 version 5) GUID integer of names.
+  The same names always give the same GUID."""
+  import uuid
+  name = ":".join([str(n) for n in names])
+  return uuid2guid(uuid.uuid5(uuid.UUID(common.GUID_NAMESPACE), name))
+
+def random_guid():
+  """Return a random (RFC 4122 version 4) GUID integer."""
+  import uuid
+  return uuid2guid(uuid.uuid4())
+
+def layout_identity(part_list, instructions=INSTRUCTIONS):
+  """Return a string which identifies the layout of part_list, the disk
+  GUID is derived from it."""
+  items = ["%d" % instructions.AUTO_GROW_LAST_PARTITION]
+  for part in part_list:
+    items.append("%s,%x,%d,%d,%d" % (part.label, part._type, part.size_in_kb,
+                                     part.first_lba_in_kb, part.readonly))
+    # Only aligned layouts say so, unaligned ones keep their GUIDs.
+    if instructions.alignment_in_kb(part) > 0:
+      items[-1] += ",%d" % instructions.alignment_in_kb(part)
+  return ";".join(items)
+
+def layout_guid(partitions, instructions, lun=None):
+  """Return the disk GUID derived from the seed and the layout of
+  partitions, of physical partition lun if the XML has several."""
+  identity = layout_identity(partitions.part_list, instructions)
+  if lun is None:
+    return derive_guid("disk", OPTIONS.guid_seed, identity)
+  return derive_guid("disk", OPTIONS.guid_seed, "lun%d" % lun, identity)
+
+def part_attributes(part):
+  """Return the GPT entry attributes of part."""
+  attributes = 0x0
+  if part.readonly is True:
+    attributes |= 1 << 60
+  if part.hidden is True:
+    attributes |= 1 << 62
+  if part.dontautomount is True:
+    attributes |= 1 << 63
+  if part.system is True:
+    attributes |= 1
+  return attributes
+
+def place_partitions(partitions, instructions, first_lba=34):
+  """Return the (first_lba, last_lba) of each partition of partitions,
+  placed from first_lba on as they are written into the GPT. Partitions
+  start on the boundary of their alignment policy, read-only ones start
+  write protect chunks in partitions.wp_chunk_list, and writeable ones are
+  moved out of them."""
+  lbas = []
+  sectors_till_next_bulk = 0
+
+  kb_per_bulk = instructions.WRITE_PROTECT_BULK_SIZE_IN_KB
+  sectors_per_bulk = pt.kb2sectors(kb_per_bulk)
+
+  for i in range(len(partitions.part_list)):
+
+    part = partitions.part_list[i]
+    last_wp_chunk = partitions.wp_chunk_list[-1]
+
+    # Start on the boundary of the alignment policy of the partition, the
+    # write protect bulks below go first if they disagree.
+    aligned_lba = pt.align_lba(first_lba, instructions.alignment_in_sec(part))
+    part.padding_in_sec = aligned_lba - first_lba
+    first_lba = aligned_lba
+
+    if kb_per_bulk > 0:
+      sectors_till_next_bulk = pt.sectors_till_next_bulk(first_lba, kb_per_bulk)
+
+    if part.readonly is True:
+      # To be here means this partition is read-only, so see if
+      # we need to move the start lba
+      if first_lba > last_wp_chunk.end_sector:
+        first_lba += sectors_till_next_bulk
+      partitions.update_wp_chunk_list(first_lba, part.size_in_sec,
+                                      sectors_per_bulk)
+    else:
+      # To be here means this partition is writeable, so see if
+      # we need to move the start
+      if first_lba <= last_wp_chunk.end_sector:
+        first_lba += sectors_till_next_bulk
+
+    size_in_sec = part.size_in_sec
+    # The last partition
+    if (i + 1) == len(partitions.part_list) and \
+       instructions.AUTO_GROW_LAST_PARTITION is True:
+      size_in_sec = 0 # Infinite huge
+
+    # Increase by number of sectors, last lba inclusive, so add 1 for size.
+    last_lba = first_lba + size_in_sec
+    # Inclusive, meaning 0 to 3 is 4 sectors, or another way,
+    # last lba must be odd.
+    last_lba -= 1
+    lbas.append((first_lba, last_lba))
+
+    first_lba = last_lba + 1
+
+  return lbas
 
 class GPTHeader(object):
 
@@ -85,52 +184,32 @@ class GPTHeader(object):
     self.entry_size            = 0x00000080  # 128
     self.entry_array_crc32     = 0x00000000  # *
 
-    self.array = [0] * BYTES_PER_SECTOR
+    self.array = bytearray(BYTES_PER_SECTOR)
 
   def toarray(self):
-    i = 0
-    for b in range(8):
-      self.array[i] = (self.signature >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(4):
-      self.array[i] = (self.revision >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(4):
-      self.array[i] = (self.header_size >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(4):
-      self.array[i] = (self.header_crc32 >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(4):
-      self.array[i] = (self.reserve >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(8):
-      self.array[i] = (self.current_lba >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(8):
-      self.array[i] = (self.backup_lba >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(8):
-      self.array[i] = (self.first_lba >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(8):
-      self.array[i] = (self.last_lba >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(16):
-      self.array[i] = (self.disk_guid >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(8):
-      self.array[i] = (self.entry_array_start_lba >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(4):
-      self.array[i] = (self.entry_number >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(4):
-      self.array[i] = (self.entry_size >> (b * 8)) & 0xFF
-      i += 1
-    for b in range(4):
-      self.array[i] = (self.entry_array_crc32 >> (b * 8)) & 0xFF
-      i += 1
+    HEADER.pack_into(self.array, 0,
+                     self.signature, self.revision, self.header_size,
+                     self.header_crc32, self.reserve, self.current_lba,
+                     self.backup_lba, self.first_lba, self.last_lba,
+                     guid2bytes(self.disk_guid), self.entry_array_start_lba,
+                     self.entry_number, self.entry_size,
+                     self.entry_array_crc32)
+
+  def fromarray(self, data):
+    """Decode the header from the sector data, the reverse of toarray()."""
+    self.array[:] = data[:BYTES_PER_SECTOR]
+    (self.signature, self.revision, self.header_size, self.header_crc32,
+     self.reserve, self.current_lba, self.backup_lba, self.first_lba,
+     self.last_lba, disk_guid, self.entry_array_start_lba,
+     self.entry_number, self.entry_size, self.entry_array_crc32) = \
+      HEADER.unpack_from(self.array, 0)
+    self.disk_guid = bytes2guid(disk_guid)
+
+  def calc_header_crc32(self):
+    """Return the CRC32 of the header in array, its own field as zero."""
+    data = bytearray(self.array[:self.header_size])
+    data[16:20] = b"\0" * 4
+    return crc32(data)
 
   def update(self, last_lba, entry_number, entry_array_crc32):
     if last_lba is not None and last_lba > 0:
@@ -140,7 +219,7 @@ class GPTHeader(object):
     if entry_array_crc32 is not None:
       self.entry_array_crc32 = entry_array_crc32
     self.toarray()
-    self.header_crc32 = my_crc32(self.array, self.header_size)
+    self.header_crc32 = self.calc_header_crc32()
 
 class Entry(object):
 
@@ -152,7 +231,7 @@ class Entry(object):
     self.attributes  = None
     self.label       = None
 
-    self.array = [0] * (BYTES_PER_SECTOR / 4)
+    self.array = bytearray(BYTES_PER_SECTOR // 4)
 
   def set(self, type_guid, unique_guid, first_lba, last_lba, attributes, label):
     self.type_guid   = type_guid
@@ -166,49 +245,55 @@ class Entry(object):
       self.label = label
 
   def toarray(self):
-    i = 0
+    ENTRY.pack_into(self.array, 0,
+                    guid2bytes(self.type_guid), guid2bytes(self.unique_guid),
+                    self.first_lba, self.last_lba, self.attributes,
+                    self.label[0:36].encode("utf-16-le"))
+
+  def fromarray(self, data):
+    """Decode the entry from its bytes data, the reverse of toarray()."""
+    self.array[:] = data[:len(self.array)]
+    (type_guid, unique_guid, self.first_lba, self.last_lba,
+     self.attributes, label) = ENTRY.unpack_from(self.array, 0)
+    self.type_guid   = bytes2guid(type_guid)
+    self.unique_guid = bytes2guid(unique_guid)
+    self.label = label.decode("utf-16-le", "replace").split("\0")[0]
+
+  def is_empty(self):
+    return self.type_guid == 0
+
+class EntryArrayCRC(object):
+  """CRC32s of entry arrays sharing a prefix with the one before (tables
+  of variants of a layout): the CRC state after the entries they have in
+  common is reused, only the entries after it are computed."""
 
-    if self.type_guid is not None:
-      for b in range(16):
-        self.array[i] = (self.type_guid >> (b * 8)) & 0xFF
-        i += 1
-
-    if self.unique_guid is not None:
-      for b in range(16):
-        self.array[i] = (self.unique_guid >> (b * 8)) & 0xFF
-        i += 1
-
-    if self.first_lba is not None:
-      for b in range(8):
-        self.array[i] = (self.first_lba >> (b * 8)) & 0xFF
-        i += 1
-
-    if self.last_lba is not None:
-      for b in range(8):
-        self.array[i] = (self.last_lba >> (b * 8)) & 0xFF
-        i += 1
-
-    if self.attributes is not None:
-      for b in range(8):
-        self.array[i] = (self.attributes >> (b * 8)) & 0xFF
-        i += 1
-
-    if self.label is not None:
-      if len(self.label) > 36:
-        self.label = self.label[0:36]
-      for b in self.label:
-        self.array[i] = ord(b); i += 1
-        self.array[i] = 0x00;   i += 1
+  def __init__(self):
+    self.entries = []   # bytes of the entries of the last array
+    self.states  = [0]  # CRC state after each of them
+
+  def crc32(self, entry_array, entry_number, entry_size):
+    common = 0
+    while common < min(len(entry_array), len(self.entries)) and \
+          entry_array[common].array == self.entries[common]:
+      common += 1
+    del self.entries[common:]
+    del self.states[common + 1:]
+    for entry in entry_array[common:]:
+      self.entries.append(bytes(entry.array))
+      self.states.append(zlib.crc32(bytes(entry.array), self.states[-1]))
+    padding = b"\0" * ((entry_number - len(entry_array)) * entry_size)
+    return zlib.crc32(padding, self.states[-1]) & 0xFFFFFFFF
 
 class PrimaryGPT(object):
 
-  def __init__(self):
+  def __init__(self, entry_crc=None):
     self.gpt_header  = GPTHeader(True)
     self.entry_array = []
+    self.entry_crc   = entry_crc  # an EntryArrayCRC, or None
 
     self.first_partition_lba = 34
 
-    self.array = [0x00] * (33 * BYTES_PER_SECTOR)
+    self.array = bytearray(33 * BYTES_PER_SECTOR)
 
     self.gpt_header_addr  = 0
     self.entry_array_addr = 1 * BYTES_PER_SECTOR
@@ -220,16 +305,12 @@ class PrimaryGPT(object):
 
     if self.gpt_header is not None:
       i = self.gpt_header_addr
-      for b in self.gpt_header.array:
-        self.array[i] = b
-        i += 1
+      self.array[i:i + len(self.gpt_header.array)] = self.gpt_header.array
 
-    if len(self.entry_array) > 0:
-      i = self.entry_array_addr
-      for entry in self.entry_array:
-        for b in entry.array:
-          self.array[i] = b
-          i += 1
+    i = self.entry_array_addr
+    for entry in self.entry_array:
+      self.array[i:i + len(entry.array)] = entry.array
+      i += len(entry.array)
 
   def entry_array_crc32(self, entry_number):
 
@@ -237,15 +318,15 @@ class PrimaryGPT(object):
       BUG.error("Invalidate number of entries (%d)." % entry_number)
 
     entry_size = self.gpt_header.entry_size
-    array = [0] * entry_number * entry_size
-    if len(self.entry_array) > 0:
-      i = 0
-      for entry in self.entry_array:
-        for b in entry.array:
-          array[i] = b
-          i += 1
+    if self.entry_crc is not None and len(self.entry_array) <= entry_number:
+      return self.entry_crc.crc32(self.entry_array, entry_number, entry_size)
+    array = bytearray(entry_number * entry_size)
+    i = 0
+    for entry in self.entry_array:
+      array[i:i + len(entry.array)] = entry.array
+      i += len(entry.array)
 
-    return my_crc32(array, entry_number * entry_size)
+    return crc32(array[:entry_number * entry_size])
 
   def update_gpt_header(self, last_lba, entry_number, entry_array_crc32):
     self.gpt_header.update(last_lba, entry_number, entry_array_crc32)
@@ -257,7 +338,7 @@ class SecondaryGPT(object):
     self.entry_array = []
     self.gpt_header  = GPTHeader(False)
 
-    self.array = [0x00] * (33 * BYTES_PER_SECTOR)
+    self.array = bytearray(33 * BYTES_PER_SECTOR)
 
     self.entry_array_addr = 0
     self.gpt_header_addr  = 32 * BYTES_PER_SECTOR
@@ -268,24 +349,34 @@ class SecondaryGPT(object):
 
   def toarray(self):
 
-    if len(self.entry_array) > 0:
-      i = self.entry_array_addr
-      for entry in self.entry_array:
-        for b in entry.array:
-          self.array[i] = b
-          i += 1
+    i = self.entry_array_addr
+    for entry in self.entry_array:
+      self.array[i:i + len(entry.array)] = entry.array
+      i += len(entry.array)
 
     if self.gpt_header is not None:
       i = self.gpt_header_addr
-      for b in self.gpt_header.array:
-        self.array[i] = b
-        i += 1
+      self.array[i:i + len(self.gpt_header.array)] = self.gpt_header.array
 
 class GPTPartitionTable(object):
 
-  def __init__(self):
+  def __init__(self, partitions=PARTITIONS, instructions=INSTRUCTIONS,
+               lun=None, disk_sectors=None, entry_crc=None,
+               part_guid_base=None):
+    """The tables of partitions, laid out by instructions. lun is the
+    number of the physical partition, which ends the image names, if the
+    XML has several of them. Without disk_sectors, the size of the disk,
+    the fields depending on it are left for the flashing tool to patch.
+    entry_crc, an EntryArrayCRC, is shared by the tables of variants of a
+    layout, and part_guid_base, the GUID the partition GUIDs are derived
+    from instead of the disk GUID, keeps their entries alike."""
+    self.partitions     = partitions
+    self.instructions   = instructions
+    self.lun            = lun
+    self.disk_sectors   = disk_sectors
+    self.part_guid_base = part_guid_base
     self.protective_mbr = mbr.MBR()
-    self.primary_gpt    = PrimaryGPT()
+    self.primary_gpt    = PrimaryGPT(entry_crc)
     self.secondary_gpt  = SecondaryGPT()
 
   def init_protective_mbr(self):
@@ -300,98 +391,90 @@ class GPTPartitionTable(object):
     entry.last_sector_cylinder  = 0xFF
     entry.first_lba             = 0x00000001
     entry.num_sectors           = 0xFFFFFFFF
+    if self.disk_sectors is not None:
+      entry.num_sectors = min(self.disk_sectors - 1, 0xFFFFFFFF)
     entry.toarray()
 
-    self.protective_mbr.signature = INSTRUCTIONS.DISK_SIGNATURE
+    self.protective_mbr.signature = self.instructions.DISK_SIGNATURE
     self.protective_mbr.add_entry(entry)
     self.protective_mbr.toarray()
 
-  def init_primary_gpt(self):
-    first_lba = self.primary_gpt.first_partition_lba
-    last_lba  = first_lba
-    sectors_till_next_bulk = 0
-
-    kb_per_bulk = INSTRUCTIONS.WRITE_PROTECT_BULK_SIZE_IN_KB
-    sectors_per_bulk = pt.kb2sectors(kb_per_bulk)
-
-    print '='*60
-    print '| PartName    Size(KB)  Readonly FirstLBA  LastLBA'
-    print '='*60
+  def init_disk_guid(self):
+    if OPTIONS.random_guid is True:
+      disk_guid = random_guid()
+    else:
+      disk_guid = layout_guid(self.partitions, self.instructions, self.lun)
+    self.primary_gpt.gpt_header.disk_guid = disk_guid
+    self.secondary_gpt.gpt_header.disk_guid = disk_guid
 
-    for i in range(len(PARTITIONS.part_list)):
+  def init_primary_gpt(self):
+    lbas = place_partitions(self.partitions, self.instructions,
+                            self.primary_gpt.first_partition_lba)
+    last_lba = self.primary_gpt.first_partition_lba
+    guid_base = self.part_guid_base
+    if guid_base is None:
+      guid_base = self.primary_gpt.gpt_header.disk_guid
 
-      part = PARTITIONS.part_list[i]
-      last_wp_chunk = PARTITIONS.wp_chunk_list[-1]
+    print('='*60)
+    print('| PartName    Size(KB)  Readonly FirstLBA  LastLBA')
+    print('='*60)
 
-      if kb_per_bulk > 0:
-        sectors_till_next_bulk = pt.sectors_till_next_bulk(first_lba, kb_per_bulk)
+    for i in range(len(self.partitions.part_list)):
 
-      if part.readonly is True:
-        # To be here means this partition is read-only, so see if
-        # we need to move the start lba
-        if first_lba > last_wp_chunk.end_sector:
-          first_lba += sectors_till_next_bulk
-        PARTITIONS.update_wp_chunk_list(first_lba, part.size_in_sec, sectors_per_bulk)
-      else:
-        # To be here means this partition is writeable, so see if
-        # we need to move the start
-        if first_lba <= last_wp_chunk.end_sector:
-          first_lba += sectors_till_next_bulk
+      part = self.partitions.part_list[i]
+      (first_lba, last_lba) = lbas[i]
 
       # The last partition
-      if (i + 1) == len(PARTITIONS.part_list) and \
-         INSTRUCTIONS.AUTO_GROW_LAST_PARTITION is True:
+      if (i + 1) == len(self.partitions.part_list) and \
+         self.instructions.AUTO_GROW_LAST_PARTITION is True:
         part.size_in_kb = part.size_in_sec = 0 # Infinite huge
-
-      # Increase by number of sectors, last lba inclusive, so add 1 for size.
-      last_lba = first_lba + part.size_in_sec
-      # Inclusive, meaning 0 to 3 is 4 sectors, or another way,
-      # last lba must be odd.
-      last_lba -= 1
+        if self.disk_sectors is not None:
+          last_lba = self.disk_sectors - 34 # Up to the Secondary GPT
 
       unique_guid = 0x0
       if OPTIONS.sequential_guid is True:
         unique_guid = i + 1
       elif part.uniqueguid != "":
-        unique_guid = part.uniqueguid
+        unique_guid = part.validate_GUID(part.uniqueguid)
+      elif OPTIONS.random_guid is True:
+        unique_guid = random_guid()
       else:
-        unique_guid = random.randint(0, 2 ** (128))
-
-      attributes = 0x0
-      if part.readonly is True:
-        attributes |= 1 << 60
-      if part.hidden is True:
-        attributes |= 1 << 62
-      if part.dontautomount is True:
-        attributes |= 1 << 63
-      if part.system is True:
-        attributes |= 1
+        unique_guid = derive_guid("partition", OPTIONS.guid_seed,
+                                  guid2str(guid_base), part.label)
 
       entry = Entry()
       entry.set(part._type, unique_guid, first_lba, \
-                last_lba, attributes, part.label)
+                last_lba, part_attributes(part), part.label)
       entry.toarray()
       self.primary_gpt.add_entry(entry)
 
-      print "| %-12s%-10d%-9s%-10d%-d" \
-        % (part.label, part.size_in_kb, str(part.readonly), first_lba, last_lba)
-      print '-'*60
+      print("| %-12s%-10d%-9s%-10d%-d"
+        % (part.label, part.size_in_kb, str(part.readonly), first_lba, last_lba))
+      print('-'*60)
 
       first_lba = last_lba + 1
       last_lba  = first_lba
 
-    if INSTRUCTIONS.AUTO_GROW_LAST_PARTITION is False:
+    padding = pt.padding_report(self.partitions.part_list)
+    if padding is not None:
+      print(padding)
+      print('-'*60)
+
+    if self.disk_sectors is not None:
+      last_lba = self.disk_sectors - 34 # Last usable LBA
+      self.primary_gpt.gpt_header.backup_lba = self.disk_sectors - 1
+    elif self.instructions.AUTO_GROW_LAST_PARTITION is False:
       last_lba += 32 # 33 - 1 (Size of Secondary GPT - 1)
     else:
       last_lba = 0x0
 
     # Calculate to the numbers of entry items into array.
-    real_entry_number = len(PARTITIONS.part_list)
+    real_entry_number = len(self.partitions.part_list)
     entry_number = 0
     if OPTIONS.all_128_partitions is True:
       entry_number = 128
     else:
-      entry_number = (real_entry_number / 4) * 4
+      entry_number = (real_entry_number // 4) * 4
       if real_entry_number % 4 > 0:
         entry_number += 4
     entry_array_crc32 = self.primary_gpt.entry_array_crc32(entry_number)
@@ -405,60 +488,70 @@ class GPTPartitionTable(object):
     last_lba = self.primary_gpt.gpt_header.last_lba
     entry_number = self.primary_gpt.gpt_header.entry_number
     entry_array_crc32 = self.primary_gpt.gpt_header.entry_array_crc32
+    if self.disk_sectors is not None:
+      header = self.secondary_gpt.gpt_header
+      header.current_lba           = self.disk_sectors - 1
+      header.backup_lba            = 1
+      header.entry_array_start_lba = self.disk_sectors - 33
     self.secondary_gpt.update_gpt_header(last_lba, entry_number, \
                                          entry_array_crc32)
     self.secondary_gpt.toarray()
 
+  def suffix(self):
+    if self.lun is None:
+      return ""
+    return "%d" % self.lun
+
   def create_gpt_both_bin(self, output_directory):
-    image_file = "%sgpt_both.bin" % output_directory
+    image_file = "%sgpt_both%s.bin" % (output_directory, self.suffix())
 
     BUG.green("Create %s <-- Protective MBR + Primary GPT + Backup GPT." % image_file)
-    with open(image_file, "wb") as f:
-      for b in self.protective_mbr.array:
-        f.write(struct.pack("B", b))
-      for b in self.primary_gpt.array:
-        f.write(struct.pack("B", b))
-      for b in self.secondary_gpt.array:
-        f.write(struct.pack("B", b))
+    with hashio.open_output(image_file) as f:
+      f.write(self.protective_mbr.array)
+      f.write(self.primary_gpt.array)
+      f.write(self.secondary_gpt.array)
 
   def create_gpt_main_bin(self, output_directory):
-    image_file = "%sgpt_main.bin" % output_directory
+    image_file = "%sgpt_main%s.bin" % (output_directory, self.suffix())
 
     BUG.green("Create %s <-- Protective MBR + Primary GPT." % image_file)
-    with open(image_file, "wb") as f:
-      for b in self.protective_mbr.array:
-        f.write(struct.pack("B", b))
-      for b in self.primary_gpt.array:
-        f.write(struct.pack("B", b))
+    with hashio.open_output(image_file) as f:
+      f.write(self.protective_mbr.array)
+      f.write(self.primary_gpt.array)
 
   def create_gpt_backup_bin(self, output_directory):
-    image_file = "%sgpt_backup.bin" % output_directory
+    image_file = "%sgpt_backup%s.bin" % (output_directory, self.suffix())
 
     BUG.green("Create %s <-- Backup GPT." % image_file)
-    with open(image_file, "wb") as f:
-      for b in self.secondary_gpt.array:
-        f.write(struct.pack("B", b))
+    with hashio.open_output(image_file) as f:
+      f.write(self.secondary_gpt.array)
 
-  def create(self, output_directory):
+  def build(self):
     self.init_protective_mbr()
+    self.init_disk_guid()
     self.init_primary_gpt()
     self.init_secondary_gpt()
 
-    print "| Protective MBR CRC32: 0x%X" \
-      % my_crc32(self.protective_mbr.array, BYTES_PER_SECTOR)
-    print '-'*60
-    print "| Primary GPT Header CRC32: 0x%X" \
-      % self.primary_gpt.gpt_header.header_crc32
-    print '-'*60
-    print "| Primary Entry Array CRC32: 0x%X" \
-      % self.primary_gpt.gpt_header.entry_array_crc32
-    print '-'*60
-    print "| Secondary GPT Header CRC32: 0x%X" \
-      % self.secondary_gpt.gpt_header.header_crc32
-    print '-'*60
-    print "| Secondary Entry Array CRC32: 0x%X" \
-      % self.secondary_gpt.gpt_header.entry_array_crc32
-    print '-'*60
+  def create(self, output_directory):
+    self.build()
+
+    print("| Disk GUID: %s" % guid2str(self.primary_gpt.gpt_header.disk_guid))
+    print('-'*60)
+    print("| Protective MBR CRC32: 0x%X"
+      % crc32(self.protective_mbr.array))
+    print('-'*60)
+    print("| Primary GPT Header CRC32: 0x%X"
+      % self.primary_gpt.gpt_header.header_crc32)
+    print('-'*60)
+    print("| Primary Entry Array CRC32: 0x%X"
+      % self.primary_gpt.gpt_header.entry_array_crc32)
+    print('-'*60)
+    print("| Secondary GPT Header CRC32: 0x%X"
+      % self.secondary_gpt.gpt_header.header_crc32)
+    print('-'*60)
+    print("| Secondary Entry Array CRC32: 0x%X"
+      % self.secondary_gpt.gpt_header.entry_array_crc32)
+    print('-'*60)
 
     self.create_gpt_both_bin(output_directory)
     self.create_gpt_main_bin(output_directory)
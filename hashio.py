@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Digests (sha256, md5 and crc32 at once) of the files the tools write,
+computed as they are written instead of reading them back, recorded in a
+JSON manifest:
+
+  {"files": {"<file>": {"size": ..., "sha256": ..., "md5": ...,
+                        "crc32": ..., "partitions": {"<label>": {
+                          "offset": ..., "size": ..., "sha256": ...}}}}}
+
+Files are opened with open_output(), a plain file unless a manifest was
+enabled. Writes are hashed in order, a seek forward leaves a hole hashed
+as zeros, and ranges (the partitions of a disk image) get digests of
+their own from the same pass. A file written out of order, or by another
+program (record_file()), is read back once instead, and is marked
+"reread".
+"""
+
+import os
+import zlib
+
+ALGORITHMS = ("sha256", "md5", "crc32")
+READ_SIZE  = 1024 * 1024
+ZEROS = b"\0" * READ_SIZE
+
+# The Manifest of this run, None if digests aren't asked for.
+MANIFEST = None
+
+class CRC32(object):
+  name = "crc32"
+
+  def __init__(self):
+    self.value = 0
+
+  def update(self, data):
+    self.value = zlib.crc32(data, self.value)
+
+  def hexdigest(self):
+    return "%08x" % (self.value & 0xFFFFFFFF)
+
+def new(algorithm):
+  if algorithm == "crc32":
+    return CRC32()
+  import hashlib
+  return hashlib.new(algorithm)
+
+class Digests(object):
+  """Several digests of one stream of bytes."""
+
+  def __init__(self, algorithms=ALGORITHMS):
+    self.hashes = [new(a) for a in algorithms]
+    self.size   = 0
+
+  def update(self, data):
+    for h in self.hashes:
+      h.update(data)
+    self.size += len(data)
+
+  def update_zeros(self, count):
+    while count > 0:
+      n = min(count, READ_SIZE)
+      self.update(ZEROS[:n])
+      count -= n
+
+  def to_dict(self):
+    d = {"size": self.size}
+    for h in self.hashes:
+      d[h.name] = h.hexdigest()
+    return d
+
+def hash_file(path, ranges=()):
+  """Return (Digests of the file at path, {label: Digests} of its ranges,
+  (label, offset, length) each), reading it."""
+  digests = Digests()
+  parts = [(label, offset, length, Digests())
+           for label, offset, length in ranges]
+  position = 0
+  with open(path, "rb") as f:
+    while True:
+      data = f.read(READ_SIZE)
+      if len(data) == 0:
+        break
+      feed(digests, parts, position, data)
+      position += len(data)
+  return (digests, dict([(p[0], p[3]) for p in parts]))
+
+def feed(digests, parts, position, data):
+  """Hash data, at position of a file, into digests and the parts
+  overlapping it."""
+  digests.update(data)
+  end = position + len(data)
+  for label, offset, length, part_digests in parts:
+    start = max(offset, position)
+    stop = min(offset + length, end)
+    if start < stop:
+      part_digests.update(data[start - position:stop - position])
+
+class HashingFile(object):
+  """A file open for writing which hashes what is written to it, in
+  order, and records its digests in manifest when closed."""
+
+  def __init__(self, path, mode, manifest):
+    self.f        = open(path, mode)
+    self.path     = path
+    self.name     = path
+    self.manifest = manifest
+    self.digests  = Digests()
+    self.parts    = []
+    self.hashed   = 0      # bytes from the start hashed so far
+    self.in_order = True
+
+  def add_range(self, label, offset, length):
+    """Hash the length bytes at offset apart as well, as label."""
+    self.parts.append((label, offset, length, Digests()))
+
+  def hash_to(self, position):
+    """Hash the hole up to position as zeros."""
+    while self.hashed < position:
+      n = min(position - self.hashed, READ_SIZE)
+      feed(self.digests, self.parts, self.hashed, ZEROS[:n])
+      self.hashed += n
+
+  def hash_data(self, position, data):
+    if not self.in_order:
+      return
+    if position < self.hashed:
+      # Written over, the file is read back when closed.
+      self.in_order = False
+      return
+    self.hash_to(position)
+    feed(self.digests, self.parts, position, data)
+    self.hashed += len(data)
+
+  def write(self, data):
+    self.hash_data(self.f.tell(), data)
+    return self.f.write(data)
+
+  def written_elsewhere(self, offset, length):
+    """Hash the length bytes at offset written without write(), e.g. a
+    range cloned within the file, reading them back."""
+    self.f.flush()
+    done = 0
+    while done < length:
+      data = os.pread(self.f.fileno(), min(READ_SIZE, length - done),
+                      offset + done)
+      if len(data) == 0:
+        break
+      self.hash_data(offset + done, data)
+      done += len(data)
+
+  def zeroed(self, offset, length):
+    """Hash the length bytes at offset made zeros without write(), e.g. a
+    hole punched."""
+    if not self.in_order:
+      return
+    if offset < self.hashed:
+      self.in_order = False
+      return
+    self.hash_to(offset + length)
+
+  def seek(self, offset, whence=0):
+    return self.f.seek(offset, whence)
+
+  def tell(self):
+    return self.f.tell()
+
+  def truncate(self, size=None):
+    return self.f.truncate(size)
+
+  def read(self, size=-1):
+    return self.f.read(size)
+
+  def flush(self):
+    self.f.flush()
+
+  def fileno(self):
+    return self.f.fileno()
+
+  def close(self):
+    if self.f.closed:
+      return
+    size = self.f.seek(0, os.SEEK_END)
+    self.f.close()
+    reread = False
+    if self.in_order:
+      self.hash_to(size)
+      parts = dict([(p[0], p[3]) for p in self.parts])
+    else:
+      reread = True
+      self.digests, parts = hash_file(
+        self.path, [p[:3] for p in self.parts])
+    self.manifest.record(self.path, self.digests, parts, reread,
+                         dict([(p[0], p[1]) for p in self.parts]))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+class Manifest(object):
+  """The manifest file path, updated as files are closed, possibly by
+  several processes."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def name(self, path):
+    """The key of path: relative to the manifest if within its directory."""
+    directory = os.path.dirname(os.path.abspath(self.path))
+    path = os.path.abspath(path)
+    if path.startswith(directory + os.sep):
+      return os.path.relpath(path, directory)
+    return path
+
+  def record(self, path, digests, parts=None, reread=False, offsets=None):
+    import fcntl
+    import json
+
+    entry = digests.to_dict()
+    if reread:
+      entry["reread"] = True
+    if parts:
+      entry["partitions"] = {}
+      for label, part_digests in parts.items():
+        item = part_digests.to_dict()
+        item["offset"] = (offsets or {}).get(label, 0)
+        entry["partitions"][label] = item
+
+    with open(self.path, "a+") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      f.seek(0)
+      text = f.read()
+      manifest = json.loads(text) if text.strip() != "" else {"files": {}}
+      manifest["files"][self.name(path)] = entry
+      f.seek(0)
+      f.truncate()
+      json.dump(manifest, f, indent=1, sort_keys=True)
+      f.write("\n")
+
+def enable(path):
+  """Record the digests of the files written from now on in the manifest
+  path."""
+  global MANIFEST
+  MANIFEST = Manifest(path)
+
+def open_output(path, mode="wb"):
+  """Open path for writing, hashed if a manifest is enabled."""
+  if MANIFEST is None:
+    return open(path, mode)
+  return HashingFile(path, mode, MANIFEST)
+
+def record_file(path, ranges=()):
+  """Record the digests of the file at path, written by another program,
+  reading it (once)."""
+  if MANIFEST is None:
+    return
+  digests, parts = hash_file(path, ranges)
+  MANIFEST.record(path, digests, parts, True,
+                  dict([(r[0], r[1]) for r in ranges]))
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (C) 2015 The Yudatun Open Source Project
 #
@@ -12,6 +12,7 @@ import sys
 import struct
 
 import pt
+import hashio
 
 INSTRUCTIONS = pt.INSTRUCTIONS
 PARTITIONS   = pt.PARTITIONS
@@ -19,6 +20,63 @@ BUG          = pt.BUG
 
 BYTES_PER_SECTOR = pt.BYTES_PER_SECTOR
 
+# bootable, first sector (head, sector/cylinder, cylinder), type,
+# last sector (head, sector/cylinder, cylinder), first_lba, num_sectors
+ENTRY = struct.Struct("<8B2I")
+
+# Partitions in the MBR itself when EBRs are needed, the 4th entry points
+# at the first EBR.
+PRIMARY_PARTITIONS = 3
+
+def place_partitions(partitions, clamp=True):
+  """Return the (first_lba, last_lba) of each partition of partitions as
+  the MBR and EBRs place them. Primary partitions start at their
+  first_lba_in_kb if given, logical ones follow the EBR sectors, one per
+  logical partition, both aligned by their alignment policy. With clamp a
+  first_lba_in_kb inside the previous partition is moved to its end, as
+  the tables are written, otherwise it's kept as requested."""
+  lbas = []
+  part_num = len(partitions.part_list)
+  if part_num > PRIMARY_PARTITIONS + 1:
+    primaries = PRIMARY_PARTITIONS
+  else:
+    primaries = part_num
+
+  first_lba = 1
+  last_lba  = 1
+
+  for i in range(part_num):
+
+    part = partitions.part_list[i]
+
+    if i >= primaries:
+      if i == primaries:
+        # Skip the EBR sectors
+        last_lba += part_num - primaries
+      first_lba = last_lba
+    else:
+      if part.first_lba_in_kb > 0:
+        first_lba = pt.kb2sectors(part.first_lba_in_kb)
+      if clamp is False:
+        if part.first_lba_in_kb <= 0:
+          first_lba = last_lba
+      elif first_lba < last_lba:
+        first_lba = last_lba
+
+    # Partitions placed after their predecessor start on the boundary of
+    # their alignment policy, a first_lba_in_kb is kept as given.
+    part.padding_in_sec = 0
+    if i >= primaries or part.first_lba_in_kb <= 0:
+      aligned_lba = pt.align_lba(first_lba,
+                                 partitions.instructions.alignment_in_sec(part))
+      part.padding_in_sec = aligned_lba - first_lba
+      first_lba = aligned_lba
+
+    last_lba = first_lba + part.size_in_sec
+    lbas.append((first_lba, last_lba - 1))
+
+  return lbas
+
 class Entry(object):
 
   def __init__(self):
@@ -33,32 +91,23 @@ class Entry(object):
     self.first_lba             = 0x00000000
     self.num_sectors           = 0x00000000
 
-    self.array = [0] * 16
+    self.array = bytearray(ENTRY.size)
 
   def toarray(self):
-
-    self.array[0] = self.bootable;
-    self.array[1] = self.first_sector_head;
-    self.array[2] = self.first_sector_sec_cy;
-    self.array[3] = self.first_sector_cylinder;
-    self.array[4] = self.part_type;
-    self.array[5] = self.last_sector_head;
-    self.array[6] = self.last_sector_sec_cy;
-    self.array[7] = self.last_sector_cylinder;
-
-    i = 8
-    for b in range(4):
-      self.array[i] = (self.first_lba >> (b * 8)) & 0xFF
-      i += 1
-
-    i = 12
-    for b in range(4):
-      self.array[i] = (self.num_sectors >> (b * 8)) & 0xFF
-      i += 1
+    ENTRY.pack_into(self.array, 0,
+                    self.bootable, self.first_sector_head,
+                    self.first_sector_sec_cy, self.first_sector_cylinder,
+                    self.part_type, self.last_sector_head,
+                    self.last_sector_sec_cy, self.last_sector_cylinder,
+                    self.first_lba & 0xFFFFFFFF,
+                    self.num_sectors & 0xFFFFFFFF)
 
 class MBR(object):
 
-  def __init__(self):
+  def __init__(self, partitions=PARTITIONS, instructions=INSTRUCTIONS):
+    self.partitions   = partitions
+    self.instructions = instructions
+
     self.code_start        = 0x0
     self.signature_start   = 0x1B8  # 440
     self.reserve_start     = 0x1BC  # 444
@@ -73,7 +122,7 @@ class MBR(object):
     self.magic_0     = 0x55
     self.magic_1     = 0xAA
 
-    self.array = [0] * 512
+    self.array = bytearray(512)
 
   def binfile2code(self, filename):
     if filename is None:
@@ -83,68 +132,51 @@ class MBR(object):
     if file_size != 440 and file_size != 446:
       BUG.error("Invalid boot code file (%s) for MBR" % filename)
 
-    self.code = [0] * file_size
     with open(filename, 'rb') as f:
-      data = f.read(file_size)
-      i = 0
-      for b in data:
-        self.code[i] = ord(b); i += 1
-      f.close()
+      self.code = bytearray(f.read(file_size))
 
   def add_entry(self, entry):
     self.entry_array.append(entry)
 
   def toarray(self):
-    i = 0
 
     if self.code is not None:
       i = self.code_start
-      for b in self.code:
-        self.array[i] = b
-        i += 1
+      self.array[i:i + len(self.code)] = self.code
 
     if self.signature is not None:
-      i = self.signature_start
-      self.array[i]   = (self.signature >> 24) & 0xFF
-      self.array[i+1] = (self.signature >> 16) & 0xFF
-      self.array[i+2] = (self.signature >> 8)  & 0xFF
-      self.array[i+3] = (self.signature)       & 0xFF
+      struct.pack_into(">I", self.array, self.signature_start,
+                       self.signature & 0xFFFFFFFF)
 
     if self.reserve is not None:
-      i = self.reserve_start
-      self.array[i]   = (self.reserve >> 8) & 0xFF
-      self.array[i+1] = (self.reserve)      & 0xFF
+      struct.pack_into(">H", self.array, self.reserve_start,
+                       self.reserve & 0xFFFF)
 
-    if len(self.entry_array) > 0:
-      i = self.entry_array_start
-      for entry in self.entry_array:
-        for b in entry.array:
-          self.array[i] = b
-          i += 1
+    i = self.entry_array_start
+    for entry in self.entry_array:
+      self.array[i:i + len(entry.array)] = entry.array
+      i += len(entry.array)
 
     self.array[self.magic_0_start] = self.magic_0
     self.array[self.magic_1_start] = self.magic_1
 
   def init_partition_table(self, part_num, needs_ebr):
 
-    kb_per_bulk = INSTRUCTIONS.WRITE_PROTECT_BULK_SIZE_IN_KB
+    kb_per_bulk = self.instructions.WRITE_PROTECT_BULK_SIZE_IN_KB
     sectors_per_bulk = pt.kb2sectors(kb_per_bulk)
 
+    lbas = place_partitions(self.partitions)
+
     first_lba = 1
     last_lba  = 1
 
     for i in range(part_num):
 
-      part = PARTITIONS.part_list[i]
-      last_wp_chunk = PARTITIONS.wp_chunk_list[-1]
-
-      if part.first_lba_in_kb > 0:
-        first_lba = pt.kb2sectors(part.first_lba_in_kb)
-      if first_lba < last_lba:
-        first_lba = last_lba
+      part = self.partitions.part_list[i]
+      first_lba = lbas[i][0]
 
       part.readonly = True
-      PARTITIONS.update_wp_chunk_list(first_lba, part.size_in_sec, sectors_per_bulk)
+      self.partitions.update_wp_chunk_list(first_lba, part.size_in_sec, sectors_per_bulk)
 
       entry = Entry()
       if part.bootable is True:
@@ -159,7 +191,7 @@ class MBR(object):
 
       last_lba = first_lba + part.size_in_sec
 
-      print "* %-10s: %-8i ~ %8i" % (part.label, first_lba, last_lba)
+      print("* %-10s: %-8i ~ %8i" % (part.label, first_lba, last_lba))
 
     if needs_ebr is True:
       entry = Entry()
@@ -175,41 +207,39 @@ class MBR(object):
   def create(self, output_directory, boot_file, part_num, needs_ebr):
 
     self.binfile2code(boot_file)
-    self.signature = INSTRUCTIONS.DISK_SIGNATURE
+    self.signature = self.instructions.DISK_SIGNATURE
     (first_lba, last_lba) = self.init_partition_table(part_num, needs_ebr)
     self.toarray()
 
     image_file = "%s/MBR.bin" % output_directory
     BUG.green("Create %s <-- Master Boot Recorder" % image_file)
-    with open(image_file, 'wb') as f:
-      for b in self.array:
-        f.write(struct.pack('B', b))
-      f.close()
+    with hashio.open_output(image_file) as f:
+      f.write(self.array)
 
     return (first_lba, last_lba)
 
 class EBR(object):
 
-  def __init__(self):
+  def __init__(self, partitions=PARTITIONS, instructions=INSTRUCTIONS):
+    self.partitions   = partitions
+    self.instructions = instructions
     self.items = []
 
   def create(self, output_directory, part_num, start_lba):
-    print "About to make EBR: %i" % start_lba
+    print("About to make EBR: %i" % start_lba)
 
     ebr_offset = 0
-    first_lba = last_lba = (start_lba + part_num - 3)
 
-    kb_per_bulk = INSTRUCTIONS.WRITE_PROTECT_BULK_SIZE_IN_KB
-    sectors_per_bulk = pt.kb2sectors(kb_per_bulk)
-    for i in range(3, part_num):
-      part = PARTITIONS.part_list[i]
-      last_wp_chunk = PARTITIONS.wp_chunk_list[-1]
+    lbas = place_partitions(self.partitions)
 
-      if first_lba < last_lba:
-        first_lba = last_lba
+    kb_per_bulk = self.instructions.WRITE_PROTECT_BULK_SIZE_IN_KB
+    sectors_per_bulk = pt.kb2sectors(kb_per_bulk)
+    for i in range(PRIMARY_PARTITIONS, part_num):
+      part = self.partitions.part_list[i]
+      first_lba = lbas[i][0]
 
       part.readonly = True
-      PARTITIONS.update_wp_chunk_list(first_lba, part.size_in_sec, sectors_per_bulk)
+      self.partitions.update_wp_chunk_list(first_lba, part.size_in_sec, sectors_per_bulk)
 
       entry1 = Entry()
       if part.bootable is True:
@@ -225,13 +255,13 @@ class EBR(object):
 
       last_lba = first_lba + part.size_in_sec
 
-      print "* %-10s: %-8i ~ %8i" % (part.label, first_lba, last_lba)
+      print("* %-10s: %-8i ~ %8i" % (part.label, first_lba, last_lba))
 
       entry2 = Entry()
       if i < (part_num - 1):
         entry2.bootable  = 0x00
         entry2.part_type = 0x05
-        entry2.first_lba = i - 2
+        entry2.first_lba = i - PRIMARY_PARTITIONS + 1
         entry2.num_sectors = 1
       entry2.toarray()
       mbr.add_entry(entry2)
@@ -247,24 +277,29 @@ class EBR(object):
 
     image_file = "%s/EBR.bin" % output_directory
     BUG.green("Create %s <-- Extented Boot Recorder" % image_file)
-    with open(image_file, 'wb') as f:
+    with hashio.open_output(image_file) as f:
       for e in self.items:
-        for b in e.array:
-          f.write(struct.pack('B', b))
-      f.close()
+        f.write(e.array)
 
 class MBRPartitionTable(object):
 
-  def __init__(self):
-    self.mbr = MBR()
-    self.ebr = EBR()
+  def __init__(self, partitions=PARTITIONS, instructions=INSTRUCTIONS):
+    self.partitions   = partitions
+    self.instructions = instructions
+    self.mbr = MBR(partitions, instructions)
+    self.ebr = EBR(partitions, instructions)
 
   def create(self, output_directory, boot_file):
-    part_num = len(PARTITIONS.part_list)
+    part_num = len(self.partitions.part_list)
     if part_num <= 4:
-      print "We can get away with only an MBR"
+      print("We can get away with only an MBR")
       self.mbr.create(output_directory, boot_file, part_num, False)
     else:
-      print "We will need an MBR and %d EBRS" % (part_num - 3)
-      (first_lba, last_lba) = self.mbr.create(output_directory, boot_file, 3, True)
+      print("We will need an MBR and %d EBRS" % (part_num - PRIMARY_PARTITIONS))
+      (first_lba, last_lba) = self.mbr.create(output_directory, boot_file,
+                                              PRIMARY_PARTITIONS, True)
       self.ebr.create(output_directory, part_num, last_lba)
+
+    padding = pt.padding_report(self.partitions.part_list)
+    if padding is not None:
+      print(padding)
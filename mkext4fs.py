@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given a root directory, or a tar of it (compressed or not), produces an
+image with ext4 filesystem. Otherwise print usages.
+
+The built-in writer reads a tar as it writes the image, without
+extracting it. The external tool is given a temporary extracted tree.
+
+Usage: mkext4fs [flags] root_directory|tar image_file
+
+  -s  (--size) <image_size>
+      The size of image.
+
+  -m  (--mount-point) <mount point>
+      The mount point of the special partition with image.
+
+  -T  (--timestamp) <timestamp>
+      The timestamp of image.
+
+  -l  (--label) <label>
+      The label of image.
+
+  -Z  (--gzip)
+      Generate image with gzip compressed.
+
+  -S  (--sparse)
+      Generate image with sparse file.
+
+  -C  (--crc)
+      Generate image with crc checksum.
+
+  -J  (--no-journal)
+      Generate image without journal.
+
+  -x  (--xml) <partition.xml>
+  -p  (--partition) <label>
+      Take the size of image from the partition with label in the partition
+      XML, an image of a read-only partition has no journal.
+
+  -b  (--builtin)
+      Build the image without the external mkext4fs tool, which is also
+      done when there is no such tool.
+
+  -B  (--bmap)
+      Write the block map (bmaptool format) of the image next to it as
+      image_file.bmap. Not for sparse or gzip compressed images.
+
+  -H  (--headroom) <size>
+      The free space (e.g. 16M, or 10% of the used space) left in an
+      image sized to fit: without a size, or with -R.
+
+  -R  (--shrink)
+      Trim the image to its used size plus the headroom, whatever its
+      size. The built-in writer lays it out so, an image of the mkext4fs
+      tool is shrunk with resize2fs after the build (not for sparse or
+      gzip compressed images).
+
+  -z  (--sizes) <file>
+      Record the size of the image in file, as <image name>=<bytes>, the
+      image name being the filename of the partition with -p. mkpart -z
+      sizes partitions to fit the images recorded there.
+
+  -M  (--manifest) <file>
+      Record the sha256, md5 and crc32 of the image in the JSON file,
+      computed while the built-in writer writes it (see hashio.py).
+
+"""
+
+import os
+import sys
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.image_size = None
+OPTIONS.mount_point = None
+OPTIONS.timestamp = None
+OPTIONS.label = None
+OPTIONS.gzip = False
+OPTIONS.sparse = False
+OPTIONS.crc = False
+OPTIONS.journal = True
+OPTIONS.xml = None
+OPTIONS.partition = None
+OPTIONS.builtin = False
+OPTIONS.bmap = False
+OPTIONS.headroom = None
+OPTIONS.shrink = False
+OPTIONS.sizes = None
+OPTIONS.image_name = None
+OPTIONS.manifest = None
+
+def findTool(name):
+  """Return the path of the external tool name in PATH, None if there is
+  none other than this script."""
+  this = os.path.splitext(os.path.realpath(__file__))[0]
+  for d in os.environ.get("PATH", "").split(os.pathsep):
+    path = os.path.join(d, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK) and \
+       os.path.splitext(os.path.realpath(path))[0] != this:
+      return path
+  return None
+
+def usePartition(xml, label):
+  """Set the image size, and drop the journal of a read-only partition,
+  from the partition with label in xml."""
+  import parser
+  import pt
+
+  parser.PARSER.xml2object(xml)
+  for partitions in pt.PHYSICAL_PARTITIONS:
+    found = [p for p in partitions.part_list if p.label == label]
+    if len(found) > 0:
+      part = found[0]
+      break
+  else:
+    raise RuntimeError("no partition \"%s\" in %s" % (label, xml))
+
+  if OPTIONS.image_size is None:
+    OPTIONS.image_size = str(part.size_in_kb * 1024)
+  if part.readonly is True:
+    OPTIONS.journal = False
+  if part.filename != "":
+    OPTIONS.image_name = part.filename
+
+def gzipImage(image):
+  import gzip
+  import shutil
+
+  import hashio
+
+  tmp = image + ".tmp"
+  os.rename(image, tmp)
+  with open(tmp, "rb") as src, hashio.open_output(image) as out:
+    with gzip.GzipFile(image, "wb", fileobj=out, mtime=0) as dst:
+      shutil.copyfileobj(src, dst, 1024 * 1024)
+  os.unlink(tmp)
+
+def runTool(cmd, what):
+  try:
+    p = common.run(cmd)
+  except Exception as e:
+    print("Error: Unable to execute command: {}".format(' '.join(cmd)))
+    raise e
+
+  p.wait()
+  assert p.returncode == 0, "%s failed" % what
+
+def readSuperblock(image):
+  """Return (blocks, free blocks, block size) of the ext4 image."""
+  import struct
+
+  with open(image, "rb") as f:
+    f.seek(1024)
+    (inodes, blocks, reserved, free, free_inodes, first_data_block,
+     log_block_size) = struct.unpack("<7I", f.read(28))
+  return (blocks, free, 1024 << log_block_size)
+
+def shrinkImage(image):
+  """Shrink the raw ext4 image to its used blocks plus OPTIONS.headroom
+  with resize2fs, and return its size."""
+  runTool(["resize2fs", "-M", image], "resize2fs")
+  blocks, free, block_size = readSuperblock(image)
+  used = blocks - free
+  headroom = common.parseHeadroom(OPTIONS.headroom, used * block_size)
+  if headroom > free * block_size:
+    blocks += -(-(headroom - free * block_size) // block_size)
+    runTool(["resize2fs", image, "%dK" % (blocks * block_size // 1024)],
+            "resize2fs")
+  with open(image, "r+b") as f:
+    f.truncate(blocks * block_size)
+  return blocks * block_size
+
+def makeBuiltinExt4Fs(input_directory, output_file):
+  import ext4
+
+  size = None
+  if OPTIONS.image_size is not None and OPTIONS.shrink is False:
+    size = common.parseSize(OPTIONS.image_size)
+  timestamp = None
+  if OPTIONS.timestamp is not None:
+    timestamp = int(OPTIONS.timestamp)
+
+  image = ext4.make_image(input_directory, output_file, size,
+                          OPTIONS.label, OPTIONS.mount_point, timestamp,
+                          OPTIONS.journal, OPTIONS.sparse, OPTIONS.crc,
+                          OPTIONS.headroom)
+  if OPTIONS.gzip is True:
+    gzipImage(output_file)
+
+  print("Created %s: %d blocks, %d inodes, journal %d blocks"
+    % (output_file, image.blocks_count,
+       image.inodes_per_group * len(image.groups), image.journal_blocks))
+  return image.blocks_count * ext4.BLOCK_SIZE
+
+def makeExt4Fs(input_directory, output_file):
+  """Make an image to output_file from input_directory with OPTIONS.
+
+  Args:
+    input_directory: path of input directory, or of a tar of it.
+    output_file: path of the output image file.
+
+  Returns:
+    The size of the image in bytes (expanded, if it's sparse).
+  """
+
+  tool = findTool("mkext4fs")
+  if OPTIONS.builtin is True or tool is None:
+    return makeBuiltinExt4Fs(input_directory, output_file)
+
+  image_size = OPTIONS.image_size
+  shrink = OPTIONS.shrink
+  if image_size is None or \
+     (shrink is True and (OPTIONS.sparse is True or OPTIONS.gzip is True)):
+    # The tool can't size the image itself, and sparse or compressed
+    # images can't be shrunk after the build: size it from a layout of
+    # the tree by the built-in writer.
+    import ext4
+    image_size = str(ext4.min_size(input_directory, OPTIONS.journal,
+                                   OPTIONS.headroom))
+    shrink = False
+
+  cmd = [tool]
+  if image_size is not None:
+    cmd.extend(["-s", image_size])
+  if OPTIONS.mount_point is not None:
+    cmd.extend(["-m", OPTIONS.mount_point])
+  if OPTIONS.timestamp is not None:
+    cmd.extend(["-T", OPTIONS.timestamp])
+  if OPTIONS.label is not None:
+    cmd.extend(["-l", OPTIONS.label])
+  if OPTIONS.gzip is True:
+    cmd.append("-Z")
+  if OPTIONS.sparse is True:
+    cmd.append("-S")
+  if OPTIONS.crc is True:
+    cmd.append("-C")
+  if OPTIONS.journal is False:
+    cmd.append("-J")
+
+  tree = None
+  if common.isTar(input_directory):
+    import tempfile
+    # The tool reads trees only.
+    tree = tempfile.mkdtemp(prefix=".mkext4fs.",
+                            dir=os.path.dirname(os.path.abspath(output_file)))
+  try:
+    if tree is not None:
+      common.extractTar(input_directory, tree)
+    cmd.append(tree or input_directory)
+    cmd.append(output_file)
+    runTool(cmd, "mkext4fs")
+  finally:
+    if tree is not None:
+      import shutil
+      shutil.rmtree(tree)
+
+  if shrink is True:
+    size = shrinkImage(output_file)
+  elif OPTIONS.gzip is True:
+    size = common.parseSize(image_size)
+  else:
+    import assemble
+    size = assemble.payload_size(output_file)
+  # Written by the tool, it's hashed reading it back.
+  import hashio
+  hashio.record_file(output_file)
+  return size
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-s", "--size"):
+      OPTIONS.image_size = arg
+    elif opt in ("-m", "--mount-point"):
+      OPTIONS.mount_point = arg
+    elif opt in ("-T", "--timestamp"):
+      OPTIONS.timestamp = arg
+    elif opt in ("-l", "--label"):
+      OPTIONS.label = arg
+    elif opt in ("-Z", "--gzip"):
+      OPTIONS.gzip = True
+    elif opt in ("-S", "--sparse"):
+      OPTIONS.sparse = True
+    elif opt in ("-C", "--crc"):
+      OPTIONS.crc = True
+    elif opt in ("-J", "--no-journal"):
+      OPTIONS.journal = False
+    elif opt in ("-x", "--xml"):
+      OPTIONS.xml = arg
+    elif opt in ("-p", "--partition"):
+      OPTIONS.partition = arg
+    elif opt in ("-b", "--builtin"):
+      OPTIONS.builtin = True
+    elif opt in ("-B", "--bmap"):
+      OPTIONS.bmap = True
+    elif opt in ("-H", "--headroom"):
+      OPTIONS.headroom = arg
+    elif opt in ("-R", "--shrink"):
+      OPTIONS.shrink = True
+    elif opt in ("-z", "--sizes"):
+      OPTIONS.sizes = arg
+    elif opt in ("-M", "--manifest"):
+      OPTIONS.manifest = arg
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="s:m:T:l:ZSCJx:p:bBH:Rz:M:",
+                             extra_long_opts=[
+                               "size=",
+                               "mount-point=",
+                               "timestamp=",
+                               "label=",
+                               "gzip",
+                               "sparse",
+                               "crc",
+                               "no-journal",
+                               "xml=",
+                               "partition=",
+                               "builtin",
+                               "bmap",
+                               "headroom=",
+                               "shrink",
+                               "sizes=",
+                               "manifest=",
+                             ],
+                             extra_option_handler=option_handler)
+  if len(args) != 2 or (OPTIONS.xml is None) != (OPTIONS.partition is None):
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.bmap is True and (OPTIONS.sparse is True or OPTIONS.gzip is True):
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.xml is not None:
+    usePartition(OPTIONS.xml, OPTIONS.partition)
+
+  if OPTIONS.manifest is not None:
+    import hashio
+    hashio.enable(OPTIONS.manifest)
+
+  size = makeExt4Fs(args[0], args[1])
+
+  if OPTIONS.sizes is not None:
+    name = OPTIONS.image_name or os.path.basename(args[1])
+    common.recordSize(OPTIONS.sizes, name, size)
+    print("Recorded %s=%d in %s" % (name, size, OPTIONS.sizes))
+
+  if OPTIONS.bmap is True:
+    import bmap
+    print("Created %s" % bmap.write_bmap(args[1]))
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given a partition xml, produces an image with special partition table.
+If the xml has several physical_partition tags (e.g. the LUNs of a UFS
+device), the GPT images of each of them are made concurrently and named
+gpt_main<N>.bin, gpt_backup<N>.bin and gpt_both<N>.bin.
+
+Usage: mkpart [flags] partition.xml
+
+  -x  (--xml) <partition.xml>
+      The partition XML file for descript partition table.
+
+  -t  (--type) <partition table type>
+      The partition table type.
+
+  -o  (--output) <output directory>
+      The output directory of image files.
+
+  -b  (--mbr-boot)
+      The flag add boot code for MBR. Only for MBR
+
+  -g  (--sequential-guid)
+      The flag of sequential guid. Only for GPT
+
+  -s  (--guid-seed) <seed>
+      The seed of the disk and partition GUIDs, which are derived from it
+      and the layout, so that the same XML always gives the same tables.
+      Only for GPT
+
+  -r  (--random-guid)
+      The flag of random disk and partition GUIDs, the tables differ on
+      every run. Only for GPT
+
+  -a  (--all-128partitions)
+      The flag was set, will be use all of 128 partitions to count crc23
+      for entry array. Only for GPT
+
+  -i  (--images) <image directory>
+      The directory of the payloads (filename) of the partitions. They
+      are checked to fit their partitions first, from their sizes and
+      sparse headers only (see validate.check_payloads()).
+
+  -V  (--verity)
+      Build the dm-verity hash tree of the payload of every read-only
+      partition, write it and its metadata as <label>_verity.bin and
+      <label>_verity.txt, and grow the partition if needed to hold both
+      the payload and the tree. Needs -i.
+
+  -D  (--disk) <disk image>
+      Assemble a disk image of the tables and the payloads, a payload of
+      several partitions (A/B slots) is written once and cloned. The disk
+      has the device size (-d), or just the size of the partitions. Only
+      for GPT. An interrupted assembly is resumed by the next run for the
+      same layout, from <disk image>.journal (see assemble.py).
+
+  -B  (--bmap)
+      Write the block map (bmaptool format) of every disk image next to it
+      as <disk image>.bmap, for "bmap" to copy only its data. Needs -D.
+
+  -c  (--check)
+      Only check the layout, print its problems and exit with 1 if there
+      are errors. Without it problems are printed before making the tables.
+
+  -d  (--device-size) <size>
+      The size of the device (e.g. 7818182656, 3728M or 4G), partitions
+      are also checked against its end (of each physical partition).
+
+  -A  (--alignment) <size>
+      The boundary (e.g. 4M) every partition is checked to start on,
+      instead of the boundary of its alignment policy.
+
+  -O  (--optimize)
+      Reorder the partitions of GPT layouts to save write protect padding,
+      as OPTIMIZE_READONLY_PARTITIONS=true does (see planner.py).
+      Partitions with pin="true" keep their position.
+
+  -z  (--sizes) <file>
+      The image sizes recorded by mkext4fs -z and mkvfatfs -z: partitions
+      whose filename is there are sized to fit it (growing partitions of
+      size 0 are left alone).
+
+  -M  (--manifest) <file>
+      Record the sha256, md5 and crc32 of every file written (tables,
+      hash trees, disk image and its partitions) in the JSON file,
+      computed while they are written (see hashio.py).
+
+"""
+
+import os
+import sys
+
+from io import StringIO
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.xml = None
+OPTIONS.part_type = None
+OPTIONS.output_directory = None
+# Only MBR
+OPTIONS.MBR_boot = None
+# Only GPT
+OPTIONS.sequential_guid = False
+OPTIONS.guid_seed = ""
+OPTIONS.random_guid = False
+OPTIONS.all_128_partitions = False
+OPTIONS.images = None
+OPTIONS.verity = False
+OPTIONS.disk_image = None
+OPTIONS.bmap = False
+OPTIONS.sizes = None
+OPTIONS.optimize = False
+OPTIONS.manifest = None
+# Checks
+OPTIONS.check_only = False
+OPTIONS.device_size = None
+OPTIONS.alignment = 0
+
+def fitSizes(physical_partitions, sizes):
+  """Size the partitions to the images recorded in sizes, a dict of
+  filename -> bytes, before any hash tree is added."""
+  import pt
+
+  for partitions in physical_partitions:
+    for part in partitions.part_list:
+      if part.filename not in sizes or part.size_in_kb == 0:
+        continue
+      size_in_kb = (sizes[part.filename] + 1023) // 1024
+      if part.size_in_kb != size_in_kb:
+        print("%s: sized from %dKB to %dKB to fit %s"
+          % (part.label, part.size_in_kb, size_in_kb, part.filename))
+        part.size_in_kb  = size_in_kb
+        part.size_in_sec = pt.kb2sectors(size_in_kb)
+
+def makeVerityTrees(physical_partitions):
+  """Build the dm-verity trees of the read-only partitions whose payload
+  is in OPTIONS.images, growing the partitions to fit them. Both slots of
+  an A/B partition get the same tree."""
+  import hashlib
+  import hashio
+  import pt
+  import sparse
+  import verity
+
+  trees = {}
+
+  for partitions in physical_partitions:
+    for part in partitions.part_list:
+      if part.readonly is False or part.filename == "":
+        continue
+      payload = os.path.join(OPTIONS.images, part.filename)
+      if not os.path.isfile(payload):
+        print("%s: no payload %s, no hash tree" % (part.label, payload))
+        continue
+      if sparse.is_sparse(payload):
+        print("%s: %s is a sparse image, no hash tree" % (part.label, payload))
+        continue
+
+      name = part.label
+      if part.slot != "":
+        name = part.label[:-len(part.slot) - 1]
+      tree = trees.get((payload, name))
+      if tree is None:
+        if OPTIONS.random_guid is True:
+          salt = os.urandom(32)
+        else:
+          salt = hashlib.sha256(":".join([common.GUID_NAMESPACE,
+                                          OPTIONS.guid_seed,
+                                          name]).encode("utf-8")).digest()
+        tree = trees[(payload, name)] = verity.build(payload, salt)
+      if tree is None:
+        continue
+
+      prefix = os.path.join(OPTIONS.output_directory, "%s_verity" % part.label)
+      with hashio.open_output(prefix + ".bin") as f:
+        f.write(tree.tree)
+      tree.write_metadata(prefix + ".txt", part.label, part.filename)
+      part.verity = tree
+
+      size_in_kb = (tree.hash_offset() + len(tree.tree) + 1023) // 1024
+      if part.size_in_kb < size_in_kb:
+        print("%s: grown from %dKB to %dKB for payload and hash tree"
+          % (part.label, part.size_in_kb, size_in_kb))
+        part.size_in_kb  = size_in_kb
+        part.size_in_sec = pt.kb2sectors(size_in_kb)
+      pt.BUG.green("Create %s.bin <-- dm-verity hash tree of %s, root hash %s"
+                   % (prefix, part.label, verity.hexlify(tree.root_hash)))
+
+def diskImage(lun):
+  """Return the name of the disk image of physical partition lun, numbered
+  like the tables if there are several of them."""
+  if lun is None:
+    return OPTIONS.disk_image
+  root, ext = os.path.splitext(OPTIONS.disk_image)
+  return "%s%d%s" % (root, lun, ext)
+
+def diskSectors(partitions):
+  """Return the sectors of the disk image of partitions: the device size,
+  or just enough for the partitions and the Secondary GPT."""
+  import pt
+  import validate
+
+  if OPTIONS.device_size is not None:
+    return OPTIONS.device_size // pt.BYTES_PER_SECTOR
+  if partitions.instructions.AUTO_GROW_LAST_PARTITION is True:
+    pt.BUG.error("The device size (-d) is needed to assemble a disk image "
+                 "with an auto-grown last partition.")
+  spans = validate.place_partitions(partitions, partitions.instructions)
+  return max([last for first, last, part in spans]) + 1 + \
+         validate.GPT_BACKUP_SECTORS
+
+def makeGPTTables(partitions, lun=None):
+  """Make the GPT images of partitions, and the disk image with -D."""
+  import gpt
+  import assemble
+
+  disk_sectors = None
+  if OPTIONS.disk_image is not None:
+    disk_sectors = diskSectors(partitions)
+  table = gpt.GPTPartitionTable(partitions, partitions.instructions, lun,
+                                disk_sectors)
+  table.create(OPTIONS.output_directory)
+  if OPTIONS.disk_image is not None:
+    extents = assemble.assemble(table, OPTIONS.images, diskImage(lun))
+    if OPTIONS.bmap is True:
+      import bmap
+      import pt
+      # Only the extents of the tables and payloads are looked at.
+      bmap_file = bmap.write_bmap(diskImage(lun), hints=extents)
+      pt.BUG.green("Create %s <-- Block map of the disk image" % bmap_file)
+
+def makeGPT(job):
+  """Make the GPT images of a physical partition in a worker process, job
+  being (lun, its Partitions, the values of OPTIONS): a worker started by
+  spawn or forkserver has none of the parent's globals. Returns the exit
+  status and what was printed, so that the tables of all physical
+  partitions are listed in order."""
+  lun, partitions, options = job
+  OPTIONS.__dict__.update(options)
+  if OPTIONS.manifest is not None:
+    import hashio
+    hashio.enable(OPTIONS.manifest)
+
+  stdout = sys.stdout
+  sys.stdout = output = StringIO()
+  status = 0
+  try:
+    print("Making GUID Partition table (GPT) of physical partition %d. "
+      "%d partitions ...\n" % (lun, len(partitions.part_list)))
+    makeGPTTables(partitions, lun)
+  except SystemExit as e:
+    # BUG.error() exits, which would leave the pool waiting for the job.
+    status = e.code
+  finally:
+    sys.stdout = stdout
+  return (status, output.getvalue())
+
+def makeGPTs(physical_partitions):
+  """Make the GPT images of physical_partitions concurrently."""
+  import multiprocessing
+
+  jobs = [(lun, partitions, dict(vars(OPTIONS)))
+          for lun, partitions in enumerate(physical_partitions)]
+  processes = min(len(jobs), multiprocessing.cpu_count())
+  pool = multiprocessing.Pool(processes)
+  try:
+    results = pool.map(makeGPT, jobs)
+  finally:
+    pool.close()
+    pool.join()
+
+  failed = False
+  for status, output in results:
+    sys.stdout.write(output)
+    if status:
+      failed = True
+  if failed:
+    sys.exit(1)
+
+def make(xml):
+  """Create a partition table image with the file in the provided
+  partition.xml. image is the name of partition table."""
+
+  # The table modules are only needed once there is work to do, keep
+  # them out of the way of "-h" and option errors.
+  import parser
+  import pt
+  import mbr
+  import validate
+
+  PARSER     = parser.PARSER
+  PARTITIONS = pt.PARTITIONS
+  BUG        = pt.BUG
+
+  PHYSICAL_PARTITIONS = pt.PHYSICAL_PARTITIONS
+
+  PARTITIONS._type = OPTIONS.part_type
+
+  PARSER.xml2object(xml)
+
+  if OPTIONS.sizes is not None:
+    fitSizes(PHYSICAL_PARTITIONS, common.readSizes(OPTIONS.sizes))
+
+  if OPTIONS.images is not None:
+    # Fail before hash trees and disk images take their time.
+    errors = False
+    for lun, partitions in enumerate(PHYSICAL_PARTITIONS):
+      diagnostics = validate.check_payloads(partitions, OPTIONS.images,
+                                            OPTIONS.device_size,
+                                            OPTIONS.verity)
+      for d in diagnostics:
+        if len(PHYSICAL_PARTITIONS) > 1:
+          print("LUN %d: %s" % (lun, d))
+        else:
+          print(d)
+      errors = errors or validate.has_errors(diagnostics)
+    if errors:
+      BUG.error("Payloads don't fit their partitions.")
+
+  if OPTIONS.verity is True:
+    makeVerityTrees(PHYSICAL_PARTITIONS)
+
+  for lun, partitions in enumerate(PHYSICAL_PARTITIONS):
+    if OPTIONS.optimize is True or \
+       partitions.instructions.OPTIMIZE_READONLY_PARTITIONS is True:
+      if partitions._type is not partitions.GPT_TYPE:
+        # BUG.warn() exits, the flag does nothing on MBR layouts.
+        print("| Only GPT layouts are reordered, skipping LUN %d" % lun)
+        continue
+      import planner
+      print("Planning the order of physical partition %d ..." % lun)
+      planner.optimize(partitions, partitions.instructions)
+
+  count = len(PHYSICAL_PARTITIONS)
+  errors = False
+  problems = 0
+  for lun in range(count):
+    partitions = PHYSICAL_PARTITIONS[lun]
+    diagnostics = validate.validate(partitions, partitions.instructions,
+                                    OPTIONS.device_size,
+                                    OPTIONS.alignment // 1024)
+    for d in diagnostics:
+      if count > 1:
+        print("LUN %d: %s" % (lun, d))
+      else:
+        print(d)
+    errors = errors or validate.has_errors(diagnostics)
+    problems += len(diagnostics)
+
+  if OPTIONS.check_only is True:
+    if errors:
+      sys.exit(1)
+    print("Layout of %d partitions checked, %d problems."
+      % (sum([len(p.part_list) for p in PHYSICAL_PARTITIONS]), problems))
+    return
+
+  if count > 1:
+    for partitions in PHYSICAL_PARTITIONS:
+      if partitions._type is not partitions.GPT_TYPE:
+        BUG.error("Multiple physical partitions are only supported for GPT.")
+    print("%d physical partitions discovered in XML file, output will be GPT ..."
+      % count)
+    makeGPTs(PHYSICAL_PARTITIONS)
+
+  elif PARTITIONS._type is PARTITIONS.GPT_TYPE:
+    print("GPT GUID discovered in XML file, output will be GPT ...")
+    print("Making GUID Partition table (GPT). %d partitions ...\n"
+      % len(PARTITIONS.part_list))
+
+    makeGPTTables(PARTITIONS)
+
+  elif PARTITIONS._type is PARTITIONS.MBR_TYPE:
+    if OPTIONS.disk_image is not None:
+      BUG.error("Disk images (-D) are only supported for GPT.")
+    print("MBR TYPE discovered in XML file, output will be MBR ...")
+    print("Making MBR Partition table (MBR). %d partitions ...\n"
+      % len(PARTITIONS.part_list))
+
+    MY_MBR_PARTITION_TABLE = mbr.MBRPartitionTable(PARTITIONS,
+                                                   PARTITIONS.instructions)
+    MY_MBR_PARTITION_TABLE.create(OPTIONS.output_directory, OPTIONS.MBR_boot)
+
+  else:
+    BUG.error("Invalidate the type of partition table (%s)." % PARTITIONS._type)
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-x", "--xml"):
+      OPTIONS.xml = arg
+    elif opt in ("-t", "--type"):
+      OPTIONS.part_type = arg
+    elif opt in ("-o", "--output"):
+      OPTIONS.output_directory = arg
+    elif opt in ("-b", "--mbr-boot"):
+      OPTIONS.MBR_boot = arg
+    elif opt in ("-g", "--sequential-guid"):
+      OPTIONS.sequential_guid = True
+    elif opt in ("-s", "--guid-seed"):
+      OPTIONS.guid_seed = arg
+    elif opt in ("-r", "--random-guid"):
+      OPTIONS.random_guid = True
+    elif opt in ("-a", "--all-128partitions"):
+      OPTIONS.all_128_partitions = True
+    elif opt in ("-i", "--images"):
+      OPTIONS.images = arg
+    elif opt in ("-V", "--verity"):
+      OPTIONS.verity = True
+    elif opt in ("-D", "--disk"):
+      OPTIONS.disk_image = arg
+    elif opt in ("-B", "--bmap"):
+      OPTIONS.bmap = True
+    elif opt in ("-c", "--check"):
+      OPTIONS.check_only = True
+    elif opt in ("-d", "--device-size"):
+      OPTIONS.device_size = common.parseSize(arg)
+    elif opt in ("-A", "--alignment"):
+      OPTIONS.alignment = common.parseSize(arg)
+    elif opt in ("-z", "--sizes"):
+      OPTIONS.sizes = arg
+    elif opt in ("-O", "--optimize"):
+      OPTIONS.optimize = True
+    elif opt in ("-M", "--manifest"):
+      OPTIONS.manifest = arg
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="x:t:o:b:gs:rai:VD:Bcd:A:z:OM:",
+                             extra_long_opts=[
+                               "xml=",
+                               "type=",
+                               "output=",
+                               "mbr-boot=",
+                               "sequential-guid",
+                               "guid-seed=",
+                               "random-guid",
+                               "all-128partitions",
+                               "images=",
+                               "verity",
+                               "disk=",
+                               "bmap",
+                               "check",
+                               "device-size=",
+                               "alignment=",
+                               "sizes=",
+                               "optimize",
+                               "manifest=",
+                             ],
+                             extra_option_handler=option_handler)
+
+  if len(args) != 0:
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.xml is None:
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.output_directory is None:
+    OPTIONS.output_directory = "./"
+
+  if OPTIONS.verity is True and OPTIONS.images is None:
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.bmap is True and OPTIONS.disk_image is None:
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.manifest is not None:
+    import hashio
+    hashio.enable(OPTIONS.manifest)
+
+  make(OPTIONS.xml)
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given a root directory, or a tar of it (compressed or not), produces an
+image with vfat filesystem. Otherwise print usages.
+
+A tar is sized from its headers, and given to mtools as a temporary
+extracted tree.
+
+Usage: mkvfatfs [flags] root_directory|tar image_file
+
+  -s  (--size) <image_size>
+      The size of image.
+
+  -t  (--title) <title>
+      The title of image.
+
+  -H  (--headroom) <size>
+      The free space (e.g. 1M, or 10% of the used space) left in an
+      image sized to fit, without -s.
+
+  -z  (--sizes) <file>
+      Record the size of the image in file, as <image name>=<bytes>.
+      mkpart -z sizes partitions to fit the images recorded there.
+
+  -M  (--manifest) <file>
+      Record the sha256, md5 and crc32 of the image in the JSON file
+      (see hashio.py).
+
+"""
+
+import os
+import sys
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.image_size = 0
+OPTIONS.image_title = None
+OPTIONS.headroom = None
+OPTIONS.sizes = None
+OPTIONS.manifest = None
+
+SECTOR_SIZE      = 512
+CLUSTER_SECTORS  = 8
+CLUSTER_SIZE     = SECTOR_SIZE * CLUSTER_SECTORS
+DIR_ENTRY_SIZE   = 32
+# Entries of the fixed root directory of FAT12/16 at least, more are
+# given in whole sectors
+ROOT_ENTRIES     = 512
+ROOT_PER_SECTOR  = SECTOR_SIZE // DIR_ENTRY_SIZE
+# Clusters a FAT12 and FAT16 filesystem has fewer of
+FAT12_CLUSTERS   = 4085
+FAT16_CLUSTERS   = 65525
+# Clusters the 32K rounding and the alignment of the data area may add
+SLACK_CLUSTERS   = 16
+
+def putFatFile(image, src_file, dst_file):
+  cmd = ["mcopy", "-s", "-Q", "-i", image, src_file, "::" + dst_file]
+  try:
+    p = common.run(cmd)
+  except Exception as e:
+    print("Error: Unable to execute command: {}".format(' '.join(cmd)))
+    raise e
+
+  p.wait()
+  assert p.returncode == 0, "couldn't insert %s into FAT image" % (src_file)
+
+def dirEntries(name):
+  """Directory entries of name: its short entry, and the long name entries
+  (13 characters each) counted for every name."""
+  return 1 + (len(name) + 12) // 13
+
+def clusters(size):
+  return (size + CLUSTER_SIZE - 1) // CLUSTER_SIZE
+
+def listDirectory(root):
+  """Yield (whether it's root, entry names, sizes of the files) of every
+  directory of the tree at root."""
+  for dpath, dnames, fnames in os.walk(root):
+    sizes = []
+    for name in fnames:
+      abspath = os.path.join(dpath, name)
+      if os.path.exists(abspath):
+        sizes.append(os.path.getsize(abspath))
+    yield (dpath == root, dnames + fnames, sizes)
+
+def listTar(path):
+  """Yield (whether it's the root, entry names, sizes of the files) of
+  every directory of the tar at path, from its headers. Symbolic links
+  count as what they point to within the tar, as mcopy copies them."""
+  import posixpath
+  import tarfile
+
+  dirs = {"": {}}
+  infos = {}
+  with tarfile.open(path, "r:*") as tar:
+    for info in tar:
+      name = posixpath.normpath("/" + info.name).lstrip("/")
+      if name in ("", "."):
+        continue
+      parts = name.split("/")
+      for i in range(1, len(parts)):
+        d = "/".join(parts[:i])
+        if d not in dirs:
+          dirs[d] = {}
+          dirs["/".join(parts[:i - 1])][parts[i - 1]] = d
+      if info.isdir():
+        dirs.setdefault(name, {})
+      infos[name] = info
+      dirs["/".join(parts[:-1])][parts[-1]] = name
+
+  def size(name, depth=0):
+    info = infos.get(name)
+    if info is None or depth > 8:
+      return None
+    if info.issym():
+      target = posixpath.join(posixpath.dirname(name), info.linkname)
+      return size(posixpath.normpath("/" + target).lstrip("/"), depth + 1)
+    if info.islnk():
+      return size(posixpath.normpath("/" + info.linkname).lstrip("/"),
+                  depth + 1)
+    return info.size if info.isreg() else None
+
+  for d, entries in dirs.items():
+    sizes = []
+    for name in entries.values():
+      if name not in dirs and size(name) is not None:
+        sizes.append(size(name))
+    yield (d == "", list(entries.keys()), sizes)
+
+def minVfatSize(root, headroom=None):
+  """Return (size, fat bits, root entries) of the smallest vfat image of
+  4K clusters holding the tree at root (or in the tar root), plus
+  headroom (bytes, or "N%" of the used space). The tree is scanned once.
+  The fixed root directory of FAT12/16 gets more than ROOT_ENTRIES if
+  needed, FAT32 is only used for more clusters than FAT16 has."""
+  data_clusters = 0
+  root_entries = 0
+  listing = listTar(root) if common.isTar(root) else listDirectory(root)
+  for is_root, names, sizes in listing:
+    entries = 0
+    for name in names:
+      entries += dirEntries(name)
+    for size in sizes:
+      data_clusters += clusters(size)
+    if is_root:
+      root_entries = entries
+    else:
+      # ".", ".." and the entries, in a cluster chain
+      data_clusters += clusters((2 + entries) * DIR_ENTRY_SIZE)
+
+  used = data_clusters * CLUSTER_SIZE
+  data_clusters += clusters(common.parseHeadroom(headroom, used))
+
+  count = data_clusters + SLACK_CLUSTERS
+  if count >= FAT16_CLUSTERS:
+    bits = 32
+    # The root directory is a cluster chain.
+    count = max(count + clusters(root_entries * DIR_ENTRY_SIZE),
+                FAT16_CLUSTERS + SLACK_CLUSTERS)
+    reserved = 32
+    root_entries = 0
+  else:
+    bits = 12 if count < FAT12_CLUSTERS else 16
+    reserved = 1
+    root_entries = max(ROOT_ENTRIES, root_entries)
+    root_entries = -(-root_entries // ROOT_PER_SECTOR) * ROOT_PER_SECTOR
+  root_sectors = root_entries // ROOT_PER_SECTOR
+
+  fat_sectors = ((count + 2) * bits // 8 + SECTOR_SIZE) // SECTOR_SIZE
+  sectors = reserved + 2 * fat_sectors + root_sectors + \
+            count * CLUSTER_SECTORS
+  return (sectors * SECTOR_SIZE, bits, root_entries)
+
+def makeVfatFs(root, image, size=0, title="boot", headroom=None):
+  """Create a vfat filesystem image with all the files in the provided
+  root directory (or tar). The size of the system, if not provided by the caller,
+  is the smallest holding the files plus headroom. Returns the size."""
+  cmd = ["mkdosfs"]
+  if size == 0:
+    size, bits, root_entries = minVfatSize(root, headroom)
+    cmd.extend(["-F", str(bits), "-S", str(SECTOR_SIZE),
+                "-s", str(CLUSTER_SECTORS)])
+    if bits != 32:
+      cmd.extend(["-r", str(root_entries)])
+
+  # Round the size of the disk up to 32K to that total sectors is
+  # a multiple of sectors per track (mtools complains otherwise)
+  mod = size % (32 * 1024)
+  if mod != 0:
+    size = size + (32 * 1024) - mod
+
+  if os.path.exists(image):
+    os.unlink(image)
+
+  if title is None:
+    title = "boot"
+
+  cmd.extend(["-n", title, "-C", image, str(size // 1024)])
+  try:
+    p = common.run(cmd)
+  except Exception as e:
+    print("Error: Unable to execute command: {}".format(' '.join(cmd)))
+    raise e
+
+  p.wait()
+  assert p.returncode == 0, "mkdosfs failed"
+
+  tree = None
+  if common.isTar(root):
+    import tempfile
+    # mcopy copies trees only.
+    tree = tempfile.mkdtemp(prefix=".mkvfatfs.",
+                            dir=os.path.dirname(os.path.abspath(image)))
+  try:
+    if tree is not None:
+      common.extractTar(root, tree)
+      root = tree
+    for f in os.listdir(root):
+      src_file = os.path.join(root, f)
+      dst_file = os.path.relpath(src_file, root)
+      putFatFile(image, src_file, dst_file)
+  finally:
+    if tree is not None:
+      import shutil
+      shutil.rmtree(tree)
+  # Written by mkdosfs and mcopy, it's hashed reading it back.
+  import hashio
+  hashio.record_file(image)
+  return size
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-s", "--size"):
+      if arg.isdigit():
+        OPTIONS.image_size = int(arg)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                 "integers are allowd." % (arg, opt))
+    elif opt in ("-t", "--title"):
+      OPTIONS.image_title = arg
+    elif opt in ("-H", "--headroom"):
+      OPTIONS.headroom = arg
+    elif opt in ("-z", "--sizes"):
+      OPTIONS.sizes = arg
+    elif opt in ("-M", "--manifest"):
+      OPTIONS.manifest = arg
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="s:t:H:z:M:",
+                             extra_long_opts=[
+                               "size=",
+                               "title=",
+                               "headroom=",
+                               "sizes=",
+                               "manifest=",
+                             ],
+                             extra_option_handler=option_handler)
+  if len(args) != 2:
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.manifest is not None:
+    import hashio
+    hashio.enable(OPTIONS.manifest)
+
+  size = makeVfatFs(args[0], args[1], OPTIONS.image_size,
+                    OPTIONS.image_title, OPTIONS.headroom)
+
+  if OPTIONS.sizes is not None:
+    name = os.path.basename(args[1])
+    common.recordSize(OPTIONS.sizes, name, size)
+    print("Recorded %s=%d in %s" % (name, size, OPTIONS.sizes))
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
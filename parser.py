@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (C) 2015 The Yudatun Open Source Project
 #
@@ -7,6 +7,8 @@
 # published by the Free Software Foundation
 #
 
+import copy
+
 import pt
 
 import xml.etree.ElementTree as ET
@@ -15,6 +17,8 @@ INSTRUCTIONS = pt.INSTRUCTIONS
 PARTITIONS   = pt.PARTITIONS
 BUG          = pt.BUG
 
+PHYSICAL_PARTITIONS = pt.PHYSICAL_PARTITIONS
+
 BYTES_PER_SECTOR = pt.BYTES_PER_SECTOR
 
 class Parser(object):
@@ -22,59 +26,99 @@ class Parser(object):
   def __init__(self): pass
 
   def xml2object(self, xml):
-    config_count = 0
+    """Fill PHYSICAL_PARTITIONS in from xml, one Partitions per
+    physical_partition tag. parser_instructions in configuration apply to
+    all of them, the ones inside a physical_partition to it only. Those
+    of an earlier parse are dropped first."""
+    root = ET.parse(xml).getroot()
+    if root.tag != "configuration":
+      BUG.error("Invalidate tag (%s)." % root.tag)
+
     instruct_count = 0
-    phy_part_count = 0
+    phy_parts = []
 
-    root     = ET.parse(xml)
-    iterator = root.getiterator()
+    # Start over from the defaults for a second XML.
+    INSTRUCTIONS.__init__()
 
-    for e in iterator:
-      if e.tag == "configuration":
-        config_count += 1
-      elif e.tag == "parser_instructions":
+    # The common instructions first, whether they come before the
+    # physical partitions or not.
+    for e in root:
+      if e.tag == "parser_instructions":
         instruct_count += 1
+        if instruct_count > 1:
+          BUG.error("Multiple defined tag (%s)." % e.tag)
         INSTRUCTIONS.text2expr(e.text)
       elif e.tag == "physical_partition":
-        phy_part_count += 1
+        phy_parts.append(e)
+      else:
+        BUG.error("Invalidate tag (%s)." % e.tag)
+
+    if len(phy_parts) == 0:
+      BUG.error("Empty tag (physical_partition) was detected.")
+
+    # The table type may have been set before the parse, keep it.
+    _type = PARTITIONS._type
+    PARTITIONS.__init__()
+    PARTITIONS._type = _type
+    del PHYSICAL_PARTITIONS[1:]
+
+    for i in range(len(phy_parts)):
+      if i == 0:
+        partitions = PARTITIONS
+      else:
+        partitions = pt.Partitions()
+        PHYSICAL_PARTITIONS.append(partitions)
+      self.physical_partition2object(phy_parts[i], partitions)
+
+  def physical_partition2object(self, element, partitions):
+    instruct_count = 0
+
+    for e in element:
+      if e.tag == "parser_instructions":
+        instruct_count += 1
+        if instruct_count > 1:
+          BUG.error("Multiple defined tag (%s)." % e.tag)
+        partitions.instructions = copy.copy(INSTRUCTIONS)
+        partitions.instructions.text2expr(e.text)
       elif e.tag == "partition":
         if e.keys():
           part = pt.Partition()
           part.items2expr(e.items())
           if part.is_gpt is True and part.is_mbr is False:
-            PARTITIONS._type = PARTITIONS.GPT_TYPE
+            partitions._type = partitions.GPT_TYPE
           elif part.is_gpt is False and part.is_mbr is True:
-            PARTITIONS._type = PARTITIONS.MBR_TYPE
+            partitions._type = partitions.MBR_TYPE
           else:
             BUG.error("Cannot defined the type of partition table.")
 
-          # Now add this Partition object to PARTITIONS unless it's the
-          # label EXT, which is a left over legacy tag
-          if part.label != 'EXT':
-            PARTITIONS.add_part(part)
-          else:
+          # Now add this Partition object, or both slots side by side of
+          # an A/B one, to partitions unless it's the label EXT, which is
+          # a left over legacy tag
+          if part.label == 'EXT':
             BUG.error("Invalidate label (EXT) for tag (partition).")
+          elif part.ab is True:
+            for slot in part.slots():
+              partitions.add_part(slot)
+          else:
+            partitions.add_part(part)
         else:
           BUG.info("Empty keys for tag (partition).")
       else:
         BUG.error("Invalidate tag (%s)." % e.tag)
 
-      if config_count > 1 or instruct_count > 1 or phy_part_count > 1:
-        BUG.error("Multiple defined tag (%s)." % e.tag)
-
-    if len(PARTITIONS.part_list) == 0:
+    if len(partitions.part_list) == 0:
       BUG.error("Empty tag (physical_partition) was detected.")
 
-    if (PARTITIONS._type is PARTITIONS.GPT_TYPE) and \
-       (INSTRUCTIONS.WRITE_PROTECT_GPT is True) and \
-       (INSTRUCTIONS.WRITE_PROTECT_BULK_SIZE_IN_KB != 0):
-      sectors_per_bulk = pt.kb2sectors(INSTRUCTIONS.WRITE_PROTECT_BULK_SIZE_IN_KB)
-      first_chunk = PARTITIONS.wp_chunk_list[0]
+    instructions = partitions.instructions
+    if (partitions._type is partitions.GPT_TYPE) and \
+       (instructions.WRITE_PROTECT_GPT is True) and \
+       (instructions.WRITE_PROTECT_BULK_SIZE_IN_KB != 0):
+      sectors_per_bulk = pt.kb2sectors(instructions.WRITE_PROTECT_BULK_SIZE_IN_KB)
+      first_chunk = partitions.wp_chunk_list[0]
       first_chunk.start_sector = 0
       first_chunk.end_sector   = sectors_per_bulk - 1
       first_chunk.num_sectors  = sectors_per_bulk
-      first_chunk.start_bulk   = first_chunk.start_sector / sectors_per_bulk
-      first_chunk.num_bulk     = first_chunk.num_sectors / sectors_per_bulk
-
+      first_chunk.start_bulk   = first_chunk.start_sector // sectors_per_bulk
+      first_chunk.num_bulk     = first_chunk.num_sectors // sectors_per_bulk
 
 PARSER = Parser()
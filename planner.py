@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Reorders the partitions of a GPT layout to save write protect padding.
+
+gpt.py keeps the order of the xml: a read-only partition after writeable
+ones starts on the next write protect bulk, and a writeable one after
+read-only ones leaves the rest of their bulk. The planner groups the
+read-only partitions of each run of movable partitions, and fills the
+space before their first bulk with writeable ones, best fit first (a bin
+of the sectors till the bulk). Each candidate order of a run is placed as
+gpt.py places it, and the one ending the layout first is kept, the xml
+order winning ties.
+
+Pinned partitions (pin="true"), those with a first_lba_in_kb, and an
+auto-grown last partition keep their position.
+"""
+
+import pt
+import gpt
+
+BYTES_PER_SECTOR = pt.BYTES_PER_SECTOR
+
+class LayoutCost(object):
+  """Where a layout ends, the sectors of its padding and its number of
+  write protect chunks."""
+
+  def __init__(self, end, wp_padding, alignment_padding, chunks):
+    self.end               = end
+    self.wp_padding        = wp_padding
+    self.alignment_padding = alignment_padding
+    self.chunks            = chunks
+
+  def key(self):
+    return (self.end, self.chunks, self.wp_padding)
+
+def place(part_list, partitions, instructions):
+  """Return (lbas, wp chunks) of part_list placed as gpt.py places them,
+  from the write protect chunks partitions starts with."""
+  import copy
+
+  scratch = pt.Partitions()
+  scratch._type     = partitions.GPT_TYPE
+  scratch.part_list = part_list
+  scratch.wp_chunk_list[0] = copy.copy(partitions.wp_chunk_list[0])
+  lbas = gpt.place_partitions(scratch, instructions)
+  return (lbas, scratch.wp_chunk_list)
+
+def layout_cost(part_list, partitions, instructions):
+  lbas, wp_chunk_list = place(part_list, partitions, instructions)
+  end = 34
+  gaps = 0
+  for first, last in lbas:
+    gaps += first - end
+    end = max(end, last + 1)
+  alignment = sum([p.padding_in_sec for p in part_list])
+  return LayoutCost(end, gaps - alignment, alignment, len(wp_chunk_list) - 1)
+
+def is_pinned(part, index, count, instructions):
+  if part.pin is True or part.first_lba_in_kb > 0:
+    return True
+  return (index + 1) == count and instructions.AUTO_GROW_LAST_PARTITION is True
+
+def best_fit(parts, sectors):
+  """Return the parts filling most of sectors, largest first."""
+  chosen = []
+  for part in sorted(parts, key=lambda p: -p.size_in_sec):
+    if 0 < part.size_in_sec <= sectors:
+      chosen.append(part)
+      sectors -= part.size_in_sec
+  # Keep the xml order within the chosen ones
+  return [p for p in parts if p in chosen]
+
+def candidates(run, start_lba, in_chunk, instructions):
+  """Yield orders of the movable partitions run, placed from start_lba
+  (within a write protect chunk if in_chunk)."""
+  readonly  = [p for p in run if p.readonly is True]
+  writeable = [p for p in run if p.readonly is not True]
+
+  yield run
+  if len(readonly) == 0 or len(writeable) == 0:
+    return
+  yield readonly + writeable
+  yield writeable + readonly
+  if not in_chunk:
+    gap = pt.sectors_till_next_bulk(start_lba,
+                                    instructions.WRITE_PROTECT_BULK_SIZE_IN_KB)
+    fill = best_fit(writeable, gap)
+    rest = [p for p in writeable if p not in fill]
+    yield fill + readonly + rest
+    yield rest + fill + readonly
+
+def plan(partitions, instructions):
+  """Return the partitions of partitions in the order saving most padding,
+  the xml order if write protection is off."""
+  parts = partitions.part_list
+  if instructions.WRITE_PROTECT_BULK_SIZE_IN_KB <= 0:
+    return list(parts)
+
+  count = len(parts)
+  order = []
+  i = 0
+  while i < count:
+    if is_pinned(parts[i], i, count, instructions):
+      order.append(parts[i])
+      i += 1
+      continue
+    j = i
+    while j < count and not is_pinned(parts[j], j, count, instructions):
+      j += 1
+    run = parts[i:j]
+    tail = parts[j:]
+
+    lbas, wp_chunk_list = place(order, partitions, instructions)
+    start_lba = lbas[-1][1] + 1 if len(lbas) > 0 else 34
+    in_chunk = start_lba <= wp_chunk_list[-1].end_sector
+
+    best = None
+    for candidate in candidates(run, start_lba, in_chunk, instructions):
+      cost = layout_cost(order + candidate + tail, partitions, instructions)
+      if best is None or cost.key() < best[0].key():
+        best = (cost, candidate)
+    order.extend(best[1])
+    i = j
+  return order
+
+def kb(sectors):
+  return sectors * BYTES_PER_SECTOR // 1024
+
+def report(before, after):
+  """Return the lines comparing the LayoutCosts before and after."""
+  return [
+    "| Write protect padding: %dKB -> %dKB" % (kb(before.wp_padding),
+                                              kb(after.wp_padding)),
+    "| Write protect chunks: %d -> %d" % (before.chunks, after.chunks),
+    "| Layout end: %dKB -> %dKB" % (kb(before.end), kb(after.end)),
+  ]
+
+def optimize(partitions, instructions):
+  """Reorder partitions.part_list by plan(), print what it saves, and
+  return whether the order changed."""
+  before = layout_cost(partitions.part_list, partitions, instructions)
+  order = plan(partitions, instructions)
+  after = layout_cost(order, partitions, instructions)
+  changed = [p.label for p in order] != \
+            [p.label for p in partitions.part_list]
+  partitions.part_list = order
+  for line in report(before, after):
+    print(line)
+  if changed:
+    print("| Order: %s" % " ".join([p.label for p in order]))
+  return changed
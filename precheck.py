@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given a partition xml and the directory of its payloads, checks that the
+payload of every partition fits where the partition table places it,
+before any image is assembled or flashed.
+
+Only the size of a raw payload, or the header of a sparse image (its
+total blocks), is looked at, never the data, and the payloads are looked
+at concurrently: a whole layout is checked in milliseconds.
+
+Usage: precheck [flags]
+
+  -x  (--xml) <partition.xml>
+      The partition XML file.
+
+  -i  (--images) <image directory>
+      The directory of the payloads (partition filename).
+
+  -d  (--device-size) <size>
+      The size of the device, the end of an auto-grown last partition.
+
+  -V  (--verity)
+      Count the dm-verity hash tree of read-only partitions, as mkpart -V
+      adds it (those partitions are grown to fit, only reported).
+
+  -j  (--jobs) <jobs>
+      The number of payloads looked at the same time (default 4 per CPU).
+
+"""
+
+import sys
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.xml = None
+OPTIONS.images = None
+OPTIONS.device_size = None
+OPTIONS.verity = False
+OPTIONS.jobs = None
+
+def precheck_all(physical_partitions, images, device_size=None,
+                 verity=False, jobs=None):
+  """Print the Diagnostics of the payloads of all physical partitions,
+  and return whether there are errors."""
+  import validate
+
+  count = len(physical_partitions)
+  errors = False
+  for lun, partitions in enumerate(physical_partitions):
+    diagnostics = validate.check_payloads(partitions, images, device_size,
+                                          verity, jobs)
+    for d in diagnostics:
+      if count > 1:
+        print("LUN %d: %s" % (lun, d))
+      else:
+        print(d)
+    errors = errors or validate.has_errors(diagnostics)
+  return errors
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-x", "--xml"):
+      OPTIONS.xml = arg
+    elif opt in ("-i", "--images"):
+      OPTIONS.images = arg
+    elif opt in ("-d", "--device-size"):
+      OPTIONS.device_size = common.parseSize(arg)
+    elif opt in ("-V", "--verity"):
+      OPTIONS.verity = True
+    elif opt in ("-j", "--jobs"):
+      OPTIONS.jobs = int(arg)
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="x:i:d:Vj:",
+                             extra_long_opts=[
+                               "xml=",
+                               "images=",
+                               "device-size=",
+                               "verity",
+                               "jobs=",
+                             ],
+                             extra_option_handler=option_handler)
+
+  if len(args) != 0 or OPTIONS.xml is None or OPTIONS.images is None:
+    common.usage(__doc__)
+    sys.exit(1)
+
+  import parser
+  import pt
+
+  parser.PARSER.xml2object(OPTIONS.xml)
+  payloads = sum([len([p for p in partitions.part_list if p.filename != ""])
+                  for partitions in pt.PHYSICAL_PARTITIONS])
+  if precheck_all(pt.PHYSICAL_PARTITIONS, OPTIONS.images,
+                  OPTIONS.device_size, OPTIONS.verity, OPTIONS.jobs):
+    sys.exit(1)
+  print("%d payloads fit their partitions." % payloads)
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
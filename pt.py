@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (C) 2015 The Yudatun Open Source Project
 #
@@ -7,37 +7,35 @@
 # published by the Free Software Foundation
 #
 
+import copy
 import sys
-import re
-
-from types import *
 
 class Bug(object):
 
   def blue(self, msg):
-    print "\033[1;34m%s\033[0m" % msg
+    print("\033[1;34m%s\033[0m" % msg)
 
   def green(self, msg):
-    print "\033[1;32m%s\033[0m" % msg
+    print("\033[1;32m%s\033[0m" % msg)
 
   def ok(self, msg):
     self.green(msg)
 
   def info(self, msg):
-    print "\033[1;31m"
-    print "INFO: %s" % msg
-    print "\033[0m"
+    print("\033[1;31m")
+    print("INFO: %s" % msg)
+    print("\033[0m")
 
   def warn(self, msg):
-    print "\033[1;31m"
-    print "WARNING: %s" % msg
-    print "\033[0m"
+    print("\033[1;31m")
+    print("WARNING: %s" % msg)
+    print("\033[0m")
     sys.exit(1)
 
   def error(self, msg):
-    print "\033[1;31m"
-    print "ERROR: %s" % msg
-    print "\033[0m"
+    print("\033[1;31m")
+    print("ERROR: %s" % msg)
+    print("\033[0m")
     sys.exit(1)
 
 BUG = Bug()
@@ -46,11 +44,22 @@ BUG = Bug()
 
 BYTES_PER_SECTOR = 512
 
+_REGEX_CACHE = {}
+
+def regex(pattern):
+  """Return pattern compiled, compiling it (and importing re) on first
+  use only."""
+  r = _REGEX_CACHE.get(pattern)
+  if r is None:
+    import re
+    r = _REGEX_CACHE[pattern] = re.compile(pattern)
+  return r
+
 def str2bool(s):
   return s.lower() in ("True", "true")
 
 def kb2sectors(kb):
-  return int(kb * 1024 / BYTES_PER_SECTOR)
+  return int(kb * 1024 // BYTES_PER_SECTOR)
 
 def sectors_till_next_bulk(lba, kb_per_bulk):
   sectors_per_bulk = kb2sectors(kb_per_bulk)
@@ -60,6 +69,41 @@ def sectors_till_next_bulk(lba, kb_per_bulk):
 
   return 0
 
+# Alignment policies of partition starts, for PARTITION_ALIGNMENT and the
+# align tag of a partition, besides a size in KB.
+ALIGN_NONE        = "NONE"
+ALIGN_ERASE_BLOCK = "ERASE_BLOCK"
+ALIGN_WP_BULK     = "WP_BULK"
+
+def str2alignment(s):
+  """Return the alignment policy s: a size in KB or one of ALIGN_*, None
+  if it's neither."""
+  s = s.strip().upper()
+  if str.isdigit(s):
+    return int(s)
+  if s in (ALIGN_NONE, ALIGN_ERASE_BLOCK, ALIGN_WP_BULK):
+    return s
+  return None
+
+def align_lba(lba, sectors):
+  """Return lba rounded up to a multiple of sectors."""
+  if sectors <= 0:
+    return lba
+  return -(-lba // sectors) * sectors
+
+def padding_report(part_list):
+  """Return the line reporting the sectors the partitions of part_list
+  lost to alignment, None if none."""
+  padded = [p for p in part_list if p.padding_in_sec > 0]
+  if len(padded) == 0:
+    return None
+  total = sum([p.padding_in_sec for p in padded])
+  return "| Alignment padding: %dKB (%s)" % (
+    total * BYTES_PER_SECTOR // 1024,
+    ", ".join(["%s %dKB" % (p.label,
+                            p.padding_in_sec * BYTES_PER_SECTOR // 1024)
+               for p in padded]))
+
 ########################################
 
 class Instructions(object):
@@ -70,18 +114,21 @@ class Instructions(object):
     self.SECTOR_SIZE_IN_BYTES          = 512
     self.AUTO_GROW_LAST_PARTITION      = False
     self.DISK_SIGNATURE                = 0x00000000
+    self.PARTITION_ALIGNMENT           = ALIGN_NONE
+    self.ERASE_BLOCK_SIZE_IN_KB        = 0
+    self.OPTIMIZE_READONLY_PARTITIONS  = False
 
   def trim_spaces(self, text):
     # Trim the left of '=' spaces
-    tmp = re.sub(r"(\t| )+=", "=", text)
+    tmp = regex(r"(\t| )+=").sub("=", text)
     # Trim the right of '=' spaces
-    tmp = re.sub(r"=(\t| )+", "=", tmp)
+    tmp = regex(r"=(\t| )+").sub("=", tmp)
     return tmp
 
   def text2list(self, text):
-    tmp = re.sub(r"\s+|\n", " ", text)  # Trim '\n'
-    tmp = re.sub(r"^\s+", "", tmp)      # Trim '\t\n\r\f\v'
-    tmp = re.sub(r"\s+$", "", tmp)
+    tmp = regex(r"\s+|\n").sub(" ", text)  # Trim '\n'
+    tmp = regex(r"^\s+").sub("", tmp)      # Trim '\t\n\r\f\v'
+    tmp = regex(r"\s+$").sub("", tmp)
     return tmp.split(' ')
 
   def text2expr(self, text):
@@ -104,11 +151,39 @@ class Instructions(object):
           self.AUTO_GROW_LAST_PARTITION = str2bool(value)
         elif key == 'DISK_SIGNATURE':
           self.DISK_SIGNATURE = int(value, 16)
+        elif key == 'PARTITION_ALIGNMENT':
+          alignment = str2alignment(value)
+          if alignment is not None:
+            self.PARTITION_ALIGNMENT = alignment
+          else:
+            BUG.warn("Invalid value (%s) for key (%s)" % (value, key))
+        elif key == 'ERASE_BLOCK_SIZE_IN_KB':
+          if str.isdigit(value):
+            self.ERASE_BLOCK_SIZE_IN_KB = int(value)
+        elif key == 'OPTIMIZE_READONLY_PARTITIONS':
+          self.OPTIMIZE_READONLY_PARTITIONS = str2bool(value)
         else:
           BUG.warn("Invalidate key (%s)" % key)
       else:
         BUG.warn("Invalidate expression (%s)" % l)
 
+  def alignment_in_kb(self, part=None):
+    """Return the KB the start of part is aligned to, by its own align tag
+    or PARTITION_ALIGNMENT, 0 for none."""
+    alignment = self.PARTITION_ALIGNMENT
+    if part is not None and part.align is not None:
+      alignment = part.align
+    if alignment == ALIGN_ERASE_BLOCK:
+      return self.ERASE_BLOCK_SIZE_IN_KB
+    if alignment == ALIGN_WP_BULK:
+      return self.WRITE_PROTECT_BULK_SIZE_IN_KB
+    if alignment == ALIGN_NONE:
+      return 0
+    return alignment
+
+  def alignment_in_sec(self, part=None):
+    return kb2sectors(self.alignment_in_kb(part))
+
 INSTRUCTIONS = Instructions()
 
 ########################################
@@ -134,11 +209,16 @@ class Partitions(object):
     self.part_list     = []
     self.wp_chunk_list = []
     self.wp_chunk_list.append(WriteProtectChunk())
+    # INSTRUCTIONS, or a copy with the physical partition's own entries
+    self.instructions  = INSTRUCTIONS
 
   def add_part(self, part):
     self.part_list.append(part)
 
   def update_wp_chunk_list(self, start, sectors, sectors_per_bulk):
+    if sectors_per_bulk <= 0:
+      # No write protection
+      return
     start_sector = start - 1
     end_sector   = start + sectors - 1
     last_wp_chunk = self.wp_chunk_list[-1]
@@ -149,7 +229,7 @@ class Partitions(object):
       while end_sector > last_wp_chunk.end_sector:
         last_wp_chunk.end_sector  += sectors_per_bulk
         last_wp_chunk.num_sectors += sectors_per_bulk
-      last_wp_chunk.num_bulk = last_wp_chunk.num_sectors / sectors_per_bulk
+      last_wp_chunk.num_bulk = last_wp_chunk.num_sectors // sectors_per_bulk
     else:
       # A new Write Protect Chunk needed.
       new_wp_chunk = WriteProtectChunk()
@@ -159,23 +239,27 @@ class Partitions(object):
       while end_sector > new_wp_chunk.end_sector:
         new_wp_chunk.end_sector  += sectors_per_bulk
         new_wp_chunk.num_sectors += sectors_per_bulk
-      new_wp_chunk.start_bulk = new_wp_chunk.start_sector / sectors_per_bulk
-      new_wp_chunk.num_bulk   = new_wp_chunk.num_sectors / sectors_per_bulk
+      new_wp_chunk.start_bulk = new_wp_chunk.start_sector // sectors_per_bulk
+      new_wp_chunk.num_bulk   = new_wp_chunk.num_sectors // sectors_per_bulk
       self.wp_chunk_list.append(new_wp_chunk)
 
 PARTITIONS = Partitions()
 
+# The partitions of each physical partition (e.g. LUNs of UFS devices) of
+# the XML in order, the first of them is PARTITIONS.
+PHYSICAL_PARTITIONS = [PARTITIONS]
+
 ########################################
 
 class Partition(object):
 
-  GUID_RE_1 = "0x([a-fA-F\d]{32})"
-  GUID_RE_2 = "([a-fA-F\d]{8})-([a-fA-F\d]{4})-"                \
-              "([a-fA-F\d]{4})-([a-fA-F\d]{2})([a-fA-F\d]{2})-" \
-              "([a-fA-F\d]{2})([a-fA-F\d]{2})([a-fA-F\d]{2})"   \
-              "([a-fA-F\d]{2})([a-fA-F\d]{2})([a-fA-F\d]{2})"
+  GUID_RE_1 = r"0x([a-fA-F\d]{32})"
+  GUID_RE_2 = r"([a-fA-F\d]{8})-([a-fA-F\d]{4})-"                \
+              r"([a-fA-F\d]{4})-([a-fA-F\d]{2})([a-fA-F\d]{2})-" \
+              r"([a-fA-F\d]{2})([a-fA-F\d]{2})([a-fA-F\d]{2})"   \
+              r"([a-fA-F\d]{2})([a-fA-F\d]{2})([a-fA-F\d]{2})"
 
-  TYPE_RE   = "^(0x)?([a-fA-F\d][a-fA-F\d]?)$"
+  TYPE_RE   = r"^(0x)?([a-fA-F\d][a-fA-F\d]?)$"
 
   PARTITION_BASIC_DATA_GUID = 0xC79926B7B668C0874433B9E5EBD0A0A2
 
@@ -191,6 +275,14 @@ class Partition(object):
     self._type           = ""
     self.filename        = ""
     self.sparse          = ""
+    self.verity          = None  # verity.HashTree of the payload if built
+    self.ab              = False # Expanded into the slots _a and _b
+    self.slot            = ""    # "a" or "b" of expanded slots
+    self.align           = None  # Alignment policy, see str2alignment()
+    self.padding_in_sec  = 0     # Sectors skipped before it to align it
+    self.pin             = False # Kept in place by planner.py
+    self.source          = ""    # Tree the payload is built from (watch.py)
+    self.fstype          = "ext4" # Filesystem of the payload, ext4 or vfat
 
     self.uniqueguid    = "" # GPT Only TAG
     # MBR Attributes
@@ -206,11 +298,11 @@ class Partition(object):
     if type(GUID) is not str:
       GUID = str(GUID)
 
-    m = re.search(self.GUID_RE_1, GUID)
-    if (type(m) is not NoneType) and (len(GUID) == 32):
+    m = regex(self.GUID_RE_1).search(GUID)
+    if (m is not None) and (len(GUID) == 32):
       return True
-    m = re.search(self.GUID_RE_2, GUID)
-    if (type(m) is not NoneType) and (len(GUID) == 36):
+    m = regex(self.GUID_RE_2).search(GUID)
+    if (m is not None) and (len(GUID) == 36):
       return True
 
     return False
@@ -223,8 +315,8 @@ class Partition(object):
     if type(TYPE) is not str:
       TYPE = str(TYPE)
 
-    m = re.search(self.TYPE_RE, TYPE)
-    if type(m) is not NoneType:
+    m = regex(self.TYPE_RE).search(TYPE)
+    if m is not None:
       return True
 
     return False
@@ -233,13 +325,13 @@ class Partition(object):
     if type(GUID) is not str:
       GUID = str(GUID)
 
-    m = re.search(self.GUID_RE_1, GUID)
-    if type(m) is not NoneType:
+    m = regex(self.GUID_RE_1).search(GUID)
+    if m is not None:
       tmp = int(m.group(1), 16)
       return tmp
 
-    m = re.search(self.GUID_RE_2, GUID)
-    if type(m) is not NoneType:
+    m = regex(self.GUID_RE_2).search(GUID)
+    if m is not None:
       tmp  = int(m.group(4),  16) << 64
       tmp |= int(m.group(3),  16) << 48
       tmp |= int(m.group(2),  16) << 32
@@ -265,8 +357,8 @@ class Partition(object):
     if type(TYPE) is not str:
       TYPE = str(TYPE)
 
-    m = re.search(self.TYPE_RE, TYPE)
-    if type(m) is not NoneType:
+    m = regex(self.TYPE_RE).search(TYPE)
+    if m is not None:
       return int(m.group(2), 16)
 
     BUG.warn("type (%s) is not in the form 0x##." % TYPE)
@@ -294,7 +386,10 @@ class Partition(object):
         else:
           BUG.warn("Invalid type (%s)" % value)
       elif key == 'uniqueguid':
-        self.uniqueguid = value
+        if self.is_validate_GUID(value) is True:
+          self.uniqueguid = value
+        else:
+          BUG.warn("Invalid uniqueguid (%s)" % value)
       elif key == 'bootable':
         self.bootable = str2bool(value)
       elif key == 'readonly':
@@ -309,7 +404,39 @@ class Partition(object):
         self.filename = value
       elif key == 'sparse':
         self.sparse = value
+      elif key == 'ab':
+        self.ab = str2bool(value)
+      elif key == 'pin':
+        self.pin = str2bool(value)
+      elif key == 'source':
+        self.source = value
+      elif key == 'fstype':
+        if value in ("ext4", "vfat"):
+          self.fstype = value
+        else:
+          BUG.warn("Invalid value (%s) for key (%s)" % (value, key))
+      elif key == 'align':
+        self.align = str2alignment(value)
+        if self.align is None:
+          BUG.warn("Invalid value (%s) for key (%s)" % (value, key))
       else:
         BUG.warn("Invalid key (%s)" % key)
 
     self.size_in_sec = kb2sectors(self.size_in_kb)
+
+  def slots(self):
+    """Return the partitions <label>_a and <label>_b of an A/B partition,
+    sharing everything else, the payload too."""
+    if self.uniqueguid != "":
+      BUG.error("uniqueguid (%s) can't be shared by the slots of %s."
+                % (self.uniqueguid, self.label))
+    if self.first_lba_in_kb > 0:
+      BUG.error("first_lba_in_kb can't be shared by the slots of %s."
+                % self.label)
+    slots = []
+    for slot in ("a", "b"):
+      part = copy.copy(self)
+      part.label = "%s_%s" % (self.label, slot)
+      part.slot  = slot
+      slots.append(part)
+    return slots
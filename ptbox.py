@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given a command and its arguments, runs one of the partition table and
+image tools. Otherwise print usages.
+
+Usage: ptbox <command> [flags] [args]
+
+  mkpart
+      Produces images with special partition table from a partition xml.
+
+  mkext4fs
+      Produces an image with ext4 filesystem from a root directory.
+
+  mkvfatfs
+      Produces an image with vfat filesystem from a root directory.
+
+  audit
+      Checks the GPTs of disk images against a partition xml.
+
+  precheck
+      Checks that the payloads of a partition xml fit their partitions.
+
+  variants
+      Produces the GPT images of size variants of a partition xml.
+
+  bmap
+      Writes the block map of an image, or copies its mapped blocks.
+
+  fastboot
+      Flashes the payloads of a partition xml over fastboot TCP.
+
+  chunkstore
+      Keeps images in a store of deduplicated chunks, and rebuilds them.
+
+  watch
+      Rebuilds the payloads of a partition xml as their source trees change.
+
+Run "ptbox <command> -h" for the flags of each command.
+"""
+
+import sys
+
+# Command name -> module implementing it. Only the module of the command
+# being run is imported, so each invocation pays for what it uses.
+COMMANDS = {
+  "mkpart":   "mkpart",
+  "mkext4fs": "mkext4fs",
+  "mkvfatfs": "mkvfatfs",
+  "audit":    "audit",
+  "precheck": "precheck",
+  "bmap":     "bmap",
+  "fastboot": "fastboot",
+  "chunkstore": "chunkstore",
+  "watch":    "watch",
+  "variants": "variants",
+}
+
+def usage():
+  print(__doc__.strip("\n"))
+
+def main(argv):
+  if len(argv) == 0:
+    usage()
+    sys.exit(1)
+
+  if argv[0] in ("-h", "--help"):
+    usage()
+    sys.exit()
+
+  name = argv[0]
+  if name not in COMMANDS:
+    usage()
+    print("** unknown command \"%s\" **" % name)
+    sys.exit(2)
+
+  module = __import__(COMMANDS[name])
+  module.main(argv[1:])
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Block image writers: raw images with holes for unwritten blocks, and
+Android sparse images.
+
+Both take the image as a sequence of blocks through the same calls:
+
+  write(data)    blocks of data (len(data) is a multiple of block_size).
+  zero(count)    count blocks which must read back as zeros.
+  skip(count)    count blocks of unused space.
+  fill(pattern, count)
+                 count blocks of a 4 byte pattern (sparse images only).
+  close()
+
+SparseImageReader reads Android sparse images back.
+"""
+
+import struct
+import zlib
+
+SPARSE_HEADER_MAGIC  = 0xED26FF3A
+SPARSE_MAJOR_VERSION = 1
+SPARSE_MINOR_VERSION = 0
+
+CHUNK_TYPE_RAW       = 0xCAC1
+CHUNK_TYPE_FILL      = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32     = 0xCAC4
+
+# magic, major, minor, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks,
+# total_chunks, image_checksum
+FILE_HEADER  = struct.Struct("<I4H4I")
+# chunk_type, reserved, chunk_sz (blocks), total_sz (bytes, with header)
+CHUNK_HEADER = struct.Struct("<2H2I")
+
+ZEROS = b"\0" * (1024 * 1024)
+
+class RawImageWriter(object):
+  """Writes a plain image. Zeroed and unused blocks are left as holes."""
+
+  def __init__(self, f, block_size, total_blocks):
+    self.f            = f
+    self.block_size   = block_size
+    self.total_blocks = total_blocks
+    self.blocks       = 0
+
+  def write(self, data):
+    self.f.write(data)
+    self.blocks += len(data) // self.block_size
+
+  def zero(self, count):
+    self.skip(count)
+
+  def skip(self, count):
+    if count > 0:
+      self.f.seek(count * self.block_size, 1)
+      self.blocks += count
+
+  def close(self):
+    self.skip(self.total_blocks - self.blocks)
+    self.f.truncate(self.total_blocks * self.block_size)
+
+class SparseImageWriter(object):
+  """Writes an Android sparse image. Consecutive calls of the same kind
+  are merged into one chunk. With crc a CRC32 chunk of the expanded image
+  ends the file and goes into its header."""
+
+  def __init__(self, f, block_size, total_blocks, crc=False):
+    self.f            = f
+    self.block_size   = block_size
+    self.total_blocks = total_blocks
+    self.blocks       = 0
+    self.chunks       = 0
+    self.crc          = 0 if crc else None
+
+    self.chunk_type   = None
+    self.chunk_blocks = 0
+    self.chunk_offset = 0
+    self.pattern      = b"\0" * 4
+
+    self.f.write(b"\0" * FILE_HEADER.size)
+
+  def start_chunk(self, chunk_type, count):
+    if self.chunk_type == chunk_type:
+      self.chunk_blocks += count
+    else:
+      self.end_chunk()
+      self.chunk_type   = chunk_type
+      self.chunk_blocks = count
+      self.chunk_offset = self.f.tell()
+      self.f.write(b"\0" * CHUNK_HEADER.size)
+      if chunk_type == CHUNK_TYPE_FILL:
+        self.f.write(self.pattern)
+    self.blocks += count
+
+  def end_chunk(self):
+    if self.chunk_type is None:
+      return
+    end = self.f.tell()
+    self.f.seek(self.chunk_offset)
+    self.f.write(CHUNK_HEADER.pack(self.chunk_type, 0, self.chunk_blocks,
+                                   end - self.chunk_offset))
+    self.f.seek(end)
+    self.chunks += 1
+    self.chunk_type = None
+
+  def update_crc_zeros(self, count):
+    size = count * self.block_size
+    while size > 0:
+      n = min(size, len(ZEROS))
+      self.crc = zlib.crc32(ZEROS[:n], self.crc)
+      size -= n
+
+  def write(self, data):
+    if len(data) == 0:
+      return
+    self.start_chunk(CHUNK_TYPE_RAW, len(data) // self.block_size)
+    self.f.write(data)
+    if self.crc is not None:
+      self.crc = zlib.crc32(data, self.crc)
+
+  def zero(self, count):
+    self.fill(b"\0" * 4, count)
+
+  def fill(self, pattern, count):
+    if count <= 0:
+      return
+    if self.chunk_type == CHUNK_TYPE_FILL and self.pattern != pattern:
+      self.end_chunk()
+    self.pattern = bytes(pattern)
+    self.start_chunk(CHUNK_TYPE_FILL, count)
+    if self.crc is None:
+      return
+    if self.pattern == b"\0" * 4:
+      self.update_crc_zeros(count)
+    else:
+      data = self.pattern * (self.block_size // 4)
+      for i in range(count):
+        self.crc = zlib.crc32(data, self.crc)
+
+  def skip(self, count):
+    if count > 0:
+      self.start_chunk(CHUNK_TYPE_DONT_CARE, count)
+      if self.crc is not None:
+        self.update_crc_zeros(count)
+
+  def close(self):
+    self.skip(self.total_blocks - self.blocks)
+    checksum = 0
+    if self.crc is not None:
+      checksum = self.crc & 0xFFFFFFFF
+      self.end_chunk()
+      self.f.write(CHUNK_HEADER.pack(CHUNK_TYPE_CRC32, 0, 0,
+                                     CHUNK_HEADER.size + 4))
+      self.f.write(struct.pack("<I", checksum))
+      self.chunks += 1
+    self.end_chunk()
+    self.f.seek(0)
+    self.f.write(FILE_HEADER.pack(SPARSE_HEADER_MAGIC, SPARSE_MAJOR_VERSION,
+                                  SPARSE_MINOR_VERSION, FILE_HEADER.size,
+                                  CHUNK_HEADER.size, self.block_size,
+                                  self.total_blocks, self.chunks, checksum))
+
+def is_sparse(filename):
+  """Return whether filename is an Android sparse image."""
+  with open(filename, "rb") as f:
+    data = f.read(4)
+  return len(data) == 4 and \
+         struct.unpack("<I", data)[0] == SPARSE_HEADER_MAGIC
+
+class SparseImageReader(object):
+  """Reads an Android sparse image from file object f."""
+
+  def __init__(self, f):
+    self.f = f
+    header = f.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+      raise ValueError("not a sparse image")
+    (magic, major, minor, file_hdr_sz, chunk_hdr_sz, self.block_size,
+     self.total_blocks, self.total_chunks, self.checksum) = \
+      FILE_HEADER.unpack(header)
+    if magic != SPARSE_HEADER_MAGIC or major != SPARSE_MAJOR_VERSION:
+      raise ValueError("not a sparse image")
+    self.file_hdr_sz  = file_hdr_sz
+    self.chunk_hdr_sz = chunk_hdr_sz
+
+  def size(self):
+    """Bytes of the expanded image."""
+    return self.total_blocks * self.block_size
+
+  def chunks(self):
+    """Yield (chunk_type, block, count, arg) of each chunk: block is the
+    first block of the chunk in the expanded image, arg is the offset of
+    the data in the file for CHUNK_TYPE_RAW, the 4 byte pattern for
+    CHUNK_TYPE_FILL and None otherwise."""
+    offset = self.file_hdr_sz
+    block = 0
+    for i in range(self.total_chunks):
+      self.f.seek(offset)
+      chunk_type, _, count, total_sz = \
+        CHUNK_HEADER.unpack(self.f.read(CHUNK_HEADER.size))
+      offset += self.chunk_hdr_sz
+      arg = None
+      if chunk_type == CHUNK_TYPE_RAW:
+        arg = offset
+      elif chunk_type == CHUNK_TYPE_FILL:
+        self.f.seek(offset)
+        arg = self.f.read(4)
+      elif chunk_type not in (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32):
+        raise ValueError("unknown chunk type 0x%X" % chunk_type)
+      yield (chunk_type, block, count, arg)
+      offset += total_sz - self.chunk_hdr_sz
+      block += count
+
+  def expand(self, out, offset, zero=None):
+    """Write the expanded image into file object out from offset on.
+    Don't care chunks, and chunks filled with zeros, are left as they
+    are in out, or passed to zero(offset, length) if given, to clear
+    what out holds there."""
+    for chunk_type, block, count, arg in self.chunks():
+      out_offset = offset + block * self.block_size
+      size = count * self.block_size
+      if zero is not None and size > 0 and \
+         (chunk_type == CHUNK_TYPE_DONT_CARE or
+          (chunk_type == CHUNK_TYPE_FILL and arg == b"\0" * 4)):
+        zero(out_offset, size)
+      elif chunk_type == CHUNK_TYPE_RAW:
+        self.f.seek(arg)
+        out.seek(out_offset)
+        while size > 0:
+          data = self.f.read(min(size, len(ZEROS)))
+          if len(data) == 0:
+            raise ValueError("truncated sparse image")
+          out.write(data)
+          size -= len(data)
+      elif chunk_type == CHUNK_TYPE_FILL and arg != b"\0" * 4:
+        out.seek(out_offset)
+        pattern = arg * (len(ZEROS) // 4)
+        while size > 0:
+          out.write(pattern[:min(size, len(pattern))])
+          size -= min(size, len(pattern))
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Checks a partition layout before any table is written. Every problem is
+reported as a Diagnostic instead of stopping at the first one, so that a
+layout can be checked as a whole:
+
+  overlap      two partitions share sectors
+  alignment    a partition doesn't start at a multiple of the alignment,
+               the checked one or its own policy
+  bounds       a partition is outside of the usable sectors of the device
+  empty        a partition of no size
+  label        a duplicate label, or a GPT label over 36 characters
+  guid         a duplicate uniqueguid
+  entries      more partitions than GPT entries
+  ignored      a tag which the partition table doesn't use
+  payload      a payload larger than its partition, or missing
+               (check_payloads(), from file sizes and sparse headers)
+
+Partitions are placed the way gpt.py and mbr.py place them, then sorted by
+their first sector and swept once, so a layout of n partitions is checked
+in O(n log n).
+"""
+
+import copy
+import heapq
+import os
+
+import pt
+import gpt
+import mbr
+
+ERROR   = "error"
+WARNING = "warning"
+
+GPT_MAX_ENTRIES    = 128
+GPT_LABEL_LENGTH   = 36
+GPT_FIRST_LBA      = 34       # Protective MBR, GPT header, 32 sectors of entries
+GPT_BACKUP_SECTORS = 33       # Entries and header at the end of the device
+MBR_MAX_SECTORS    = 1 << 32  # LBA fields of MBR entries are 32 bits
+
+class Diagnostic(object):
+  """A problem of a layout.
+
+  Args:
+    level: ERROR or WARNING.
+    code: kind of the problem, as listed above.
+    message: the problem in words.
+    labels: labels of the partitions involved.
+  """
+
+  def __init__(self, level, code, message, labels=()):
+    self.level   = level
+    self.code    = code
+    self.message = message
+    self.labels  = list(labels)
+
+  def to_dict(self):
+    return {"level": self.level, "code": self.code,
+            "message": self.message, "labels": self.labels}
+
+  def __str__(self):
+    return "%s: %s: %s" % (self.level.upper(), self.code, self.message)
+
+  def __repr__(self):
+    return "<Diagnostic %s %s %r>" % (self.level, self.code, self.labels)
+
+def has_errors(diagnostics):
+  for d in diagnostics:
+    if d.level == ERROR:
+      return True
+  return False
+
+def place_partitions(partitions, instructions, device_sectors=None):
+  """Return (first_lba, last_lba, part) of each partition of partitions,
+  where its partition table would place it, leaving partitions untouched.
+  MBR partitions are taken at their first_lba_in_kb, as requested, rather
+  than moved after their predecessor. An auto-grown last partition of a
+  GPT ends at the last usable sector if device_sectors is known."""
+  # Placement records the alignment padding of each partition, in
+  # copies of them.
+  parts = [copy.copy(part) for part in partitions.part_list]
+  if partitions._type == partitions.GPT_TYPE:
+    # Placement records write protect chunks, start from none as gpt.py
+    # does rather than in the given partitions.
+    scratch = pt.Partitions()
+    scratch._type     = partitions._type
+    scratch.part_list = parts
+    scratch.wp_chunk_list[0] = copy.copy(partitions.wp_chunk_list[0])
+    lbas = gpt.place_partitions(scratch, instructions)
+    if instructions.AUTO_GROW_LAST_PARTITION is True and \
+       len(lbas) > 0 and device_sectors is not None:
+      first_lba = lbas[-1][0]
+      lbas[-1] = (first_lba, device_sectors - GPT_BACKUP_SECTORS - 1)
+  else:
+    scratch = copy.copy(partitions)
+    scratch.part_list = parts
+    lbas = mbr.place_partitions(scratch, clamp=False)
+
+  return [(first, last, part)
+          for (first, last), part in zip(lbas, partitions.part_list)]
+
+def span(first, last):
+  return "%d-%d" % (first, last)
+
+def check_overlaps(spans):
+  """Sweep spans in the order of their first sector, keeping the spans
+  still open in a heap by their last sector. Each span overlaps exactly
+  the open spans left once those ending before it are dropped."""
+  diagnostics = []
+  active = []
+
+  for first, last, part in sorted(spans, key=lambda s: (s[0], s[1])):
+    if last < first:
+      continue
+    while len(active) > 0 and active[0][0] < first:
+      heapq.heappop(active)
+    for other_last, other_first, other_label in active:
+      diagnostics.append(Diagnostic(
+        ERROR, "overlap",
+        "%s (%s) overlaps %s (%s)" % (part.label, span(first, last),
+                                      other_label,
+                                      span(other_first, other_last)),
+        (other_label, part.label)))
+    heapq.heappush(active, (last, first, part.label))
+
+  return diagnostics
+
+def check_bounds(spans, first_usable, last_usable):
+  diagnostics = []
+  for first, last, part in spans:
+    if last < first:
+      continue
+    if first < first_usable or (last_usable is not None and
+                                last > last_usable):
+      if last_usable is None:
+        usable = "from %d" % first_usable
+      else:
+        usable = span(first_usable, last_usable)
+      diagnostics.append(Diagnostic(
+        ERROR, "bounds",
+        "%s (%s) is outside of the usable sectors %s"
+        % (part.label, span(first, last), usable),
+        (part.label,)))
+  return diagnostics
+
+def check_alignment(spans, alignment_kb, instructions=None):
+  """Check that partitions start on alignment_kb boundaries, or if it's 0,
+  on the boundaries of their alignment policy in instructions."""
+  diagnostics = []
+  for first, last, part in spans:
+    kb = alignment_kb
+    if kb <= 0 and instructions is not None:
+      kb = instructions.alignment_in_kb(part)
+    sectors = pt.kb2sectors(kb)
+    if sectors > 0 and first % sectors != 0:
+      diagnostics.append(Diagnostic(
+        WARNING, "alignment",
+        "%s starts at sector %d, not on a %dKB boundary"
+        % (part.label, first, kb),
+        (part.label,)))
+  return diagnostics
+
+def check_partitions(partitions, instructions, is_gpt):
+  """Check what doesn't depend on placement: sizes, labels, GUIDs and
+  the number of partitions."""
+  diagnostics = []
+  labels = {}
+  guids  = {}
+  part_list = partitions.part_list
+
+  for i in range(len(part_list)):
+    part = part_list[i]
+
+    if part.size_in_sec <= 0 and not \
+       (is_gpt is True and (i + 1) == len(part_list) and
+        instructions.AUTO_GROW_LAST_PARTITION is True):
+      diagnostics.append(Diagnostic(
+        ERROR, "empty", "%s has no size" % part.label, (part.label,)))
+
+    policy = part.align
+    if policy is None:
+      policy = instructions.PARTITION_ALIGNMENT
+    if policy == pt.ALIGN_ERASE_BLOCK and \
+       instructions.ERASE_BLOCK_SIZE_IN_KB <= 0:
+      diagnostics.append(Diagnostic(
+        WARNING, "ignored",
+        "%s: ERASE_BLOCK alignment without ERASE_BLOCK_SIZE_IN_KB"
+        % part.label, (part.label,)))
+
+    if part.label in labels:
+      diagnostics.append(Diagnostic(
+        ERROR, "label", "%s is defined more than once" % part.label,
+        (part.label,)))
+    else:
+      labels[part.label] = part
+
+    if is_gpt is False:
+      continue
+
+    if len(part.label) > GPT_LABEL_LENGTH:
+      diagnostics.append(Diagnostic(
+        ERROR, "label",
+        "%s is longer than %d characters" % (part.label, GPT_LABEL_LENGTH),
+        (part.label,)))
+
+    if part.uniqueguid != "":
+      guid = part.validate_GUID(part.uniqueguid)
+      if guid in guids:
+        diagnostics.append(Diagnostic(
+          ERROR, "guid",
+          "%s has the uniqueguid of %s (%s)"
+          % (part.label, guids[guid].label, part.uniqueguid),
+          (guids[guid].label, part.label)))
+      else:
+        guids[guid] = part
+
+    if part.first_lba_in_kb > 0:
+      diagnostics.append(Diagnostic(
+        WARNING, "ignored",
+        "%s: first_lba_in_kb is ignored for GPT" % part.label,
+        (part.label,)))
+
+  if is_gpt is True and len(part_list) > GPT_MAX_ENTRIES:
+    diagnostics.append(Diagnostic(
+      ERROR, "entries",
+      "%d partitions, a GPT has %d entries"
+      % (len(part_list), GPT_MAX_ENTRIES)))
+
+  return diagnostics
+
+def validate(partitions, instructions, device_size=None, alignment_kb=0):
+  """Check the layout of partitions and return a list of Diagnostics,
+  empty if there are no problems.
+
+  Args:
+    partitions, instructions: as filled in by the parser.
+    device_size: bytes of the device, or None to skip the end of device
+      checks.
+    alignment_kb: boundary every partition should start on, or 0 for
+      the alignment policy of each partition.
+  """
+  is_gpt = partitions._type == partitions.GPT_TYPE
+
+  device_sectors = None
+  if device_size is not None:
+    device_sectors = device_size // pt.BYTES_PER_SECTOR
+
+  spans = place_partitions(partitions, instructions, device_sectors)
+
+  if is_gpt:
+    first_usable = GPT_FIRST_LBA
+    last_usable  = None
+    if device_sectors is not None:
+      last_usable = device_sectors - GPT_BACKUP_SECTORS - 1
+  else:
+    first_usable = 1
+    last_usable  = MBR_MAX_SECTORS - 1
+    if device_sectors is not None:
+      last_usable = min(last_usable, device_sectors - 1)
+
+  diagnostics = check_partitions(partitions, instructions, is_gpt)
+  diagnostics += check_overlaps(spans)
+  diagnostics += check_bounds(spans, first_usable, last_usable)
+  diagnostics += check_alignment(spans, alignment_kb, instructions)
+  return diagnostics
+
+def payload_size(path):
+  """Return (bytes of the payload at path once expanded, whether it's a
+  sparse image), from its size or its sparse header."""
+  import sparse
+
+  with open(path, "rb") as f:
+    try:
+      # Reads the file header only.
+      return (sparse.SparseImageReader(f).size(), True)
+    except ValueError:
+      return (os.fstat(f.fileno()).st_size, False)
+
+def needed_size(size, sparse_image, part, verity):
+  """Return the bytes part needs for a payload of size bytes: with the
+  hash tree mkpart -V adds to raw payloads of read-only partitions."""
+  if verity is True and part.readonly is True and not sparse_image:
+    import verity as dm_verity
+    blocks = (size + dm_verity.BLOCK_SIZE - 1) // dm_verity.BLOCK_SIZE
+    return blocks * dm_verity.BLOCK_SIZE + dm_verity.tree_size(size)
+  return size
+
+def check_payload(span, images, verity=False):
+  """Return the Diagnostics of the payload of the partition of span, a
+  (first_lba, last_lba, part) of place_partitions()."""
+  first, last, part = span
+  if part.filename == "":
+    return []
+  path = os.path.join(images, part.filename)
+  try:
+    size, sparse_image = payload_size(path)
+  except (IOError, OSError):
+    return [Diagnostic(
+      WARNING, "payload",
+      "%s: no payload %s" % (part.label, path), (part.label,))]
+
+  diagnostics = []
+  if sparse_image is False and part.sparse == "true":
+    diagnostics.append(Diagnostic(
+      WARNING, "payload",
+      "%s: %s isn't a sparse image" % (part.label, part.filename),
+      (part.label,)))
+
+  needed = needed_size(size, sparse_image, part, verity)
+  room = (last - first + 1) * pt.BYTES_PER_SECTOR
+  if last < first or needed <= room:
+    return diagnostics
+  if size <= room:
+    # mkpart -V grows the partition to fit its tree.
+    diagnostics.append(Diagnostic(
+      WARNING, "payload",
+      "%s: %s and its hash tree take %dKB, the partition is grown from %dKB"
+      % (part.label, part.filename, (needed + 1023) // 1024, room // 1024),
+      (part.label,)))
+  else:
+    diagnostics.append(Diagnostic(
+      ERROR, "payload",
+      "%s: %s takes %dKB%s, the partition has %dKB"
+      % (part.label, part.filename, (size + 1023) // 1024,
+         " expanded" if sparse_image else "", room // 1024),
+      (part.label,)))
+  return diagnostics
+
+def check_payloads(partitions, images, device_size=None, verity=False,
+                   jobs=None):
+  """Check the payloads of partitions, found in the directory images,
+  against the LBAs their table gives them on a pool of jobs threads, and
+  return a list of Diagnostics in the order of the partitions."""
+  import multiprocessing
+  from multiprocessing.pool import ThreadPool
+
+  device_sectors = None
+  if device_size is not None:
+    device_sectors = device_size // pt.BYTES_PER_SECTOR
+  spans = place_partitions(partitions, partitions.instructions,
+                           device_sectors)
+  spans = [s for s in spans if s[2].filename != ""]
+  if len(spans) == 0:
+    return []
+
+  if jobs is None:
+    jobs = 4 * multiprocessing.cpu_count()
+  pool = ThreadPool(max(1, min(jobs, len(spans))))
+  try:
+    results = pool.map(lambda span: check_payload(span, images, verity),
+                       spans)
+  finally:
+    pool.close()
+    pool.join()
+  return [d for diagnostics in results for d in diagnostics]
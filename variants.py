@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given a partition xml and a matrix of device sizes and partition size
+overrides, produces the GPT images of every variant of the layout in one
+run. Otherwise print usages.
+
+The xml is parsed once. Each variant gets the tables mkpart -d <size> -D
+would make of the xml with its overrides (same -s seed): the Backup GPT
+at the end of its device, a grown last partition up to it, the disk GUID
+of its layout. The partition GUIDs are the exception: they are derived
+from the disk GUID of the xml's own layout in every variant, so that the
+entries a variant leaves as they are have the same bytes in all of them,
+and their CRC state is computed once. A variant without overrides gets
+the tables of mkpart exactly.
+
+Usage: variants [flags]
+
+  -x  (--xml) <partition.xml>
+      The partition XML file.
+
+  -o  (--output) <output directory>
+      The images of each variant go to <output directory>/<variant>/.
+
+  -l  (--lun) <lun>
+      The physical partition of the XML (default 0).
+
+  -s  (--guid-seed) <seed>
+      The seed of the disk and partition GUIDs, as for mkpart -s.
+
+  -d  (--device-sizes) <size>[,<size>...]
+      A variant for each device size (e.g. 16G,32G,64G), named after it,
+      with the overrides of -p.
+
+  -p  (--partition-size) <label>=<size>
+      Override the size of the partition label in the variants of -d. May
+      be given several times.
+
+  -G  (--grow) <true|false>
+      Set AUTO_GROW_LAST_PARTITION in the variants of -d.
+
+  -m  (--matrix) <file>
+      More variants, a line each:
+
+        <name> <device size> [<label>=<size> ...] [grow|nogrow]
+
+      The default of grow is the xml's. Blank lines and lines starting
+      with # are ignored.
+
+"""
+
+import os
+import sys
+
+from io import StringIO
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.xml = None
+OPTIONS.output_directory = None
+OPTIONS.lun = 0
+OPTIONS.device_sizes = []
+OPTIONS.overrides = {}
+OPTIONS.grow = None
+OPTIONS.matrix = None
+# Read by gpt.py
+OPTIONS.guid_seed = ""
+OPTIONS.sequential_guid = False
+OPTIONS.random_guid = False
+OPTIONS.all_128_partitions = False
+
+class Variant(object):
+  """A device size, the sizes (in bytes) of some partitions by label, and
+  AUTO_GROW_LAST_PARTITION (None for the xml's)."""
+
+  def __init__(self, name, device_size, overrides=None, grow=None):
+    self.name        = name
+    self.device_size = device_size
+    self.overrides   = overrides or {}
+    self.grow        = grow
+
+def parseGrow(text):
+  if text.lower() in ("true", "grow"):
+    return True
+  if text.lower() in ("false", "nogrow"):
+    return False
+  raise ValueError("not true or false: %r" % (text,))
+
+def parseDeviceSize(text):
+  try:
+    return common.parseSize(text)
+  except ValueError:
+    raise ValueError("not a device size: %r" % (text,))
+
+def parseOverride(text):
+  """Return (label, bytes) of label=size."""
+  if "=" not in text:
+    raise ValueError("not label=size: %r" % (text,))
+  label, size = text.split("=", 1)
+  try:
+    return (label.strip(), common.parseSize(size))
+  except ValueError:
+    raise ValueError("not a size: %r" % (text,))
+
+def readMatrix(filename):
+  """Return the Variants of the matrix file filename."""
+  variants = []
+  with open(filename) as f:
+    for line in f:
+      fields = line.split()
+      if len(fields) == 0 or fields[0].startswith("#"):
+        continue
+      if len(fields) < 2:
+        raise ValueError("%s: no device size for %s" % (filename, fields[0]))
+      try:
+        variant = Variant(fields[0], parseDeviceSize(fields[1]))
+        for field in fields[2:]:
+          if "=" in field:
+            label, size = parseOverride(field)
+            variant.overrides[label] = size
+          else:
+            variant.grow = parseGrow(field)
+      except ValueError as e:
+        raise ValueError("%s: %s: %s" % (filename, fields[0], e))
+      variants.append(variant)
+  return variants
+
+def variantLayout(partitions, variant):
+  """Return (Partitions, Instructions) of variant of partitions, sharing
+  the partitions it leaves as they are."""
+  import copy
+  import pt
+
+  instructions = copy.copy(partitions.instructions)
+  if variant.grow is not None:
+    instructions.AUTO_GROW_LAST_PARTITION = variant.grow
+
+  scratch = pt.Partitions()
+  scratch._type = partitions._type
+  scratch.instructions = instructions
+  scratch.wp_chunk_list[0] = copy.copy(partitions.wp_chunk_list[0])
+  labels = [p.label for p in partitions.part_list]
+  for label in variant.overrides:
+    if label not in labels:
+      raise ValueError("%s: no partition %s" % (variant.name, label))
+
+  for i, part in enumerate(partitions.part_list):
+    last = (i + 1) == len(partitions.part_list)
+    if part.label in variant.overrides or last:
+      # The table zeroes the size of a grown last partition.
+      part = copy.copy(part)
+    if part.label in variant.overrides:
+      part.size_in_kb  = variant.overrides[part.label] // 1024
+      part.size_in_sec = pt.kb2sectors(part.size_in_kb)
+    scratch.add_part(part)
+  return (scratch, instructions)
+
+def makeVariant(partitions, variant, lun, output_directory, entry_crc,
+                guid_base=None):
+  """Check the layout of variant and write its tables, with partition
+  GUIDs derived from guid_base (see gpt.GPTPartitionTable). Returns the
+  GPTPartitionTable, or the error Diagnostics of the layout."""
+  import gpt
+  import pt
+  import validate
+
+  scratch, instructions = variantLayout(partitions, variant)
+  diagnostics = validate.validate(scratch, instructions, variant.device_size)
+  if validate.has_errors(diagnostics):
+    return [d for d in diagnostics if d.level == validate.ERROR]
+
+  disk_sectors = variant.device_size // pt.BYTES_PER_SECTOR
+  table = gpt.GPTPartitionTable(scratch, instructions, lun, disk_sectors,
+                                entry_crc, guid_base)
+  directory = os.path.join(output_directory, variant.name) + os.sep
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  stdout = sys.stdout
+  sys.stdout = StringIO()
+  try:
+    table.build()
+    table.create_gpt_both_bin(directory)
+    table.create_gpt_main_bin(directory)
+    table.create_gpt_backup_bin(directory)
+  finally:
+    sys.stdout = stdout
+  return table
+
+def makeVariants(partitions, variants, lun, output_directory):
+  """Write the tables of every variant, print a line about each, and
+  return whether they all could be made."""
+  import gpt
+
+  entry_crc = gpt.EntryArrayCRC()
+  guid_base = gpt.layout_guid(partitions, partitions.instructions, lun)
+  ok = True
+  print("%-12s %10s %12s %12s %10s" % ("variant", "device", "last usable",
+                                       "backup LBA", "entry CRC"))
+  for variant in variants:
+    result = makeVariant(partitions, variant, lun, output_directory,
+                         entry_crc, guid_base)
+    if isinstance(result, list):
+      ok = False
+      for d in result:
+        print("%-12s %s" % (variant.name, d))
+      continue
+    header = result.primary_gpt.gpt_header
+    print("%-12s %9dM %12d %12d 0x%08X"
+      % (variant.name, variant.device_size // (1024 * 1024),
+         header.last_lba, header.backup_lba, header.entry_array_crc32))
+  return ok
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-x", "--xml"):
+      OPTIONS.xml = arg
+    elif opt in ("-o", "--output"):
+      OPTIONS.output_directory = arg
+    elif opt in ("-l", "--lun"):
+      OPTIONS.lun = int(arg)
+    elif opt in ("-s", "--guid-seed"):
+      OPTIONS.guid_seed = arg
+    elif opt in ("-d", "--device-sizes"):
+      OPTIONS.device_sizes.extend([s for s in arg.split(",") if s != ""])
+    elif opt in ("-p", "--partition-size"):
+      label, size = parseOverride(arg)
+      OPTIONS.overrides[label] = size
+    elif opt in ("-G", "--grow"):
+      OPTIONS.grow = parseGrow(arg)
+    elif opt in ("-m", "--matrix"):
+      OPTIONS.matrix = arg
+    else:
+      return False
+    return True
+
+  # Sizes, overrides and grow flags which don't parse are reported as the
+  # other errors are, without a traceback.
+  try:
+    args = common.parseOptions(argv, __doc__,
+                               extra_opts="x:o:l:s:d:p:G:m:",
+                               extra_long_opts=[
+                                 "xml=",
+                                 "output=",
+                                 "lun=",
+                                 "guid-seed=",
+                                 "device-sizes=",
+                                 "partition-size=",
+                                 "grow=",
+                                 "matrix=",
+                               ],
+                               extra_option_handler=option_handler)
+  except ValueError as e:
+    raise RuntimeError(str(e))
+
+  if len(args) != 0 or OPTIONS.xml is None or \
+     (len(OPTIONS.device_sizes) == 0 and OPTIONS.matrix is None):
+    common.usage(__doc__)
+    sys.exit(1)
+
+  if OPTIONS.output_directory is None:
+    OPTIONS.output_directory = "./"
+
+  variants = []
+  try:
+    for size in OPTIONS.device_sizes:
+      variants.append(Variant(size, parseDeviceSize(size),
+                              dict(OPTIONS.overrides), OPTIONS.grow))
+    if OPTIONS.matrix is not None:
+      variants.extend(readMatrix(OPTIONS.matrix))
+  except ValueError as e:
+    raise RuntimeError(str(e))
+
+  import parser
+  import pt
+
+  parser.PARSER.xml2object(OPTIONS.xml)
+  if OPTIONS.lun < 0 or OPTIONS.lun >= len(pt.PHYSICAL_PARTITIONS):
+    pt.BUG.error("No physical partition %d in %s." % (OPTIONS.lun, OPTIONS.xml))
+  partitions = pt.PHYSICAL_PARTITIONS[OPTIONS.lun]
+  if partitions._type is not partitions.GPT_TYPE:
+    pt.BUG.error("Only GPT layouts have variants.")
+
+  lun = OPTIONS.lun if len(pt.PHYSICAL_PARTITIONS) > 1 else None
+  try:
+    ok = makeVariants(partitions, variants, lun, OPTIONS.output_directory)
+  except ValueError as e:
+    pt.BUG.error(str(e))
+  if not ok:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)
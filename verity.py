@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+dm-verity hash trees (format 1, as veritysetup makes them) of partition
+payloads.
+
+Every data block is hashed with the salt prepended, the digests fill hash
+blocks, which are hashed the same way level by level up to a single block,
+whose hash is the root hash. The levels are stored top level first, each
+hash block padded with zeros. The tree goes after the payload in the
+partition, so that the partition holds both:
+
+  | payload (data blocks) | top level | ... | level 0 |
+                          ^ hash_offset
+"""
+
+import hashlib
+import mmap
+import os
+import threading
+
+ALGORITHM  = "sha256"
+BLOCK_SIZE = 4096
+
+def div_round_up(a, b):
+  return (a + b - 1) // b
+
+def digest_stride(digest_size):
+  """Bytes a digest takes in a hash block: its size rounded up to a power
+  of two."""
+  stride = 1
+  while stride < digest_size:
+    stride <<= 1
+  return stride
+
+def level_sizes(data_blocks, block_size=BLOCK_SIZE, algorithm=ALGORITHM):
+  """Return the number of hash blocks of each level of the tree of
+  data_blocks data blocks, level 0 (the hashes of the data) first. A
+  single data block has no levels, it's hashed into the root hash."""
+  hashes_per_block = block_size // digest_stride(hashlib.new(algorithm).digest_size)
+  levels = []
+  blocks = data_blocks
+  while blocks > 1:
+    blocks = div_round_up(blocks, hashes_per_block)
+    levels.append(blocks)
+  return levels
+
+def tree_size(data_size, block_size=BLOCK_SIZE, algorithm=ALGORITHM):
+  """Return the bytes of the tree of data_size bytes of payload."""
+  return sum(level_sizes(div_round_up(data_size, block_size),
+                         block_size, algorithm)) * block_size
+
+class HashTree(object):
+  """The tree of a payload, see build()."""
+
+  def __init__(self, data_size, salt, block_size, algorithm):
+    self.data_size   = data_size
+    self.salt        = salt
+    self.block_size  = block_size
+    self.algorithm   = algorithm
+    self.data_blocks = div_round_up(data_size, block_size)
+    self.levels      = level_sizes(self.data_blocks, block_size, algorithm)
+    self.tree        = bytearray(sum(self.levels) * block_size)
+    self.root_hash   = None
+
+  def hash_offset(self):
+    """Offset of the tree in the partition, after the padded payload."""
+    return self.data_blocks * self.block_size
+
+  def level_offset(self, level):
+    """Offset in the tree of level, the levels above it come first."""
+    return sum(self.levels[level + 1:]) * self.block_size
+
+  def table(self, device):
+    """Return the dm-verity table of the partition at device."""
+    return "1 %s %s %d %d %d %d %s %s %s" % (
+      device, device, self.block_size, self.block_size, self.data_blocks,
+      self.hash_offset() // self.block_size, self.algorithm,
+      hexlify(self.root_hash), hexlify(self.salt) or "-")
+
+  def write_metadata(self, filename, label, payload):
+    items = [
+      ("label",            label),
+      ("payload",          payload),
+      ("algorithm",        self.algorithm),
+      ("data_block_size",  self.block_size),
+      ("hash_block_size",  self.block_size),
+      ("data_blocks",      self.data_blocks),
+      ("hash_start_block", self.hash_offset() // self.block_size),
+      ("hash_offset",      self.hash_offset()),
+      ("tree_size",        len(self.tree)),
+      ("salt",             hexlify(self.salt)),
+      ("root_hash",        hexlify(self.root_hash)),
+      ("table",            self.table("/dev/block/by-name/%s" % label)),
+    ]
+    with open(filename, "w") as f:
+      for key, value in items:
+        f.write("%s=%s\n" % (key, value))
+
+def hexlify(data):
+  import binascii
+  return binascii.hexlify(bytes(data)).decode("ascii")
+
+def hash_blocks(source, start, end, salted, block_size, stride, out,
+                out_offset):
+  """Hash blocks [start, end) of source into out from out_offset on."""
+  for i in range(start, end):
+    offset = i * block_size
+    data = source[offset:offset + block_size]
+    if len(data) < block_size:
+      # The payload ends within its last block.
+      data = data + b"\0" * (block_size - len(data))
+    h = salted.copy()
+    h.update(data)
+    o = out_offset + i * stride
+    out[o:o + h.digest_size] = h.digest()
+
+def hash_level(source, count, salted, block_size, out, out_offset, threads):
+  """Hash the count blocks of source into a level of out, the blocks are
+  split between threads (hashlib releases the GIL while hashing)."""
+  stride = digest_stride(salted.digest_size)
+  threads = max(1, min(threads, count // 256))
+  if threads == 1:
+    hash_blocks(source, 0, count, salted, block_size, stride, out,
+                out_offset)
+    return
+
+  workers = []
+  step = div_round_up(count, threads)
+  for start in range(0, count, step):
+    t = threading.Thread(target=hash_blocks,
+                         args=(source, start, min(start + step, count),
+                               salted, block_size, stride, out, out_offset))
+    t.start()
+    workers.append(t)
+  for t in workers:
+    t.join()
+
+def build(filename, salt=b"", block_size=BLOCK_SIZE, algorithm=ALGORITHM,
+          threads=None):
+  """Return the HashTree of the payload in filename, or None if it's
+  empty. Level 0 is hashed by threads (default: the number of CPUs)
+  from the memory mapped payload, the upper levels from the tree in
+  memory."""
+  if threads is None:
+    import multiprocessing
+    threads = multiprocessing.cpu_count()
+
+  data_size = os.path.getsize(filename)
+  if data_size == 0:
+    return None
+
+  tree = HashTree(data_size, salt, block_size, algorithm)
+  salted = hashlib.new(algorithm)
+  salted.update(salt)
+
+  root = bytearray(digest_stride(salted.digest_size))
+
+  with open(filename, "rb") as f:
+    payload = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      if len(tree.levels) == 0:
+        hash_level(payload, 1, salted, block_size, root, 0, 1)
+      else:
+        hash_level(payload, tree.data_blocks, salted, block_size,
+                   tree.tree, tree.level_offset(0), threads)
+    finally:
+      payload.close()
+
+  for level in range(1, len(tree.levels) + 1):
+    below = tree.level_offset(level - 1)
+    count = tree.levels[level - 1]
+    source = tree.tree[below:below + count * block_size]
+    if level == len(tree.levels):
+      hash_level(source, 1, salted, block_size, root, 0, 1)
+    else:
+      hash_level(source, count, salted, block_size, tree.tree,
+                 tree.level_offset(level), threads)
+
+  tree.root_hash = bytes(root[:salted.digest_size])
+  return tree
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 The Yudatun Open Source Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation
+#
+
+"""
+Given a partition xml and an image directory, watches the source trees of
+the partitions (source="..." tag, relative to the xml) and rebuilds the
+payloads (partition filename) of those changed. Otherwise print usages.
+
+Changes are picked up with inotify, or by polling the trees where inotify
+isn't available, and rebuilt once the trees have been quiet for the
+debounce time. An ext4 payload (fstype="ext4", the default) is rebuilt
+with mkext4fs -p; a vfat payload (fstype="vfat") is patched in place with
+mtools, file by file, and rebuilt with mkvfatfs if that fails. The
+payloads to rebuild are built concurrently (common.runJobs). The
+partitions of an assembled disk image (mkpart -D) are refreshed with the
+new payloads, writing only the blocks which changed.
+
+Usage: watch [flags] -x partition.xml -i images
+
+  -x  (--xml) <partition.xml>
+      The partition XML file.
+
+  -i  (--images) <directory>
+      The directory of the payloads.
+
+  -D  (--disk) <disk image>
+      The disk image of the partitions to refresh.
+
+  -d  (--debounce) <ms>
+      The quiet time before rebuilding (default 500).
+
+  -P  (--poll) <seconds>
+      Poll the trees every seconds, instead of using inotify.
+
+  -1  (--once)
+      Rebuild the payloads older than their trees, and exit.
+
+"""
+
+import os
+import select
+import struct
+import sys
+import time
+
+import common
+
+OPTIONS = common.OPTIONS
+OPTIONS.xml = None
+OPTIONS.images = None
+OPTIONS.disk_image = None
+OPTIONS.debounce = 500
+OPTIONS.poll = None
+OPTIONS.once = False
+
+POLL_INTERVAL = 1.0
+COPY_SIZE = 1024 * 1024
+
+# inotify(7)
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+             IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+             IN_MOVE_SELF
+
+# wd, mask, cookie, len
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class Target(object):
+  """A payload, built from source, of the partitions labels."""
+
+  def __init__(self, part, source, payload):
+    self.source  = source
+    self.payload = payload
+    self.fstype  = part.fstype
+    self.part    = part
+    self.labels  = [part.label]
+
+def targets(xml, images):
+  """Return the Targets of the partitions of xml with a source tree, one
+  for the slots of an A/B partition."""
+  import parser
+  import pt
+
+  parser.PARSER.xml2object(xml)
+  base = os.path.dirname(os.path.abspath(xml))
+  found = {}
+  for partitions in pt.PHYSICAL_PARTITIONS:
+    for part in partitions.part_list:
+      if part.source == "" or part.filename == "":
+        continue
+      source = os.path.realpath(os.path.join(base, part.source))
+      payload = os.path.join(images, part.filename)
+      if payload in found:
+        found[payload].labels.append(part.label)
+        continue
+      found[payload] = Target(part, source, payload)
+  return list(found.values())
+
+def tree_mtime(root):
+  """Return the latest mtime of root and everything in it."""
+  latest = os.path.getmtime(root)
+  for dpath, dnames, fnames in os.walk(root):
+    for name in dnames + fnames:
+      try:
+        latest = max(latest, os.lstat(os.path.join(dpath, name)).st_mtime)
+      except OSError:
+        pass
+  return latest
+
+class InotifyWatcher(object):
+  """Watches the trees roots with inotify, through ctypes."""
+
+  def __init__(self, roots):
+    import ctypes
+    import ctypes.util
+
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                            use_errno=True)
+    if not hasattr(self.libc, "inotify_init1"):
+      raise OSError("no inotify")
+    self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1")
+    self.roots = roots
+    self.dirs = {}  # wd -> directory
+    for root in roots:
+      self.add_tree(root)
+
+  def add_tree(self, root):
+    import ctypes
+
+    for dpath, dnames, fnames in os.walk(root):
+      wd = self.libc.inotify_add_watch(self.fd, dpath.encode("utf-8"),
+                                       WATCH_MASK)
+      if wd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_add_watch %s" % dpath)
+      self.dirs[wd] = dpath
+
+  def wait(self, timeout):
+    """Return the paths changed, waiting timeout seconds at most (None
+    for ever) for the first of them."""
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if len(readable) == 0:
+      return []
+    try:
+      data = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+
+    changed = []
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+      wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+      offset += INOTIFY_EVENT.size
+      name = data[offset:offset + length].rstrip(b"\0").decode("utf-8",
+                                                               "replace")
+      offset += length
+
+      if mask & IN_Q_OVERFLOW:
+        # Events were lost, anything may have changed.
+        changed.extend(self.roots)
+        continue
+      if mask & IN_IGNORED:
+        self.dirs.pop(wd, None)
+        continue
+      directory = self.dirs.get(wd)
+      if directory is None:
+        continue
+      path = os.path.join(directory, name) if name != "" else directory
+      changed.append(path)
+      if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+        self.add_tree(path)
+    return changed
+
+  def close(self):
+    os.close(self.fd)
+
+class PollWatcher(object):
+  """Watches the trees roots by comparing their stats every interval."""
+
+  def __init__(self, roots, interval=POLL_INTERVAL):
+    self.roots = roots
+    self.interval = interval
+    self.state = self.scan()
+
+  def scan(self):
+    state = {}
+    for root in self.roots:
+      for dpath, dnames, fnames in os.walk(root):
+        for name in [""] + dnames + fnames:
+          path = os.path.join(dpath, name) if name != "" else dpath
+          try:
+            st = os.lstat(path)
+          except OSError:
+            continue
+          state[path] = (st.st_mtime_ns, st.st_size, st.st_mode)
+    return state
+
+  def wait(self, timeout):
+    if timeout is None or timeout > self.interval:
+      timeout = self.interval
+    time.sleep(timeout)
+    state = self.scan()
+    changed = [p for p in set(state) | set(self.state)
+               if state.get(p) != self.state.get(p)]
+    self.state = state
+    return changed
+
+  def close(self):
+    pass
+
+def watcher(roots, poll=None):
+  if poll is None:
+    try:
+      return InotifyWatcher(roots)
+    except (OSError, AttributeError) as e:
+      print("No inotify (%s), polling every %.1fs" % (e, POLL_INTERVAL))
+      poll = POLL_INTERVAL
+  return PollWatcher(roots, poll)
+
+def run(cmd):
+  try:
+    p = common.run(cmd)
+  except Exception as e:
+    print("Error: Unable to execute command: {}".format(' '.join(cmd)))
+    raise e
+  p.wait()
+  return p.returncode == 0
+
+def tool(name):
+  return os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py")
+
+def rebuild_command(target, xml, tmp):
+  """Return the command building the payload of target into tmp."""
+  if target.fstype == "vfat":
+    return [sys.executable, tool("mkvfatfs"),
+            "-s", str(target.part.size_in_kb * 1024),
+            "-t", target.part.label[:11], target.source, tmp]
+  return [sys.executable, tool("mkext4fs"), "-x", xml, "-p",
+          target.part.label, target.source, tmp]
+
+def rebuild(target_list, xml):
+  """Build the payloads of target_list anew, concurrently, each into a
+  temporary file first. Returns the seconds each build took."""
+  tmps = [target.payload + ".tmp" for target in target_list]
+  results = common.runJobs([rebuild_command(target, xml, tmp)
+                            for target, tmp in zip(target_list, tmps)])
+  failed = []
+  for target, tmp, result in zip(target_list, tmps, results):
+    if result.ok():
+      os.rename(tmp, target.payload)
+      continue
+    if os.path.exists(tmp):
+      os.unlink(tmp)
+    failed.append("%s (exit %s)" % (target.payload, result.returncode))
+  if len(failed) > 0:
+    raise RuntimeError("rebuild of %s failed, -v shows the output"
+                       % ", ".join(failed))
+  return [result.duration for result in results]
+
+def outermost(paths):
+  """Return paths without those within another of them."""
+  result = []
+  for path in sorted(set(paths)):
+    if len(result) > 0 and path.startswith(result[-1] + os.sep):
+      continue
+    result.append(path)
+  return result
+
+def patch_vfat(target, paths):
+  """Apply the changes of paths of the tree of target to its vfat image
+  with mtools, return whether all of them were applied."""
+  image = target.payload
+  for path in outermost(paths):
+    dst = "::/" + os.path.relpath(path, target.source).replace(os.sep, "/")
+    if os.path.isdir(path):
+      parent = "::/" + os.path.relpath(os.path.dirname(path),
+                                       target.source).replace(os.sep, "/")
+      if parent == "::/.":
+        parent = "::/"
+      ok = run(["mcopy", "-o", "-s", "-Q", "-i", image, path, parent])
+    elif os.path.exists(path):
+      ok = run(["mcopy", "-o", "-Q", "-i", image, path, dst])
+    else:
+      ok = run(["mdel", "-i", image, dst]) or \
+           run(["mdeltree", "-i", image, dst])
+    if not ok:
+      return False
+  return True
+
+def patch(target, paths):
+  """Bring the vfat payload of target up to date with the changes of
+  paths in place, return whether it was, or it needs a rebuild."""
+  if target.fstype == "vfat" and os.path.exists(target.payload) and \
+     target.source not in paths:
+    try:
+      if patch_vfat(target, paths):
+        return True
+    except OSError:
+      # No mtools
+      pass
+    print("| %-12s patch failed, rebuilding" % target.part.label)
+  return False
+
+def disk_spans(disk, lun_count):
+  """Return (disk image, lun) of each physical partition, named as mkpart
+  -D names them."""
+  if lun_count == 1:
+    return [(disk, 0)]
+  root, ext = os.path.splitext(disk)
+  return [("%s%d%s" % (root, lun, ext), lun) for lun in range(lun_count)]
+
+def write_range(f, offset, room, payload):
+  """Make the room bytes of f at offset hold the raw payload followed by
+  zeros, writing only the blocks which differ."""
+  import sparse
+
+  position = 0
+  with open(payload, "rb") as src:
+    while position < room:
+      n = min(COPY_SIZE, room - position)
+      new = src.read(n)
+      if len(new) < n:
+        new += sparse.ZEROS[:n - len(new)]
+      f.seek(offset + position)
+      old = f.read(n)
+      if old != new:
+        f.seek(offset + position)
+        f.write(new)
+      position += n
+
+def refresh_disk(disk, target):
+  """Write the payload of target into the partitions of target in the
+  disk images of disk."""
+  import assemble
+  import pt
+  import sparse
+  import validate
+
+  if sparse.is_sparse(target.payload):
+    raise RuntimeError("%s: sparse payloads can't refresh a disk image"
+                       % target.part.label)
+  size = assemble.payload_size(target.payload)
+  for image, lun in disk_spans(disk, len(pt.PHYSICAL_PARTITIONS)):
+    if not os.path.isfile(image):
+      continue
+    partitions = pt.PHYSICAL_PARTITIONS[lun]
+    sectors = os.path.getsize(image) // pt.BYTES_PER_SECTOR
+    spans = validate.place_partitions(partitions, partitions.instructions,
+                                      sectors)
+    with open(image, "r+b") as f:
+      for first, last, part in spans:
+        if part.label not in target.labels:
+          continue
+        room = (last - first + 1) * pt.BYTES_PER_SECTOR
+        if size > room:
+          raise RuntimeError("%s: %d bytes of payload, the partition has %d"
+                             % (part.label, size, room))
+        write_range(f, first * pt.BYTES_PER_SECTOR, room, target.payload)
+        print("| %-12s refreshed in %s" % (part.label, image))
+
+def process(changes, xml, disk):
+  """Update the targets of changes, a dict Target -> paths changed: patch
+  them, or rebuild them all at once."""
+  took = {}
+  stale = []
+  for target, paths in changes.items():
+    start = time.time()
+    if patch(target, paths):
+      took[target] = ("patched", time.time() - start)
+    else:
+      stale.append(target)
+  if len(stale) > 0:
+    for target, seconds in zip(stale, rebuild(stale, xml)):
+      took[target] = ("rebuilt", seconds)
+
+  for target, paths in changes.items():
+    how, seconds = took[target]
+    if disk is not None:
+      refresh_disk(disk, target)
+    print("| %-12s %s %s in %.2fs (%d changes)"
+      % (target.part.label, how, target.payload, seconds, len(paths)))
+
+def watch(target_list, xml, disk, debounce, poll=None):
+  """Rebuild the targets as their trees change, until interrupted."""
+  w = watcher([t.source for t in target_list], poll)
+  print("Watching %d trees (%s)"
+    % (len(target_list), type(w).__name__[:-len("Watcher")].lower()))
+  pending = {}
+  deadline = None
+  try:
+    while True:
+      timeout = None
+      if deadline is not None:
+        timeout = max(0.0, deadline - time.time())
+      changed = w.wait(timeout)
+      for path in changed:
+        for target in target_list:
+          if path == target.source or \
+             path.startswith(target.source + os.sep):
+            pending.setdefault(target, set()).add(path)
+      if len(changed) > 0:
+        deadline = time.time() + debounce / 1000.0
+      elif deadline is not None and time.time() >= deadline:
+        try:
+          process(pending, xml, disk)
+        except RuntimeError as e:
+          print("Error: %s" % (e,))
+        pending = {}
+        deadline = None
+  except KeyboardInterrupt:
+    pass
+  finally:
+    w.close()
+
+def main(argv):
+
+  def option_handler(opt, arg):
+    if opt in ("-x", "--xml"):
+      OPTIONS.xml = arg
+    elif opt in ("-i", "--images"):
+      OPTIONS.images = arg
+    elif opt in ("-D", "--disk"):
+      OPTIONS.disk_image = arg
+    elif opt in ("-d", "--debounce"):
+      OPTIONS.debounce = int(arg)
+    elif opt in ("-P", "--poll"):
+      OPTIONS.poll = float(arg)
+    elif opt in ("-1", "--once"):
+      OPTIONS.once = True
+    else:
+      return False
+    return True
+
+  args = common.parseOptions(argv, __doc__,
+                             extra_opts="x:i:D:d:P:1",
+                             extra_long_opts=[
+                               "xml=",
+                               "images=",
+                               "disk=",
+                               "debounce=",
+                               "poll=",
+                               "once",
+                             ],
+                             extra_option_handler=option_handler)
+
+  if len(args) != 0 or OPTIONS.xml is None or OPTIONS.images is None:
+    common.usage(__doc__)
+    sys.exit(1)
+
+  target_list = targets(OPTIONS.xml, OPTIONS.images)
+  if len(target_list) == 0:
+    raise RuntimeError("no partition of %s has a source tree" % OPTIONS.xml)
+
+  stale = {}
+  for target in target_list:
+    if not os.path.isdir(target.source):
+      raise RuntimeError("%s: no source tree %s"
+                         % (target.part.label, target.source))
+    if not os.path.exists(target.payload) or \
+       os.path.getmtime(target.payload) < tree_mtime(target.source):
+      stale[target] = set([target.source])
+  process(stale, OPTIONS.xml, OPTIONS.disk_image)
+
+  if OPTIONS.once is False:
+    watch(target_list, OPTIONS.xml, OPTIONS.disk_image, OPTIONS.debounce,
+          OPTIONS.poll)
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except RuntimeError as e:
+    print()
+    print("Error: %s" % (e,))
+    print()
+    sys.exit(1)